@@ -1,18 +1,40 @@
 import asyncio
-import inspect
-import json
 import logging
 import os
+from contextlib import aclosing
 from typing import AsyncGenerator, Generator, Union
 
+from aimanager.completions._interface import ToolsNotSupportedError
 from aimanager.completions.builder import AsyncCompletionsClientBuilder, CompletionsClientBuilder
+from aimanager.completions.usage import track_usage
 from aimanager.memory.builder import AsyncMemoryProviderBuilder, MemoryProviderBuilder
+from aimanager.memory.summarizer import ConversationSummarizer, summary_message
+from aimanager.metrics import metrics
 from aimanager.tools import invoker, prompts
+from aimanager.tracing import traced, tracer
 
+from ._budget import BudgetStats, ToolBudget, TurnBudget
+from ._context import ContextStats, ContextWindow
 from ._interface import AIAgentInterface, AsyncAIAgentInterface
+from ._prompt import CompiledPrompt, PromptCacheStats, compile_prompt
+from .admission import admission
 
 logger = logging.getLogger("django")
 
+TURN_SECONDS = metrics.histogram("agent_turn_seconds", "Duration of agent turns, tool rounds included", ("agent",))
+
+
+def _tool_message(fname: str, result) -> dict:
+    if isinstance(result, Exception):
+        return {
+            "role": "developer",
+            "content": f"You tried to trigger function {fname} but excepthion was rised: {result}",
+        }
+    return {
+        "role": "developer",
+        "content": f"You successfully triggered a function {fname} and it returned: {result}",
+    }
+
 
 class BaseAgent(AIAgentInterface):
     name = "base"
@@ -26,44 +48,55 @@ class BaseAgent(AIAgentInterface):
         "very good at understanding natural language."
     )
 
+    @traced("agent.compose_messages")
     def _compose_messages_list(
         self, prompt: str, user_id: Union[str, int], conversation_id: Union[str, int]
     ) -> list[dict]:
-        instruction = self.system_prompt
-        if self.tools_registry:
-            instruction += f"\n{prompts.FUNCTION_INSTRUCTION}"
-            schemes = [tool.llm_schema for tool in self.tools_registry.values()]
-            instruction += f"\n{json.dumps(schemes)}"
-
-        system_messages = [{"role": "system", "content": instruction}]
-        conversation_history = self.get_conversation(user_id, conversation_id)
+        system_messages = [self.compiled_prompt.message]
+        summary = self.memory.get_summary(user_id, self.name, conversation_id)
+        if summary:
+            # messages folded into the summary are not sent again
+            system_messages.append(summary_message(summary))
+        conversation_history = self.memory.get_conversation(
+            user_id,
+            self.name,
+            conversation_id,
+            limit=self.context_window.max_messages,
+            offset=summary["covered"] if summary else 0,
+        )
         user_message = [{"role": "user", "content": prompt}]
         self.memory.add_messages_to_conversation(user_message, user_id, self.name, conversation_id)
+        conversation_history = self._fit_context(system_messages, conversation_history or [], user_message)
         return system_messages + conversation_history + user_message
 
-    def _check_tools(self, response: str, conversation_list: list) -> dict:
+    def _complete(self, messages: list[dict], stream: bool = False):
+        compiled = self.compiled_prompt
+        try:
+            return self.completions.generate_response(
+                [compiled.message] + messages[1:], model=self.model, stream=stream, tools=compiled.tools
+            )
+        except ToolsNotSupportedError:
+            # the provider remembered the model, the next attempt uses the prompt protocol
+            return self._complete(messages, stream)
+
+    def _call_tools(self, calls: list[dict], budget: TurnBudget) -> list[dict]:
+        if budget.check():
+            return [budget.exhausted_message()]
+        results = invoker.trigger_functions(calls, self.tools_registry, timeout=budget.tool_timeout())
+        budget.add_round(results)
+        return [_tool_message(call["name"], result) for call, result in zip(calls, results)]
+
+    @traced("agent.check_tools")
+    def _check_tools(self, response: str, conversation_list: list, budget: TurnBudget = None) -> dict:
+        budget = budget or self.tool_budget.start()
         response = invoker.parse_llm_response(response)
         message = []
         while response["type"] == "function":
-            result = invoker.trigger_function(response, self.tools_registry)
-            fname = response["name"]
-            try:
-                if inspect.iscoroutine(result):
-                    result = asyncio.run(result)
-                message += [
-                    {
-                        "role": "developer",
-                        "content": f"You successfully triggered a function {fname} and it returned: {result}",
-                    }
-                ]
-            except Exception as e:
-                message += [
-                    {
-                        "role": "developer",
-                        "content": f"You tried to trigger function {fname} but excepthion was rised: {e}",
-                    }
-                ]
-            response = self.completions.generate_response(conversation_list + message, model=self.model)
+            if budget.exhausted:
+                # the model was told to stop calling functions and still did
+                return prompts.BUDGET_EXHAUSTED_REPLY
+            message += self._call_tools(response["calls"], budget)
+            response = self._complete(conversation_list + message)
             response = invoker.parse_llm_response(response)
         return response["content"]
 
@@ -72,11 +105,42 @@ class BaseAgent(AIAgentInterface):
             raise TypeError(f"Cant register tool {tool.__name__}: no scheme")
         self.tools_registry[tool.__name__] = tool
 
+    @property
+    def native_tools(self) -> bool:
+        return bool(self.tools_registry) and self.completions.supports_tools(self.model)
+
+    @property
+    def compiled_prompt(self) -> CompiledPrompt:
+        return compile_prompt(self.system_prompt, tuple(self.tools_registry.values()), self.native_tools)
+
+    def prompt_report(self) -> dict:
+        return self.prompt_cache_stats.report(self.compiled_prompt)
+
+    def _fit_context(self, system_messages: list[dict], history: list[dict], user_message: list[dict]) -> list[dict]:
+        history, report = self.context_window.fit(system_messages, history, user_message, self.model)
+        self.context_stats.add(report)
+        if report.saved_tokens:
+            logger.info(f"Agent {self.name} context window: {report.as_dict()}")
+        return history
+
+    def _finish_turn(self, budget: TurnBudget) -> None:
+        self.budget_stats.add(budget)
+        TURN_SECONDS.labels(self.name).observe(budget.elapsed())
+        logger.info(f"Agent {self.name} turn budget: {budget.as_dict()}")
+
     def init_agent(self, *args, **kwargs) -> dict:
-        self.memory = MemoryProviderBuilder.build(self.memory_provider)
-        self.completions = CompletionsClientBuilder.build(kwargs.get("provider") or self.model_provider)
+        self.memory = kwargs.get("memory") or MemoryProviderBuilder.build(self.memory_provider)
+        self.completions = kwargs.get("completions") or CompletionsClientBuilder.build(
+            kwargs.get("provider") or self.model_provider
+        )
         self.system_prompt = kwargs.get("system_prompt") or self.system_prompt
         self.model = kwargs.get("model")
+        self.prompt_cache_stats = PromptCacheStats()
+        self.tool_budget = kwargs.get("tool_budget") or ToolBudget()
+        self.budget_stats = BudgetStats()
+        self.context_window = kwargs.get("context_window") or ContextWindow()
+        self.context_stats = ContextStats()
+        self.summarizer = kwargs.get("summarizer") or ConversationSummarizer(admission=admission)
         self.tools_registry = {}
         for tool in kwargs.get("tools") or self.tools or []:
             self.register_tool(tool)
@@ -88,26 +152,57 @@ class BaseAgent(AIAgentInterface):
     def clear_conversation(self, user_id: str, conversation_id: str = None) -> bool:
         return self.memory.delete_conversation(user_id, self.name, conversation_id)
 
-    def generate_response(self, prompt: str, user_id: str, conversation_id: str = None) -> str:
-        messages = self._compose_messages_list(prompt, user_id, conversation_id)
-        response = self.completions.generate_response(messages, model=self.model)
-        self._check_tools(response, messages)
-        message = [{"role": "assistant", "content": response}]
-        self.memory.add_messages_to_conversation(message, user_id, self.name, conversation_id)
-        return response
+    def generate_response(self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None) -> str:
+        with tracer.span("agent.generate_response", agent=self.name, model=self.model):
+            with track_usage() as usage:
+                budget = self.tool_budget.start(usage)
+                messages = self._compose_messages_list(prompt, user_id, conversation_id)
+                response = self._complete(messages)
+                response = self._check_tools(response, messages, budget)
+            self.prompt_cache_stats.add(usage)
+            self._finish_turn(budget)
+            message = [{"role": "assistant", "content": response}]
+            self.memory.add_messages_to_conversation(message, user_id, self.name, conversation_id)
+            self.summarizer.schedule(self, user_id, conversation_id, tenant)
+            return response
 
-    def generate_response_stream(self, prompt: str, user_id: str, conversation_id: str = None) -> Generator[str]:
-        messages = self._compose_messages_list(prompt, user_id, conversation_id)
-        stream = self.completions.generate_response(messages, model=self.model, stream=True)
-        response = ""
-        for chunk in stream:
-            response += chunk
-            if not response.startswith("{"):
-                yield chunk
+    def generate_response_stream(
+        self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None
+    ) -> Generator[str]:
+        with track_usage() as usage:
+            budget = self.tool_budget.start(usage)
+            messages = self._compose_messages_list(prompt, user_id, conversation_id)
+            tool_messages = []
+            while True:
+                detector = invoker.StreamingCallDetector()
+                stream = self._complete(messages + tool_messages, stream=True)
+                response = ""
+                for chunk in stream:
+                    text = detector.feed(chunk)
+                    if text:
+                        response += text
+                        yield text
+                    if detector.call:
+                        # the rest of the answer is not needed, the follow-up completion replaces it
+                        stream.close()
+                        break
+                text = detector.flush()
+                if text:
+                    response += text
+                    yield text
+                if detector.call is None:
+                    break
+                if budget.exhausted:
+                    response = prompts.BUDGET_EXHAUSTED_REPLY
+                    yield response
+                    break
+                tool_messages += self._call_tools(detector.call["calls"], budget)
 
-        # TODO: handle logic with functions and stream
+        self.prompt_cache_stats.add(usage)
+        self._finish_turn(budget)
         message = [{"role": "assistant", "content": response}]
         self.memory.add_messages_to_conversation(message, user_id, self.name, conversation_id)
+        self.summarizer.schedule(self, user_id, conversation_id, tenant)
         return response
 
 
@@ -123,44 +218,71 @@ class BaseAsyncAgent(AsyncAIAgentInterface):
         "very good at understanding natural language."
     )
 
+    @traced("agent.compose_messages")
     async def _compose_messages_list(
         self, prompt: str, user_id: Union[str, int], conversation_id: Union[str, int]
     ) -> list[dict]:
-        instruction = self.system_prompt
-        if self.tools_registry:
-            instruction += f"\n{prompts.FUNCTION_INSTRUCTION}"
-            schemes = [tool.llm_schema for tool in self.tools_registry.values()]
-            instruction += f"\n{json.dumps(schemes)}"
-        system_messages = [{"role": "system", "content": instruction}]
-        conversation_history = await self.async_get_conversation(user_id, conversation_id)
+        system_messages = [self.compiled_prompt.message]
+        summary = await self.memory.async_get_summary(user_id, self.name, conversation_id)
+        if summary:
+            # messages folded into the summary are not sent again
+            system_messages.append(summary_message(summary))
+        conversation_history = await self.memory.async_get_conversation(
+            user_id,
+            self.name,
+            conversation_id,
+            limit=self.context_window.max_messages,
+            offset=summary["covered"] if summary else 0,
+        )
         user_message = [{"role": "user", "content": prompt}]
         await self.memory.async_add_messages_to_conversation(user_message, user_id, self.name, conversation_id)
+        conversation_history = self._fit_context(system_messages, conversation_history or [], user_message)
         return system_messages + conversation_history + user_message
 
-    async def _check_tools(self, response: str, conversation_list: list) -> dict:
+    async def _complete(self, messages: list[dict]) -> str:
+        compiled = self.compiled_prompt
+        try:
+            return await self.completions.async_generate_response(
+                [compiled.message] + messages[1:], model=self.model, tools=compiled.tools
+            )
+        except ToolsNotSupportedError:
+            # the provider remembered the model, the next attempt uses the prompt protocol
+            return await self._complete(messages)
+
+    async def _complete_stream(self, messages: list[dict]) -> AsyncGenerator[str]:
+        while True:
+            compiled = self.compiled_prompt
+            stream = self.completions.async_generate_response_stream(
+                [compiled.message] + messages[1:], model=self.model, stream=True, tools=compiled.tools
+            )
+            try:
+                async for chunk in stream:
+                    yield chunk
+                return
+            except ToolsNotSupportedError:
+                # raised before the first chunk; the next attempt uses the prompt protocol
+                continue
+            finally:
+                await stream.aclose()
+
+    async def _call_tools(self, calls: list[dict], budget: TurnBudget) -> list[dict]:
+        if budget.check():
+            return [budget.exhausted_message()]
+        results = await invoker.async_trigger_functions(calls, self.tools_registry, timeout=budget.tool_timeout())
+        budget.add_round(results)
+        return [_tool_message(call["name"], result) for call, result in zip(calls, results)]
+
+    @traced("agent.check_tools")
+    async def _check_tools(self, response: str, conversation_list: list, budget: TurnBudget = None) -> dict:
+        budget = budget or self.tool_budget.start()
         response = invoker.parse_llm_response(response)
         message = []
         while response["type"] == "function":
-            # TODO: possible infinite loop. To handle (bot created 10 records)
-            result = invoker.trigger_function(response, self.tools_registry)
-            fname = response["name"]
-            try:
-                if inspect.iscoroutine(result):
-                    result = await result
-                message += [
-                    {
-                        "role": "developer",
-                        "content": f"You successfully triggered a function {fname} and it returned: {result}",
-                    }
-                ]
-            except Exception as e:
-                message += [
-                    {
-                        "role": "developer",
-                        "content": f"You tried to trigger function {fname} but excepthion was rised: {e}",
-                    }
-                ]
-            response = await self.completions.async_generate_response(conversation_list + message, model=self.model)
+            if budget.exhausted:
+                # the model was told to stop calling functions and still did
+                return prompts.BUDGET_EXHAUSTED_REPLY
+            message += await self._call_tools(response["calls"], budget)
+            response = await self._complete(conversation_list + message)
             response = invoker.parse_llm_response(response)
         return response["content"]
 
@@ -169,11 +291,42 @@ class BaseAsyncAgent(AsyncAIAgentInterface):
             raise TypeError(f"Cant register tool {tool.__name__}: no scheme")
         self.tools_registry[tool.__name__] = tool
 
+    @property
+    def native_tools(self) -> bool:
+        return bool(self.tools_registry) and self.completions.supports_tools(self.model)
+
+    @property
+    def compiled_prompt(self) -> CompiledPrompt:
+        return compile_prompt(self.system_prompt, tuple(self.tools_registry.values()), self.native_tools)
+
+    def prompt_report(self) -> dict:
+        return self.prompt_cache_stats.report(self.compiled_prompt)
+
+    def _fit_context(self, system_messages: list[dict], history: list[dict], user_message: list[dict]) -> list[dict]:
+        history, report = self.context_window.fit(system_messages, history, user_message, self.model)
+        self.context_stats.add(report)
+        if report.saved_tokens:
+            logger.info(f"Agent {self.name} context window: {report.as_dict()}")
+        return history
+
+    def _finish_turn(self, budget: TurnBudget) -> None:
+        self.budget_stats.add(budget)
+        TURN_SECONDS.labels(self.name).observe(budget.elapsed())
+        logger.info(f"Agent {self.name} turn budget: {budget.as_dict()}")
+
     def init_agent(self, *args, **kwargs) -> dict:
-        self.memory = AsyncMemoryProviderBuilder.build(self.memory_provider)
-        self.completions = AsyncCompletionsClientBuilder.build(kwargs.get("provider") or self.model_provider)
+        self.memory = kwargs.get("memory") or AsyncMemoryProviderBuilder.build(self.memory_provider)
+        self.completions = kwargs.get("completions") or AsyncCompletionsClientBuilder.build(
+            kwargs.get("provider") or self.model_provider
+        )
         self.system_prompt = kwargs.get("system_prompt") or self.system_prompt
         self.model = kwargs.get("model")
+        self.prompt_cache_stats = PromptCacheStats()
+        self.tool_budget = kwargs.get("tool_budget") or ToolBudget()
+        self.budget_stats = BudgetStats()
+        self.context_window = kwargs.get("context_window") or ContextWindow()
+        self.context_stats = ContextStats()
+        self.summarizer = kwargs.get("summarizer") or ConversationSummarizer(admission=admission)
         self.tools_registry = {}
         for tool in kwargs.get("tools") or self.tools or []:
             self.register_tool(tool)
@@ -185,26 +338,77 @@ class BaseAsyncAgent(AsyncAIAgentInterface):
     async def async_clear_conversation(self, user_id: str, conversation_id: str = None) -> bool:
         return await self.memory.async_delete_conversation(user_id, self.name, conversation_id)
 
-    async def async_generate_response(self, prompt: str, user_id: str, conversation_id: str = None) -> str:
-        messages = await self._compose_messages_list(prompt, user_id, conversation_id)
-        response = await self.completions.async_generate_response(messages, model=self.model)
-        response = await self._check_tools(response, messages)
+    async def async_generate_response(
+        self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None
+    ) -> str:
+        with tracer.span("agent.generate_response", agent=self.name, model=self.model):
+            with track_usage() as usage:
+                budget = self.tool_budget.start(usage)
+                messages = await self._compose_messages_list(prompt, user_id, conversation_id)
+                response = await self._complete(messages)
+                response = await self._check_tools(response, messages, budget)
+            self.prompt_cache_stats.add(usage)
+            self._finish_turn(budget)
+            await self._save_answer(response, user_id, conversation_id, tenant)
+            return response
+
+    async def _save_answer(self, response: str, user_id: str, conversation_id: str, tenant: str = None) -> None:
         message = [{"role": "assistant", "content": response}]
         await self.memory.async_add_messages_to_conversation(message, user_id, self.name, conversation_id)
-        return response
+        self.summarizer.async_schedule(self, user_id, conversation_id, tenant)
+
+    async def async_generate_events(
+        self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None
+    ) -> AsyncGenerator[dict]:
+        """
+        The answer as events: `delta` chunks of text, a `tool` event per function call and the `usage`
+        of the turn. A consumer that stops early aborts the completion, the answer so far is saved.
+        """
+        with track_usage() as usage:
+            budget = self.tool_budget.start(usage)
+            messages = await self._compose_messages_list(prompt, user_id, conversation_id)
+            tool_messages = []
+            response = ""
+            try:
+                while True:
+                    detector = invoker.StreamingCallDetector()
+                    response = ""
+                    async with aclosing(self._complete_stream(messages + tool_messages)) as stream:
+                        async for chunk in stream:
+                            text = detector.feed(chunk)
+                            if text:
+                                response += text
+                                yield {"type": "delta", "content": text}
+                            if detector.call:
+                                # the rest of the answer is not needed, the follow-up completion replaces it
+                                break
+                    text = detector.flush()
+                    if text:
+                        response += text
+                        yield {"type": "delta", "content": text}
+                    if detector.call is None:
+                        break
+                    if budget.exhausted:
+                        response = prompts.BUDGET_EXHAUSTED_REPLY
+                        yield {"type": "delta", "content": response}
+                        break
+                    for call in detector.call["calls"]:
+                        yield {"type": "tool", "name": call["name"]}
+                    tool_messages += await self._call_tools(detector.call["calls"], budget)
+            except (GeneratorExit, asyncio.CancelledError):
+                self._finish_turn(budget)
+                if response:
+                    await self._save_answer(response, user_id, conversation_id, tenant)
+                raise
+        self.prompt_cache_stats.add(usage)
+        self._finish_turn(budget)
+        await self._save_answer(response, user_id, conversation_id, tenant)
+        yield {"type": "usage", **usage.as_dict()}
 
     async def async_generate_response_stream(
-        self, prompt: str, user_id: str, conversation_id: str = None
+        self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None
     ) -> AsyncGenerator[str]:
-        messages = self._compose_messages_list(prompt, user_id, conversation_id)
-        stream = await self.completions.async_generate_response(messages, model=self.model, stream=True)
-        response = ""
-        async for chunk in stream:
-            response += chunk
-            if not response.startswith("{"):
-                yield chunk
-
-        # TODO: handle logic with functions and stream
-        message = [{"role": "assistant", "content": response}]
-        await self.memory.async_add_messages_to_conversation(message, user_id, self.name, conversation_id)
-        yield response
+        async with aclosing(self.async_generate_events(prompt, user_id, conversation_id, tenant)) as events:
+            async for event in events:
+                if event["type"] == "delta":
+                    yield event["content"]
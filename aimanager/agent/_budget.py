@@ -0,0 +1,114 @@
+import json
+import os
+import time
+
+from aimanager.tools import prompts
+
+
+class ToolBudget:
+    """
+    Limits of the tool loop of one turn: function-call rounds, runtime of a single tool,
+    wall-clock time of the whole turn and tokens spent on it. Zero disables a limit.
+    """
+
+    def __init__(
+        self, max_rounds: int = None, tool_timeout: float = None, turn_timeout: float = None, max_tokens: int = None
+    ):
+        self.max_rounds = max_rounds if max_rounds is not None else int(os.getenv("TOOL_MAX_ROUNDS", 5))
+        self.tool_timeout = tool_timeout if tool_timeout is not None else float(os.getenv("TOOL_TIMEOUT", 30))
+        self.turn_timeout = turn_timeout if turn_timeout is not None else float(os.getenv("TURN_TIMEOUT", 90))
+        self.max_tokens = max_tokens if max_tokens is not None else int(os.getenv("TURN_MAX_TOKENS", 0))
+
+    def start(self, usage=None) -> "TurnBudget":
+        return TurnBudget(self, usage)
+
+
+class TurnBudget:
+    """Budget use of a single turn. `usage` is the tracker of the turn from `track_usage()`."""
+
+    def __init__(self, limits: ToolBudget, usage=None):
+        self.limits = limits
+        self.usage = usage
+        self.started = time.monotonic()
+        self.rounds = 0
+        self.tool_calls = 0
+        self.tool_timeouts = 0
+        self.exhausted = None
+
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    def remaining(self) -> float:
+        if not self.limits.turn_timeout:
+            return None
+        return max(self.limits.turn_timeout - self.elapsed(), 0.0)
+
+    def tool_timeout(self) -> float:
+        """Timeout for tools of the next round: per-tool limit, capped by what is left of the turn."""
+        timeouts = [timeout for timeout in (self.limits.tool_timeout or None, self.remaining()) if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    @property
+    def tokens(self) -> int:
+        return self.usage.total_tokens if self.usage is not None else 0
+
+    def check(self) -> bool:
+        """Return True and remember the reason when no further tool round is allowed."""
+        if self.exhausted:
+            return True
+        if self.limits.max_rounds and self.rounds >= self.limits.max_rounds:
+            self.exhausted = "max_rounds"
+        elif self.remaining() == 0:
+            self.exhausted = "deadline"
+        elif self.limits.max_tokens and self.tokens >= self.limits.max_tokens:
+            self.exhausted = "tokens"
+        return self.exhausted is not None
+
+    def add_round(self, results: list) -> None:
+        self.rounds += 1
+        self.tool_calls += len(results)
+        self.tool_timeouts += sum(isinstance(result, TimeoutError) for result in results)
+        if self.usage is not None:
+            self.usage.add_round()
+
+    def exhausted_message(self) -> dict:
+        status = json.dumps({"status": "budget_exhausted", "reason": self.exhausted, **self.as_dict()})
+        return {"role": "developer", "content": f"{prompts.BUDGET_EXHAUSTED_INSTRUCTION}\n{status}"}
+
+    def as_dict(self) -> dict:
+        return {
+            "rounds": self.rounds,
+            "tool_calls": self.tool_calls,
+            "tool_timeouts": self.tool_timeouts,
+            "elapsed": round(self.elapsed(), 3),
+            "tokens": self.tokens,
+            "exhausted": self.exhausted,
+        }
+
+
+class BudgetStats:
+    """Per-agent totals of budget use, for monitoring."""
+
+    def __init__(self):
+        self.turns = 0
+        self.rounds = 0
+        self.tool_calls = 0
+        self.tool_timeouts = 0
+        self.exhausted = {}
+
+    def add(self, budget: TurnBudget) -> None:
+        self.turns += 1
+        self.rounds += budget.rounds
+        self.tool_calls += budget.tool_calls
+        self.tool_timeouts += budget.tool_timeouts
+        if budget.exhausted:
+            self.exhausted[budget.exhausted] = self.exhausted.get(budget.exhausted, 0) + 1
+
+    def as_dict(self) -> dict:
+        return {
+            "turns": self.turns,
+            "rounds": self.rounds,
+            "tool_calls": self.tool_calls,
+            "tool_timeouts": self.tool_timeouts,
+            "exhausted": dict(self.exhausted),
+        }
@@ -0,0 +1,127 @@
+import os
+
+from aimanager.completions.tokens import CHARS_PER_TOKEN, REPLY_OVERHEAD, estimate_message_tokens
+
+
+class ContextReport:
+    def __init__(self, budget: int, history_messages: int):
+        self.budget = budget
+        self.history_messages = history_messages
+        self.kept_messages = 0
+        self.compressed_messages = 0
+        self.original_tokens = 0
+        self.tokens = 0
+
+    @property
+    def dropped_messages(self) -> int:
+        return self.history_messages - self.kept_messages
+
+    @property
+    def saved_tokens(self) -> int:
+        return self.original_tokens - self.tokens
+
+    def as_dict(self) -> dict:
+        return {
+            "budget": self.budget,
+            "tokens": self.tokens,
+            "saved_tokens": self.saved_tokens,
+            "dropped_messages": self.dropped_messages,
+            "compressed_messages": self.compressed_messages,
+        }
+
+
+class ContextWindow:
+    """
+    Fits conversation history into a per-model prompt token budget.
+
+    The system prompt, the new user message and the latest `keep_last` history messages are always
+    sent. Older messages are kept newest first while they fit the budget, the rest is dropped.
+    Older messages longer than `max_message_tokens` are compressed by cutting them down.
+    """
+
+    # prompt budgets for models that need a different one than CONTEXT_MAX_TOKENS
+    model_budgets = {}
+
+    def __init__(
+        self,
+        max_tokens: int = None,
+        keep_last: int = None,
+        max_message_tokens: int = None,
+        max_messages: int = None,
+        model_budgets: dict = None,
+    ):
+        self.max_tokens = max_tokens or int(os.getenv("CONTEXT_MAX_TOKENS", 8000))
+        self.keep_last = keep_last if keep_last is not None else int(os.getenv("CONTEXT_KEEP_LAST", 4))
+        self.max_message_tokens = max_message_tokens or int(os.getenv("CONTEXT_MAX_MESSAGE_TOKENS", 1000))
+        # upper bound of history messages read from memory at all
+        self.max_messages = max_messages or int(os.getenv("CONTEXT_MAX_MESSAGES", 100))
+        self.model_budgets = {**self.model_budgets, **(model_budgets or {})}
+
+    def budget_for(self, model: str = None) -> int:
+        return self.model_budgets.get(model, self.max_tokens)
+
+    def compress(self, message: dict) -> dict:
+        content = message.get("content")
+        limit = self.max_message_tokens * CHARS_PER_TOKEN
+        if not isinstance(content, str) or len(content) <= limit:
+            return message
+        return {**message, "content": content[:limit] + "…"}
+
+    def fit(
+        self, system_messages: list[dict], history: list[dict], user_messages: list[dict], model: str = None
+    ) -> tuple[list[dict], ContextReport]:
+        """Return the history messages to send and a report of what was left out."""
+        report = ContextReport(self.budget_for(model), len(history))
+        counts = [estimate_message_tokens(message) for message in history]
+        fixed = sum(estimate_message_tokens(message) for message in system_messages + user_messages) + REPLY_OVERHEAD
+        report.original_tokens = fixed + sum(counts)
+
+        recent = len(history) - self.keep_last
+        used = fixed + sum(counts[max(recent, 0) :])
+        kept = []
+        for index in range(recent - 1, -1, -1):
+            message = history[index]
+            tokens = counts[index]
+            compressed = tokens > self.max_message_tokens
+            if compressed:
+                message = self.compress(message)
+                tokens = estimate_message_tokens(message)
+            if used + tokens > report.budget:
+                break
+            used += tokens
+            kept.append(message)
+            report.compressed_messages += compressed
+        kept.reverse()
+        window = kept + history[max(recent, 0) :]
+        # don't start the window in the middle of a turn
+        while len(window) > self.keep_last and window[0].get("role") != "user":
+            used -= estimate_message_tokens(window.pop(0))
+
+        report.kept_messages = len(window)
+        report.tokens = used
+        return window, report
+
+
+class ContextStats:
+    """Per-agent totals of tokens saved by the context window."""
+
+    def __init__(self):
+        self.turns = 0
+        self.trimmed_turns = 0
+        self.saved_tokens = 0
+        self.dropped_messages = 0
+
+    def add(self, report: ContextReport) -> None:
+        self.turns += 1
+        self.saved_tokens += report.saved_tokens
+        self.dropped_messages += report.dropped_messages
+        if report.saved_tokens:
+            self.trimmed_turns += 1
+
+    def as_dict(self) -> dict:
+        return {
+            "turns": self.turns,
+            "trimmed_turns": self.trimmed_turns,
+            "saved_tokens": self.saved_tokens,
+            "dropped_messages": self.dropped_messages,
+        }
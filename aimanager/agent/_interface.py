@@ -24,11 +24,13 @@ class AIAgentInterface(ABC):
         pass
 
     @abstractmethod
-    def generate_response(self, prompt: str, user_id: str, conversation_id: str = None) -> str:
+    def generate_response(self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None) -> str:
         pass
 
     @abstractmethod
-    def generate_response_stream(self, prompt: str, user_id: str, conversation_id: str = None) -> Generator[str]:
+    def generate_response_stream(
+        self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None
+    ) -> Generator[str]:
         pass
 
 
@@ -54,11 +56,13 @@ class AsyncAIAgentInterface(ABC):
         pass
 
     @abstractmethod
-    async def async_generate_response(self, prompt: str, user_id: str, conversation_id: str = None) -> str:
+    async def async_generate_response(
+        self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None
+    ) -> str:
         pass
 
     @abstractmethod
     async def async_generate_response_stream(
-        self, prompt: str, user_id: str, conversation_id: str = None
+        self, prompt: str, user_id: str, conversation_id: str = None, tenant: str = None
     ) -> Generator[str]:
         pass
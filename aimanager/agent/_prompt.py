@@ -0,0 +1,74 @@
+import hashlib
+import json
+from functools import lru_cache
+
+from aimanager.completions.tokens import estimate_tokens
+from aimanager.tools import prompts
+
+
+def native_schema(schema: dict) -> dict:
+    """OpenAI strict mode requires every property to be required, so optional parameters turn it off."""
+    function = schema["function"]
+    parameters = function["parameters"]
+    if function.get("strict") and set(parameters["required"]) != set(parameters["properties"]):
+        return {**schema, "function": {**function, "strict": False}}
+    return schema
+
+
+class CompiledPrompt:
+    """
+    System message built once per (instructions, tool set) version.
+
+    The same message object is sent on every turn, so the prompt prefix stays byte-identical
+    and providers with prefix caching can serve it from cache. Never mutate `message`.
+    With native tools the schemas go to `tools` instead of the instruction text.
+    """
+
+    def __init__(self, system_prompt: str, tools: tuple = (), native: bool = False):
+        instruction = system_prompt
+        self.tools = None
+        if tools and native:
+            self.tools = [native_schema(tool.llm_schema) for tool in tools]
+        elif tools:
+            instruction += f"\n{prompts.FUNCTION_INSTRUCTION}"
+            schemes = [tool.llm_schema for tool in tools]
+            instruction += f"\n{json.dumps(schemes)}"
+        native_tools = json.dumps(self.tools) if self.tools else ""
+        self.message = {"role": "system", "content": instruction}
+        self.fingerprint = hashlib.sha256((instruction + native_tools).encode()).hexdigest()[:16]
+        self.tokens = estimate_tokens(instruction) + estimate_tokens(native_tools)
+
+
+@lru_cache(maxsize=256)
+def compile_prompt(system_prompt: str, tools: tuple = (), native: bool = False) -> CompiledPrompt:
+    return CompiledPrompt(system_prompt, tools, native)
+
+
+class PromptCacheStats:
+    """Per-agent report of the compiled prompt size and of provider-side prefix cache hits."""
+
+    def __init__(self):
+        self.turns = 0
+        self.cached_turns = 0
+        self.prompt_tokens = 0
+        self.cached_tokens = 0
+
+    def add(self, usage) -> None:
+        if not usage.calls:
+            return
+        self.turns += 1
+        self.prompt_tokens += usage.prompt_tokens
+        self.cached_tokens += usage.cached_tokens
+        if usage.cached_tokens:
+            self.cached_turns += 1
+
+    def report(self, compiled: CompiledPrompt) -> dict:
+        return {
+            "fingerprint": compiled.fingerprint,
+            "compiled_prompt_tokens": compiled.tokens,
+            "turns": self.turns,
+            "cached_turns": self.cached_turns,
+            "prompt_tokens": self.prompt_tokens,
+            "cached_tokens": self.cached_tokens,
+            "cached_ratio": self.cached_tokens / self.prompt_tokens if self.prompt_tokens else 0.0,
+        }
@@ -0,0 +1,361 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator
+
+logger = logging.getLogger("django")
+
+# share of the capacity each class gets while all of them are waiting
+PRIORITY_WEIGHTS = {"interactive": 8, "batch": 2, "background": 1}
+
+
+class AdmissionRejected(Exception):
+    """The worker is too busy for the request, or its tenant used up its quota; try again later."""
+
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(f"Too busy ({reason}), try again in {retry_after:.0f}s")
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+def load_quotas() -> dict:
+    """
+    Quotas of single tenants from ADMISSION_QUOTAS, a JSON object by tenant key:
+    `{"bot:3": {"concurrency": 16, "tpm": 200000}, "user:7": {"concurrency": 1}}`.
+    """
+    return json.loads(os.getenv("ADMISSION_QUOTAS") or "{}")
+
+
+class _Tenant:
+    def __init__(self, tpm: float):
+        self.in_flight = 0
+        self.queued = 0
+        self.tokens = tpm
+        self.updated = time.monotonic()
+
+    def refill(self, tpm: float, now: float) -> None:
+        if tpm:
+            self.tokens = min(tpm, self.tokens + (now - self.updated) * tpm / 60)
+        self.updated = now
+
+
+class _Waiter:
+    def __init__(self, tenant: str, priority: str, finish: float, wake):
+        self.tenant = tenant
+        self.priority = priority
+        self.finish = finish
+        self.wake = wake
+        self.arrived = time.monotonic()
+        self.state = "waiting"
+        self.reason = None
+
+
+class Ticket:
+    """An admitted request; `release()` frees its slot, `charge()` books the tokens it used."""
+
+    def __init__(self, controller: "AdmissionController", tenant: str, priority: str, waited: float):
+        self.controller = controller
+        self.tenant = tenant
+        self.priority = priority
+        self.waited = waited
+        self.admitted = time.monotonic()
+        self.tokens = 0
+        self.released = False
+
+    def charge(self, tokens: int) -> None:
+        self.tokens += tokens or 0
+
+    def release(self) -> None:
+        self.controller._release(self)
+
+
+class AdmissionStats:
+    def __init__(self, window: int = 1000):
+        self.admitted = {}
+        self.rejected = {}
+        self.waits = {}
+        self.window = window
+
+    def add_wait(self, priority: str, seconds: float) -> None:
+        self.admitted[priority] = self.admitted.get(priority, 0) + 1
+        self.waits.setdefault(priority, deque(maxlen=self.window)).append(seconds)
+
+    def add_rejected(self, reason: str) -> None:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+
+    def as_dict(self) -> dict:
+        waits = {}
+        for priority, samples in self.waits.items():
+            ordered = sorted(samples)
+            waits[priority] = {
+                "avg": round(sum(ordered) / len(ordered), 3),
+                "p95": round(ordered[min(int(0.95 * len(ordered)), len(ordered) - 1)], 3),
+                "max": round(ordered[-1], 3),
+            }
+        return {"admitted": dict(self.admitted), "rejected": dict(self.rejected), "wait": waits}
+
+
+class AdmissionController:
+    """
+    Admission of agent generations in a worker, by tenant: a user id or a Telegram bot id.
+
+    At most `capacity` generations run at a time, and at most `tenant_concurrency` of one tenant.
+    A tenant that used more than `tenant_tpm` tokens in the last minute waits until its budget refills.
+    Waiting requests are served by weighted fair queuing over (priority, tenant) flows, so interactive
+    chats get ahead of batch and background work and no tenant starves the others of its class.
+    A request that can't be served within `max_wait` is rejected at once with `AdmissionRejected`
+    rather than left to time out; when the queue is full the newest request of the lowest priority
+    is shed first.
+    """
+
+    Rejected = AdmissionRejected
+    poll_interval = 0.5
+
+    def __init__(
+        self,
+        capacity: int = None,
+        tenant_concurrency: int = None,
+        tenant_tpm: float = None,
+        max_queue: int = None,
+        max_wait: float = None,
+        quotas: dict = None,
+    ):
+        self.capacity = capacity or int(os.getenv("ADMISSION_CAPACITY", 64))
+        self.tenant_concurrency = tenant_concurrency or int(os.getenv("ADMISSION_TENANT_CONCURRENCY", 8))
+        self.tenant_tpm = tenant_tpm if tenant_tpm is not None else float(os.getenv("ADMISSION_TENANT_TPM", 0))
+        self.max_queue = max_queue or int(os.getenv("ADMISSION_MAX_QUEUE", 256))
+        self.max_wait = max_wait or float(os.getenv("ADMISSION_MAX_WAIT", 10))
+        self.quotas = quotas if quotas is not None else load_quotas()
+        self.in_flight = 0
+        self.queue = []
+        self.tenants = {}
+        self.virtual_time = 0.0
+        self.last_finish = {}
+        # moving average of how long a generation holds its slot, for the wait estimate
+        self.service_time = None
+        self.stats = AdmissionStats()
+        self._lock = threading.Lock()
+
+    def _quota(self, tenant: str) -> tuple:
+        quota = self.quotas.get(tenant) or {}
+        return quota.get("concurrency", self.tenant_concurrency), float(quota.get("tpm", self.tenant_tpm))
+
+    def _tenant(self, tenant: str) -> _Tenant:
+        if tenant not in self.tenants:
+            self.tenants[tenant] = _Tenant(self._quota(tenant)[1])
+        return self.tenants[tenant]
+
+    def _eligible(self, waiter: _Waiter, now: float) -> bool:
+        concurrency, tpm = self._quota(waiter.tenant)
+        tenant = self._tenant(waiter.tenant)
+        tenant.refill(tpm, now)
+        return tenant.in_flight < concurrency and (not tpm or tenant.tokens > 0)
+
+    def _admit(self, waiter: _Waiter) -> None:
+        self.in_flight += 1
+        tenant = self._tenant(waiter.tenant)
+        tenant.in_flight += 1
+        self.virtual_time = max(self.virtual_time, waiter.finish)
+        waiter.state = "admitted"
+
+    def _dispatch(self) -> None:
+        """Admit the waiting requests with the earliest virtual finish among the eligible ones."""
+        now = time.monotonic()
+        while self.in_flight < self.capacity and self.queue:
+            eligible = [waiter for waiter in self.queue if self._eligible(waiter, now)]
+            if not eligible:
+                return
+            waiter = min(eligible, key=lambda waiter: waiter.finish)
+            self._dequeue(waiter)
+            self._admit(waiter)
+            waiter.wake()
+
+    def _dequeue(self, waiter: _Waiter) -> None:
+        self.queue.remove(waiter)
+        self._tenant(waiter.tenant).queued -= 1
+
+    def _reject(self, waiter: _Waiter, reason: str) -> None:
+        waiter.state = "rejected"
+        waiter.reason = reason
+        self.stats.add_rejected(reason)
+        self._forget(waiter.tenant)
+
+    def _forget(self, name: str) -> None:
+        tenant, tpm = self.tenants.get(name), self._quota(name)[1]
+        if tenant and not tenant.in_flight and not tenant.queued and (not tpm or tenant.tokens >= tpm):
+            # an idle tenant with a full budget is the same as a new one
+            del self.tenants[name]
+
+    def _retry_after(self) -> float:
+        return max(1.0, min(self.max_wait, self.service_time or 1.0))
+
+    def _enqueue(self, tenant: str, priority: str, wake) -> _Waiter:
+        if priority not in PRIORITY_WEIGHTS:
+            raise ValueError(f"Unknown priority {priority}, expected one of {list(PRIORITY_WEIGHTS)}")
+        now = time.monotonic()
+        flow = (priority, tenant)
+        # the flow's previous request finishes first, an idle flow starts at the current virtual time
+        finish = max(self.virtual_time, self.last_finish.get(flow, 0.0)) + 1 / PRIORITY_WEIGHTS[priority]
+        waiter = _Waiter(tenant, priority, finish, wake)
+
+        concurrency, tpm = self._quota(tenant)
+        state = self._tenant(tenant)
+        state.refill(tpm, now)
+        if tpm and state.tokens <= 0 and -state.tokens * 60 / tpm > self.max_wait:
+            self._reject(waiter, "quota")
+            raise AdmissionRejected("quota", -state.tokens * 60 / tpm)
+
+        if not self.queue and self.in_flight < self.capacity and self._eligible(waiter, now):
+            self._admit(waiter)
+            self.last_finish[flow] = finish
+            return waiter
+
+        if len(self.queue) >= self.max_queue:
+            victim = max(self.queue, key=lambda queued: (-PRIORITY_WEIGHTS[queued.priority], queued.arrived))
+            if PRIORITY_WEIGHTS[victim.priority] >= PRIORITY_WEIGHTS[priority]:
+                self._reject(waiter, "overload")
+                raise AdmissionRejected("overload", self._retry_after())
+            self._dequeue(victim)
+            self._reject(victim, "shed")
+            victim.wake()
+        elif self.service_time is not None:
+            ahead = len([queued for queued in self.queue if queued.finish <= finish])
+            if (ahead + 1) / self.capacity * self.service_time > self.max_wait:
+                self._reject(waiter, "overload")
+                raise AdmissionRejected("overload", self._retry_after())
+
+        self.last_finish[flow] = finish
+        self.queue.append(waiter)
+        state.queued += 1
+        self._dispatch()
+        return waiter
+
+    def _ticket(self, waiter: _Waiter) -> Ticket:
+        waited = time.monotonic() - waiter.arrived
+        self.stats.add_wait(waiter.priority, waited)
+        return Ticket(self, waiter.tenant, waiter.priority, waited)
+
+    def _expire(self, waiter: _Waiter) -> None:
+        """Give up waiting: a waiter still queued after `max_wait` is rejected."""
+        if waiter.state == "waiting":
+            self._dequeue(waiter)
+            self._reject(waiter, "timeout")
+
+    def _rejected(self, waiter: _Waiter) -> AdmissionRejected:
+        return AdmissionRejected(waiter.reason, self._retry_after())
+
+    def _release(self, ticket: Ticket) -> None:
+        with self._lock:
+            # a ticket is released by the end of its stream and by the closed response, whichever is first
+            if ticket.released:
+                return
+            ticket.released = True
+            self.in_flight -= 1
+            tenant = self._tenant(ticket.tenant)
+            tenant.in_flight -= 1
+            tpm = self._quota(ticket.tenant)[1]
+            tenant.refill(tpm, time.monotonic())
+            tenant.tokens -= ticket.tokens
+            held = time.monotonic() - ticket.admitted
+            self.service_time = (
+                held if self.service_time is None else self.service_time + 0.1 * (held - self.service_time)
+            )
+            # flows that are done don't need their finish tags anymore
+            self.last_finish = {flow: tag for flow, tag in self.last_finish.items() if tag > self.virtual_time}
+            self._forget(ticket.tenant)
+            self._dispatch()
+
+    def acquire(self, tenant: str, priority: str = "interactive") -> Ticket:
+        event = threading.Event()
+        with self._lock:
+            waiter = self._enqueue(tenant, priority, event.set)
+        deadline = waiter.arrived + self.max_wait
+        while not event.is_set() and waiter.state == "waiting":
+            # tenants waiting for their token budget are admitted when it refills, not on a release
+            if event.wait(min(self.poll_interval, max(deadline - time.monotonic(), 0))):
+                break
+            with self._lock:
+                self._dispatch()
+                if time.monotonic() >= deadline:
+                    self._expire(waiter)
+        with self._lock:
+            if waiter.state == "rejected":
+                raise self._rejected(waiter)
+            return self._ticket(waiter)
+
+    async def async_acquire(self, tenant: str, priority: str = "interactive") -> Ticket:
+        loop = asyncio.get_running_loop()
+        woken = loop.create_future()
+
+        def wake():
+            loop.call_soon_threadsafe(lambda: woken.done() or woken.set_result(None))
+
+        with self._lock:
+            waiter = self._enqueue(tenant, priority, wake)
+        deadline = waiter.arrived + self.max_wait
+        try:
+            while waiter.state == "waiting":
+                try:
+                    await asyncio.wait_for(asyncio.shield(woken), min(self.poll_interval, deadline - time.monotonic()))
+                except TimeoutError:
+                    with self._lock:
+                        self._dispatch()
+                        if time.monotonic() >= deadline:
+                            self._expire(waiter)
+        except BaseException:
+            with self._lock:
+                if waiter.state == "waiting":
+                    self._dequeue(waiter)
+                    waiter.state = "cancelled"
+                    self._forget(waiter.tenant)
+                admitted = waiter.state == "admitted"
+            if admitted:
+                # admitted while being cancelled, the slot goes to the next one
+                Ticket(self, waiter.tenant, waiter.priority, 0.0).release()
+            raise
+        with self._lock:
+            if waiter.state == "rejected":
+                raise self._rejected(waiter)
+            return self._ticket(waiter)
+
+    @contextmanager
+    def admit(self, tenant: str, priority: str = "interactive") -> Iterator[Ticket]:
+        ticket = self.acquire(tenant, priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    @asynccontextmanager
+    async def async_admit(self, tenant: str, priority: str = "interactive") -> AsyncIterator[Ticket]:
+        ticket = await self.async_acquire(tenant, priority)
+        try:
+            yield ticket
+        finally:
+            ticket.release()
+
+    def report(self) -> dict:
+        with self._lock:
+            queued = {}
+            for waiter in self.queue:
+                queued[waiter.priority] = queued.get(waiter.priority, 0) + 1
+            return {
+                "capacity": self.capacity,
+                "in_flight": self.in_flight,
+                "queue_depth": len(self.queue),
+                "queued": queued,
+                "tenants": {
+                    name: {"in_flight": tenant.in_flight, "queued": tenant.queued}
+                    for name, tenant in self.tenants.items()
+                },
+                "service_time": round(self.service_time, 3) if self.service_time is not None else None,
+                **self.stats.as_dict(),
+            }
+
+
+admission = AdmissionController()
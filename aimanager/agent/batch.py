@@ -0,0 +1,235 @@
+import asyncio
+import copy
+import json
+import logging
+import os
+import time
+from typing import AsyncGenerator, Callable, Iterator
+
+from aimanager.completions._interface import AsyncCompletionProviderInterface
+from aimanager.completions.usage import track_usage
+
+logger = logging.getLogger("django")
+
+
+def read_records(path: str) -> Iterator[dict]:
+    """
+    Records of a JSONL input file: `prompt`, `user`, optional `agent`, `conversation` and `id`.
+    The line number is the id of a record without one.
+    """
+    with open(path, encoding="utf-8") as file:
+        for line_number, line in enumerate(file, start=1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            record.setdefault("id", line_number)
+            yield record
+
+
+def read_checkpoint(path: str) -> set:
+    """
+    Ids of the records already answered in the output file. A line cut off by a crash is dropped
+    from the file; failed records are not in the checkpoint and run again.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as file:
+        data = file.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            file.truncate(end)
+    done = set()
+    for line in data[:end].splitlines():
+        try:
+            result = json.loads(line)
+        except json.JSONDecodeError:
+            continue
+        if "error" not in result:
+            done.add(result["id"])
+    return done
+
+
+class RateLimiter:
+    """In-process token bucket: at most `per_minute` acquisitions a minute, with bursts up to `burst`."""
+
+    def __init__(self, per_minute: float, burst: int = 1):
+        self.rate = per_minute / 60
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RateLimitedCompletionProvider(AsyncCompletionProviderInterface):
+    """Async completions provider that takes a token of the limiter before every upstream call."""
+
+    def __init__(self, provider: AsyncCompletionProviderInterface, limiter: RateLimiter):
+        self.provider = provider
+        self.limiter = limiter
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    def init_client(self, *args, **kwargs):
+        pass
+
+    def supports_tools(self, model: str = None) -> bool:
+        return self.provider.supports_tools(model)
+
+    async def async_generate_response(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> str:
+        await self.limiter.acquire()
+        return await self.provider.async_generate_response(messages, model=model, stream=stream, tools=tools)
+
+    async def async_generate_response_stream(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> AsyncGenerator:
+        await self.limiter.acquire()
+        async for chunk in self.provider.async_generate_response_stream(
+            messages, model=model, stream=stream, tools=tools
+        ):
+            yield chunk
+
+
+class BatchStats:
+    def __init__(self, skipped: int = 0):
+        self.started = time.monotonic()
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency = 0.0
+
+    def add(self, result: dict) -> None:
+        if "error" in result:
+            self.failed += 1
+        else:
+            self.done += 1
+        self.prompt_tokens += result["usage"]["prompt_tokens"]
+        self.completion_tokens += result["usage"]["completion_tokens"]
+        self.latency += result["latency"]
+
+    def as_dict(self) -> dict:
+        finished = self.done + self.failed
+        elapsed = time.monotonic() - self.started
+        return {
+            "done": self.done,
+            "failed": self.failed,
+            "skipped": self.skipped,
+            "elapsed": round(elapsed, 1),
+            "records_per_second": round(finished / elapsed, 2) if elapsed else 0.0,
+            "error_rate": self.failed / finished if finished else 0.0,
+            "avg_latency": round(self.latency / finished, 3) if finished else 0.0,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "tokens_per_second": round((self.prompt_tokens + self.completion_tokens) / elapsed, 1) if elapsed else 0.0,
+        }
+
+
+class BatchRunner:
+    """
+    Answers the records of a JSONL file with async agents and appends a result line per record
+    to the output file as soon as it is answered, so the output is also the checkpoint:
+    a run started again with the same output skips what was answered before.
+
+    `resolve_agent(record)` returns the `BaseAsyncAgent` for a record, e.g. from `async_agent_pool`.
+    At most `concurrency` records run at a time; `rate_limits` caps the completion calls per minute by
+    provider name, counting every round of a tool loop and the summary updates, not records.
+    """
+
+    def __init__(
+        self,
+        resolve_agent: Callable,
+        concurrency: int = None,
+        rate_limits: dict = None,
+        progress: Callable = None,
+        progress_interval: float = None,
+    ):
+        self.resolve_agent = resolve_agent
+        self.concurrency = concurrency or int(os.getenv("BATCH_CONCURRENCY", 8))
+        self.limiters = {
+            provider: RateLimiter(per_minute, burst=self.concurrency)
+            for provider, per_minute in (rate_limits or {}).items()
+        }
+        # rate limited copies of the agents of this runner, by the agent they were copied from
+        self.limited_agents = {}
+        self.progress = progress
+        self.progress_interval = progress_interval or float(os.getenv("BATCH_PROGRESS_INTERVAL", 10))
+        self.stats = None
+
+    async def answer(self, record: dict) -> dict:
+        result = {key: record.get(key) for key in ("id", "agent", "user", "conversation", "prompt")}
+        started = time.monotonic()
+        with track_usage() as usage:
+            try:
+                agent = self._rate_limited(await self.resolve_agent(record))
+                result["response"] = await agent.async_generate_response(
+                    record["prompt"], record["user"], record.get("conversation")
+                )
+            except Exception as e:
+                logger.warning(f"Batch record {record.get('id')} failed: {e}")
+                result["error"] = f"{type(e).__name__}: {e}"
+        result["usage"] = usage.as_dict()
+        result["latency"] = round(time.monotonic() - started, 3)
+        return result
+
+    def _rate_limited(self, agent):
+        # agents may come from the process-wide pool, the limiter goes on a copy owned by this runner
+        limiter = self.limiters.get(agent.completions.name)
+        if limiter is None:
+            return agent
+        if agent not in self.limited_agents:
+            limited = copy.copy(agent)
+            limited.completions = RateLimitedCompletionProvider(agent.completions, limiter)
+            self.limited_agents[agent] = limited
+        return self.limited_agents[agent]
+
+    async def run(self, records, output_path: str) -> dict:
+        done = read_checkpoint(output_path)
+        self.stats = BatchStats()
+        queue = asyncio.Queue(maxsize=self.concurrency * 2)
+
+        async def worker():
+            while (record := await queue.get()) is not None:
+                result = await self.answer(record)
+                output.write(json.dumps(result, ensure_ascii=False) + "\n")
+                output.flush()
+                self.stats.add(result)
+
+        with open(output_path, "a", encoding="utf-8") as output:
+            workers = [asyncio.create_task(worker()) for _ in range(self.concurrency)]
+            reporter = asyncio.create_task(self._report())
+            try:
+                for record in records:
+                    if record["id"] in done:
+                        self.stats.skipped += 1
+                        continue
+                    await queue.put(record)
+                for _ in workers:
+                    await queue.put(None)
+                await asyncio.gather(*workers)
+            finally:
+                reporter.cancel()
+                for task in workers:
+                    task.cancel()
+        if self.progress:
+            self.progress(self.stats.as_dict())
+        return self.stats.as_dict()
+
+    async def _report(self) -> None:
+        while self.progress:
+            await asyncio.sleep(self.progress_interval)
+            self.progress(self.stats.as_dict())
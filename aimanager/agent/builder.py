@@ -1,24 +1,213 @@
-from ._interface import AIAgentInterface, AsyncAIAgentInterface
+import asyncio
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from aimanager.completions.builder import AsyncCompletionsClientBuilder, CompletionsClientBuilder
+from aimanager.completions.cache import AsyncCompletionCache, CompletionCache
+from aimanager.completions.coalescing import RequestCoalescer
+from aimanager.completions.semantic_cache import SemanticCache
+from aimanager.memory.builder import AsyncMemoryProviderBuilder, MemoryProviderBuilder
+from aimanager.tracing import traced, tracer
+
 from ._base import BaseAgent, BaseAsyncAgent
+from ._interface import AIAgentInterface, AsyncAIAgentInterface
 
 
 class LLMAgentBuilder:
-    @staticmethod
-    def build(agent_name: str, *args, **kwargs) -> AIAgentInterface:
+    agents = [BaseAgent]
+
+    @classmethod
+    def resolve(cls, agent_name: str) -> type:
         if agent_name:
-            for agent in [BaseAgent]:
+            for agent in cls.agents:
                 if agent.name == agent_name:
-                    return agent(*args, **kwargs)
-        else:
-            return BaseAgent(*args, **kwargs)
+                    return agent
+            return None
+        return cls.agents[0]
+
+    @classmethod
+    @traced("agent.build")
+    def build(cls, agent_name: str, *args, **kwargs) -> AIAgentInterface:
+        agent = cls.resolve(agent_name)
+        if agent:
+            return agent(*args, **kwargs)
+
+
+class AsyncLLMAgentBuilder(LLMAgentBuilder):
+    agents = [BaseAsyncAgent]
+
+    @classmethod
+    def build(cls, agent_name: str, *args, **kwargs) -> AsyncAIAgentInterface:
+        return super().build(agent_name, *args, **kwargs)
+
+
+class AgentPool:
+    """
+    Per-process registry of ready-to-use agents.
+
+    Agents are keyed by (agent name, provider, model, system prompt fingerprint, tool set) and
+    share one completions client per provider and one memory client per memory provider, so
+    consecutive requests reuse open connections instead of building new clients every time.
+    Pooled agents are shared between requests: register tools through `tools=` instead of
+    calling `register_tool` on an agent returned by the pool.
+    `metadata` is `Agent.metadata`; agents with a cache enabled there get their completions client
+    wrapped by the pool's caches, in the order of `cache_builders`, the last one is checked first.
+    """
 
+    def __init__(
+        self,
+        agent_builder,
+        completions_builder,
+        memory_builder,
+        max_size: int = None,
+        loop_bound=False,
+        cache_builders: tuple = (),
+    ):
+        self.agent_builder = agent_builder
+        self.completions_builder = completions_builder
+        self.memory_builder = memory_builder
+        self.cache_builders = cache_builders
+        self.max_size = max_size or int(os.getenv("AGENT_POOL_SIZE", 64))
+        # async clients hold connections bound to the event loop they were created in
+        self.loop_bound = loop_bound
+        self._loop = None
+        self._lock = threading.Lock()
+        self._agents = OrderedDict()
+        self._completions = {}
+        self._memories = {}
+        self._caches = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.build_time = 0.0
 
-class AsyncLLMAgentBuilder:
     @staticmethod
-    def build(agent_name: str, *args, **kwargs) -> AsyncAIAgentInterface:
-        if agent_name:
-            for agent in [BaseAsyncAgent]:
-                if agent.name == agent_name:
-                    return agent(*args, **kwargs)
-        else:
-            return BaseAsyncAgent(*args, **kwargs)
+    def make_key(
+        agent_name: str,
+        provider: str,
+        model: str,
+        system_prompt: str = None,
+        tools: list = None,
+        metadata: dict = None,
+    ) -> tuple:
+        fingerprint = hashlib.sha256((system_prompt or "").encode()).hexdigest()[:16]
+        tool_set = tuple(sorted(f"{tool.__module__}.{tool.__qualname__}" for tool in tools or []))
+        options = json.dumps(metadata, sort_keys=True, default=str) if metadata else ""
+        return agent_name, provider, model, fingerprint, tool_set, options
+
+    def get(
+        self,
+        agent_name: str = None,
+        provider: str = None,
+        model: str = None,
+        system_prompt: str = None,
+        tools=None,
+        metadata: dict = None,
+    ):
+        agent_class = self.agent_builder.resolve(agent_name)
+        if agent_class is None:
+            return None
+        provider = provider or agent_class.model_provider
+        key = self.make_key(agent_class.name, provider, model, system_prompt, tools, metadata)
+
+        with self._lock:
+            self._check_loop()
+            agent = self._agents.get(key)
+            if agent is not None:
+                self._agents.move_to_end(key)
+                self.hits += 1
+                return agent
+            self.misses += 1
+
+        started = time.perf_counter()
+        with tracer.span("agent.build", agent=agent_class.name, provider=provider, model=model):
+            agent = agent_class(
+                provider=provider,
+                model=model,
+                system_prompt=system_prompt,
+                tools=tools,
+                completions=self._completions_for(provider, metadata),
+                memory=self._shared(self._memories, agent_class.memory_provider, self.memory_builder),
+            )
+        elapsed = time.perf_counter() - started
+
+        with self._lock:
+            self.build_time += elapsed
+            agent = self._agents.setdefault(key, agent)
+            self._agents.move_to_end(key)
+            while len(self._agents) > self.max_size:
+                self._agents.popitem(last=False)
+                self.evictions += 1
+        return agent
+
+    def _shared(self, clients: dict, name: str, builder):
+        with self._lock:
+            client = clients.get(name)
+        if client is None:
+            client = builder.build(name)
+            with self._lock:
+                client = clients.setdefault(name, client)
+        return client
+
+    def _completions_for(self, provider: str, metadata: dict = None):
+        completions = self._shared(self._completions, provider, self.completions_builder)
+        for builder in self.cache_builders:
+            settings = builder.settings_class.from_metadata(metadata)
+            if settings:
+                cache = self._shared(self._caches, builder.__name__, builder)
+                completions = cache.wrap(completions, settings)
+        return completions
+
+    def _check_loop(self):
+        if not self.loop_bound:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
+        if loop is not self._loop:
+            # clients of a previous loop can't be reused, e.g. under WSGI where each async view gets its own loop
+            self._agents.clear()
+            self._completions.clear()
+            self._memories.clear()
+            self._caches.clear()
+            self._loop = loop
+
+    def clear(self):
+        with self._lock:
+            self._agents.clear()
+            self._completions.clear()
+            self._memories.clear()
+            self._caches.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "size": len(self._agents),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "avg_build_time": self.build_time / self.misses if self.misses else 0.0,
+                "completions_clients": len(self._completions),
+                "memory_clients": len(self._memories),
+                "caches": {name: cache.report() for name, cache in self._caches.items()},
+            }
+
+
+agent_pool = AgentPool(
+    LLMAgentBuilder, CompletionsClientBuilder, MemoryProviderBuilder, cache_builders=(SemanticCache, CompletionCache)
+)
+async_agent_pool = AgentPool(
+    AsyncLLMAgentBuilder,
+    AsyncCompletionsClientBuilder,
+    AsyncMemoryProviderBuilder,
+    loop_bound=True,
+    cache_builders=(RequestCoalescer, SemanticCache, AsyncCompletionCache),
+)
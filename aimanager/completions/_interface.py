@@ -2,6 +2,10 @@ from abc import ABC, abstractmethod
 from typing import AsyncGenerator
 
 
+class ToolsNotSupportedError(Exception):
+    """The model rejected native `tools=`; the caller should fall back to the prompt protocol."""
+
+
 class CompletionProviderInterface(ABC):
     def __init__(self, *args, **kwargs):
         super().__init__()
@@ -12,9 +16,12 @@ class CompletionProviderInterface(ABC):
         pass
 
     @abstractmethod
-    def generate_response(self, messages: list = None, model: str = None, stream: bool = False) -> str:
+    def generate_response(self, messages: list = None, model: str = None, stream: bool = False, tools=None) -> str:
         pass
 
+    def supports_tools(self, model: str = None) -> bool:
+        return False
+
 
 class AsyncCompletionProviderInterface(ABC):
     def __init__(self, *args, **kwargs):
@@ -26,11 +33,16 @@ class AsyncCompletionProviderInterface(ABC):
         pass
 
     @abstractmethod
-    async def async_generate_response(self, messages: list = None, model: str = None, stream: bool = False) -> str:
+    async def async_generate_response(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> str:
         pass
 
     @abstractmethod
     async def async_generate_response_stream(
-        self, messages: list = None, model: str = None, stream: bool = False
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
     ) -> AsyncGenerator:
         pass
+
+    def supports_tools(self, model: str = None) -> bool:
+        return False
@@ -1,13 +1,16 @@
-from .lmstudio import LMStudioProvider
+from .lmstudio import AsyncLMStudioProvider, LMStudioProvider
 from .openai import OpenAIProvider, AsyncOpenAIProvider
 from .custom_openai_api_provider import CustomOpenAIApiProvider, AsyncCustomOpenAIApiProvider
-from .openrouter import OpenRouterProvider
+from .openrouter import AsyncOpenRouterProvider, OpenRouterProvider
+from .router import AsyncRouterProvider, RouterProvider
 from ._interface import AsyncCompletionProviderInterface, CompletionProviderInterface
 
 
 class CompletionsClientBuilder:
     @staticmethod
     def build(provider_name: str) -> CompletionProviderInterface:
+        if provider_name == RouterProvider.name:
+            return RouterProvider(build=CompletionsClientBuilder.build)
         for provider in [OpenAIProvider, LMStudioProvider, OpenRouterProvider, CustomOpenAIApiProvider]:
             if provider.name == provider_name:
                 return provider()
@@ -17,7 +20,14 @@ class CompletionsClientBuilder:
 class AsyncCompletionsClientBuilder:
     @staticmethod
     def build(provider_name: str) -> AsyncCompletionProviderInterface:
-        for provider in [AsyncOpenAIProvider, AsyncCustomOpenAIApiProvider]:
+        if provider_name == AsyncRouterProvider.name:
+            return AsyncRouterProvider(build=AsyncCompletionsClientBuilder.build)
+        for provider in [
+            AsyncOpenAIProvider,
+            AsyncLMStudioProvider,
+            AsyncOpenRouterProvider,
+            AsyncCustomOpenAIApiProvider,
+        ]:
             if provider.name == provider_name:
                 return provider()
         return AsyncOpenAIProvider()
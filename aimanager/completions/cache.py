@@ -0,0 +1,368 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from typing import AsyncGenerator, Generator, Union
+
+import redis
+import redis.asyncio as aredis
+
+from aimanager.metrics import metrics
+from aimanager.tools.invoker import parse_llm_response
+
+from ._interface import AsyncCompletionProviderInterface, CompletionProviderInterface
+
+logger = logging.getLogger("django")
+
+WHITESPACE = re.compile(r"\s+")
+
+CACHE_LOOKUPS = metrics.counter(
+    "completion_cache_lookups_total", "Completion cache lookups by result: local_hit, hit or miss", ("cache", "result")
+)
+
+
+def _normalize(message: dict) -> dict:
+    content = message.get("content")
+    if isinstance(content, str):
+        content = WHITESPACE.sub(" ", content).strip().casefold()
+    return {"role": message.get("role"), "content": content}
+
+
+def cache_key(provider: str, model: str, messages: list[dict], tools: list = None) -> str:
+    """Key of a completion request; whitespace and letter case of messages don't change it."""
+    payload = json.dumps(
+        [provider, model, [_normalize(message) for message in messages], tools],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return f"completion-cache:{hashlib.sha256(payload.encode()).hexdigest()}"
+
+
+def is_cacheable(response: str) -> bool:
+    # function calls are answered by tools, only final text answers are reused
+    return bool(response) and parse_llm_response(response)["type"] == "text"
+
+
+class CacheSettings:
+    """
+    Per-agent options from `Agent.metadata["completion_cache"]`:
+    `true` or `{"enabled": true, "ttl": seconds}`. The cache is off when the key is missing.
+    """
+
+    def __init__(self, ttl: int = None):
+        self.ttl = ttl or int(os.getenv("COMPLETION_CACHE_TTL", 3600))
+
+    @classmethod
+    def from_metadata(cls, metadata: dict = None) -> "CacheSettings":
+        options = (metadata or {}).get("completion_cache")
+        if not options:
+            return None
+        if not isinstance(options, dict):
+            options = {}
+        if not options.get("enabled", True):
+            return None
+        return cls(ttl=options.get("ttl"))
+
+
+class LRUCache:
+    """Small thread-safe in-process cache with per-entry expiry."""
+
+    def __init__(self, max_size: int):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            value, expires = item
+            if expires < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key: str, value, ttl: float) -> None:
+        if not self.max_size:
+            return
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+
+class CacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.local_hits = 0
+        self.misses = 0
+        self.stores = 0
+        self.evictions = 0
+        self.errors = 0
+
+    def as_dict(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "local_hits": self.local_hits,
+            "misses": self.misses,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "errors": self.errors,
+            "hit_rate": self.hits / requests if requests else 0.0,
+        }
+
+
+class CompletionCache:
+    """
+    Exact-match completion cache shared by the agents of a pool: a small in-process LRU in front of Redis.
+
+    Redis entries expire after the TTL of the agent that stored them. The number of entries is capped
+    at `max_entries` through a sorted set of keys by store time, the oldest are deleted first.
+    Redis errors are counted and treated as misses, the cache never fails a completion.
+    """
+
+    index_key = "completion-cache:index"
+    settings_class = CacheSettings
+
+    def __init__(self, redis_url: str = None, max_entries: int = None, local_size: int = None):
+        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        self.max_entries = max_entries or int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", 10000))
+        self.local = LRUCache(
+            local_size if local_size is not None else int(os.getenv("COMPLETION_CACHE_LOCAL_SIZE", 256))
+        )
+        self.stats = CacheStats()
+        self.client = self.connect()
+
+    @classmethod
+    def build(cls, name: str = None) -> "CompletionCache":
+        return cls()
+
+    def connect(self):
+        return redis.StrictRedis.from_url(self.redis_url)
+
+    def wrap(self, provider: CompletionProviderInterface, settings: CacheSettings) -> "CachedCompletionProvider":
+        return CachedCompletionProvider(provider, self, settings)
+
+    def lookup(self, provider, messages: list, model: str, tools: list, settings: CacheSettings) -> tuple:
+        """Return the key of a request and its cached answer or None."""
+        key = cache_key(provider.name, model or provider.model, messages, tools)
+        return key, self.get(key, settings.ttl)
+
+    def store(self, key: str, response: str, settings: CacheSettings) -> None:
+        self.set(key, response, settings.ttl)
+
+    def report(self) -> dict:
+        return self.stats.as_dict()
+
+    def _local_hit(self, key: str):
+        value = self.local.get(key)
+        if value is not None:
+            self.stats.hits += 1
+            self.stats.local_hits += 1
+            CACHE_LOOKUPS.labels("exact", "local_hit").inc()
+        return value
+
+    def _remote_result(self, key: str, value: bytes, ttl: int):
+        if value is None:
+            self.stats.misses += 1
+            CACHE_LOOKUPS.labels("exact", "miss").inc()
+            return None
+        self.stats.hits += 1
+        CACHE_LOOKUPS.labels("exact", "hit").inc()
+        value = value.decode()
+        self.local.set(key, value, ttl)
+        return value
+
+    def _error(self, e: Exception) -> None:
+        self.stats.errors += 1
+        logger.warning(f"Completion cache error: {e}")
+
+    def _overflow(self, size: int) -> int:
+        return size - self.max_entries if size > self.max_entries else 0
+
+    def get(self, key: str, ttl: int) -> str:
+        value = self._local_hit(key)
+        if value is not None:
+            return value
+        try:
+            value = self.client.get(key)
+        except redis.RedisError as e:
+            self._error(e)
+            value = None
+        return self._remote_result(key, value, ttl)
+
+    def set(self, key: str, value: str, ttl: int) -> None:
+        self.local.set(key, value, ttl)
+        self.stats.stores += 1
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.set(key, value, ex=ttl)
+            pipe.zadd(self.index_key, {key: time.time()})
+            pipe.zcard(self.index_key)
+            *_, size = pipe.execute()
+            overflow = self._overflow(size)
+            if overflow:
+                evicted = [member for member, _ in self.client.zpopmin(self.index_key, overflow)]
+                self.client.delete(*evicted)
+                self.stats.evictions += len(evicted)
+        except redis.RedisError as e:
+            self._error(e)
+
+
+class AsyncCompletionCache(CompletionCache):
+    """`CompletionCache` over redis.asyncio; the client is bound to the event loop it was created in."""
+
+    def connect(self):
+        return aredis.Redis.from_pool(aredis.ConnectionPool.from_url(self.redis_url))
+
+    def wrap(
+        self, provider: AsyncCompletionProviderInterface, settings: CacheSettings
+    ) -> "AsyncCachedCompletionProvider":
+        return AsyncCachedCompletionProvider(provider, self, settings)
+
+    async def async_lookup(self, provider, messages: list, model: str, tools: list, settings: CacheSettings) -> tuple:
+        key = cache_key(provider.name, model or provider.model, messages, tools)
+        return key, await self.async_get(key, settings.ttl)
+
+    async def async_store(self, key: str, response: str, settings: CacheSettings) -> None:
+        await self.async_set(key, response, settings.ttl)
+
+    async def async_get(self, key: str, ttl: int) -> str:
+        value = self._local_hit(key)
+        if value is not None:
+            return value
+        try:
+            value = await self.client.get(key)
+        except redis.RedisError as e:
+            self._error(e)
+            value = None
+        return self._remote_result(key, value, ttl)
+
+    async def async_set(self, key: str, value: str, ttl: int) -> None:
+        self.local.set(key, value, ttl)
+        self.stats.stores += 1
+        try:
+            pipe = self.client.pipeline(transaction=False)
+            pipe.set(key, value, ex=ttl)
+            pipe.zadd(self.index_key, {key: time.time()})
+            pipe.zcard(self.index_key)
+            *_, size = await pipe.execute()
+            overflow = self._overflow(size)
+            if overflow:
+                evicted = [member for member, _ in await self.client.zpopmin(self.index_key, overflow)]
+                await self.client.delete(*evicted)
+                self.stats.evictions += len(evicted)
+        except redis.RedisError as e:
+            self._error(e)
+
+
+class CachedCompletionProvider(CompletionProviderInterface):
+    """
+    Completions provider that answers repeated requests from a cache, streamed or not.
+    The cache implements `lookup(provider, messages, model, tools, settings) -> (token, answer)`
+    and `store(token, answer, settings)`.
+    """
+
+    def __init__(self, provider: CompletionProviderInterface, cache, settings):
+        self.provider = provider
+        self.cache = cache
+        self.settings = settings
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    def init_client(self, *args, **kwargs):
+        pass
+
+    def supports_tools(self, model: str = None) -> bool:
+        return self.provider.supports_tools(model)
+
+    def generate_response(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> Union[str, Generator]:
+        token, cached = self.cache.lookup(self.provider, messages, model, tools, self.settings)
+        if cached is not None:
+            return (chunk for chunk in [cached]) if stream else cached
+        response = self.provider.generate_response(messages, model=model, stream=stream, tools=tools)
+        if not stream:
+            self._store(token, response)
+            return response
+        return self._iter_stream(token, response)
+
+    def _iter_stream(self, token, stream) -> Generator:
+        chunks = []
+        try:
+            for chunk in stream:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            stream.close()
+        # only an answer streamed to the end is stored
+        self._store(token, "".join(chunks))
+
+    def _store(self, token, response: str) -> None:
+        if token is not None and is_cacheable(response):
+            self.cache.store(token, response, self.settings)
+
+
+class AsyncCachedCompletionProvider(AsyncCompletionProviderInterface):
+    """Async `CachedCompletionProvider`: the cache implements `async_lookup` and `async_store`."""
+
+    def __init__(self, provider: AsyncCompletionProviderInterface, cache, settings):
+        self.provider = provider
+        self.cache = cache
+        self.settings = settings
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    def init_client(self, *args, **kwargs):
+        pass
+
+    def supports_tools(self, model: str = None) -> bool:
+        return self.provider.supports_tools(model)
+
+    async def async_generate_response(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> str:
+        token, cached = await self.cache.async_lookup(self.provider, messages, model, tools, self.settings)
+        if cached is not None:
+            return cached
+        response = await self.provider.async_generate_response(messages, model=model, stream=stream, tools=tools)
+        await self._store(token, response)
+        return response
+
+    async def async_generate_response_stream(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> AsyncGenerator:
+        token, cached = await self.cache.async_lookup(self.provider, messages, model, tools, self.settings)
+        if cached is not None:
+            yield cached
+            return
+        response = self.provider.async_generate_response_stream(messages, model=model, stream=stream, tools=tools)
+        chunks = []
+        try:
+            async for chunk in response:
+                chunks.append(chunk)
+                yield chunk
+        finally:
+            await response.aclose()
+        # only an answer streamed to the end is stored
+        await self._store(token, "".join(chunks))
+
+    async def _store(self, token, response: str) -> None:
+        if token is not None and is_cacheable(response):
+            await self.cache.async_store(token, response, self.settings)
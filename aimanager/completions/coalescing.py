@@ -0,0 +1,364 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import uuid
+from contextlib import aclosing, contextmanager
+from contextvars import ContextVar
+from typing import AsyncGenerator
+
+import redis
+import redis.asyncio as aredis
+
+from ._interface import AsyncCompletionProviderInterface
+
+logger = logging.getLogger("django")
+
+# Deletes the lease only while it still holds the caller's token: after an expiry another worker
+# may hold it, and a GET then DEL would delete that worker's lease.
+RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_coalescing_enabled = ContextVar("completions_coalescing", default=True)
+
+
+@contextmanager
+def no_coalescing():
+    """Completion calls inside the block always go upstream, even when an identical one is in flight."""
+    token = _coalescing_enabled.set(False)
+    try:
+        yield
+    finally:
+        _coalescing_enabled.reset(token)
+
+
+def request_key(provider: str, model: str, messages: list[dict], tools: list = None) -> str:
+    payload = json.dumps([provider, model, messages, tools], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class CoalescingSettings:
+    """Coalescing is on unless COALESCE_REQUESTS=false or `Agent.metadata["coalesce"]` is false."""
+
+    @classmethod
+    def from_metadata(cls, metadata: dict = None) -> "CoalescingSettings":
+        if os.getenv("COALESCE_REQUESTS", "true").lower() != "true":
+            return None
+        if (metadata or {}).get("coalesce", True) is False:
+            return None
+        return cls()
+
+
+class Flight:
+    """One upstream call and the chunks it produced so far, read by every identical request."""
+
+    def __init__(self):
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.consumers = 0
+        self.task = None
+        self._changed = asyncio.Condition()
+
+    async def push(self, chunk: str) -> None:
+        async with self._changed:
+            self.chunks.append(chunk)
+            self._changed.notify_all()
+
+    async def finish(self, error: BaseException = None) -> None:
+        async with self._changed:
+            self.done = True
+            self.error = error
+            self._changed.notify_all()
+
+    async def follow(self) -> AsyncGenerator:
+        index = 0
+        while True:
+            while index < len(self.chunks):
+                yield self.chunks[index]
+                index += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            async with self._changed:
+                await self._changed.wait_for(lambda: index < len(self.chunks) or self.done)
+
+
+class CoalescingStats:
+    def __init__(self):
+        self.flights = 0
+        self.deduplicated = 0
+        self.remote_followers = 0
+        self.published = 0
+        self.fallbacks = 0
+        self.errors = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "flights": self.flights,
+            "deduplicated": self.deduplicated,
+            "remote_followers": self.remote_followers,
+            "published": self.published,
+            "fallbacks": self.fallbacks,
+            "errors": self.errors,
+        }
+
+
+class RequestCoalescer:
+    """
+    Single-flight for async completion calls: identical requests in flight share one upstream call.
+
+    Within a worker, the first request starts a flight task that reads the upstream stream; every
+    identical request, the first one included, replays its chunks. The task is cancelled when all
+    of them are gone. Across workers (COALESCE_REDIS=true), the flight first takes a Redis lease on
+    the request key. A worker that doesn't get it marks the key as watched and reads the chunks the
+    lease holder publishes to a Redis stream. The holder looks for a watcher at its first chunk and,
+    if there was none, once more when the answer is complete, and publishes only to a watched key.
+    If nothing arrives within `wait_timeout`, the follower calls upstream itself. Redis commands
+    time out after `redis_timeout` seconds, a slow Redis doesn't hold back the answer.
+    `deduplicated` + `remote_followers` is the number of upstream calls avoided.
+    """
+
+    watch_block = 1.0
+
+    def __init__(
+        self, redis_url: str = None, lease_ttl: float = None, wait_timeout: float = None, redis_timeout: float = None
+    ):
+        self.lease_ttl = lease_ttl or float(os.getenv("COALESCE_LEASE_TTL", 60))
+        self.wait_timeout = wait_timeout or float(os.getenv("COALESCE_WAIT_TIMEOUT", 30))
+        self.redis_timeout = redis_timeout or float(os.getenv("COALESCE_REDIS_TIMEOUT", 0.5))
+        self.flights = {}
+        self.stats = CoalescingStats()
+        self.client = None
+        if os.getenv("COALESCE_REDIS", "false").lower() == "true":
+            redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379/0")
+            pool = aredis.ConnectionPool.from_url(
+                redis_url,
+                socket_connect_timeout=self.redis_timeout,
+                # a follower's XREAD blocks for `watch_block` seconds
+                socket_timeout=self.redis_timeout + self.watch_block,
+            )
+            self.client = aredis.Redis.from_pool(pool)
+
+    settings_class = CoalescingSettings
+
+    @classmethod
+    def build(cls, name: str = None) -> "RequestCoalescer":
+        return cls()
+
+    def wrap(self, provider: AsyncCompletionProviderInterface, settings: CoalescingSettings):
+        return CoalescedCompletionProvider(provider, self)
+
+    def report(self) -> dict:
+        return {"in_flight": len(self.flights), **self.stats.as_dict()}
+
+    async def stream(self, key: str, upstream) -> AsyncGenerator:
+        """Chunks of the flight for `key`; `upstream()` returns the async generator of a new call."""
+        flight = self.flights.get(key)
+        if flight is None:
+            flight = self.flights[key] = Flight()
+            flight.task = asyncio.get_running_loop().create_task(self._fly(key, flight, upstream))
+            self.stats.flights += 1
+        else:
+            self.stats.deduplicated += 1
+        flight.consumers += 1
+        try:
+            async for chunk in flight.follow():
+                yield chunk
+        finally:
+            flight.consumers -= 1
+            if not flight.consumers and not flight.done:
+                # nobody reads the answer anymore, release the upstream connection
+                if self.flights.get(key) is flight:
+                    del self.flights[key]
+                flight.task.cancel()
+
+    async def _fly(self, key: str, flight: Flight, upstream) -> None:
+        try:
+            lease = await self._acquire(key)
+            if lease or not await self._follow_remote(key, flight):
+                await self._lead(key, flight, upstream, lease)
+        except Exception as e:
+            await flight.finish(e)
+        else:
+            await flight.finish()
+        finally:
+            if self.flights.get(key) is flight:
+                del self.flights[key]
+
+    async def _lead(self, key: str, flight: Flight, upstream, lease: str = None) -> None:
+        publisher = _Publisher(self, f"{key}:{lease}") if lease else None
+        try:
+            async with aclosing(upstream()) as response:
+                async for chunk in response:
+                    await flight.push(chunk)
+                    if publisher:
+                        await publisher.publish(flight.chunks)
+            if publisher:
+                await publisher.publish(flight.chunks, done=True)
+        except Exception:
+            if publisher:
+                await publisher.fail()
+            raise
+        finally:
+            if lease:
+                await self._release(key, lease)
+
+    async def _acquire(self, key: str) -> str:
+        if self.client is None:
+            return None
+        token = uuid.uuid4().hex
+        try:
+            if await self.client.set(f"coalesce:lease:{key}", token, nx=True, px=int(self.lease_ttl * 1000)):
+                return token
+        except redis.RedisError as e:
+            self._error(e)
+        return None
+
+    async def _release(self, key: str, token: str) -> None:
+        try:
+            await self.client.eval(RELEASE_SCRIPT, 1, f"coalesce:lease:{key}", token)
+        except redis.RedisError as e:
+            self._error(e)
+
+    async def _follow_remote(self, key: str, flight: Flight) -> bool:
+        """Replay the flight of another worker; False when this worker has to call upstream."""
+        if self.client is None:
+            return False
+        lease = f"coalesce:lease:{key}"
+        try:
+            token = await self.client.get(lease)
+            if token is None:
+                return False
+            # chunks of every flight go to their own stream, a finished one is never replayed
+            flight_key = f"{key}:{token.decode()}"
+            await self.client.set(f"coalesce:watch:{flight_key}", 1, ex=int(self.lease_ttl))
+            started = time.monotonic()
+            last_id = "0"
+            while time.monotonic() - started < self.wait_timeout:
+                entries = await self.client.xread(
+                    {f"coalesce:chunks:{flight_key}": last_id}, block=int(self.watch_block * 1000)
+                )
+                if not entries:
+                    if await self.client.get(lease) != token:
+                        # the lease holder finished or died without publishing
+                        break
+                    continue
+                started = time.monotonic()
+                for last_id, fields in entries[0][1]:
+                    if b"chunk" in fields:
+                        await flight.push(fields[b"chunk"].decode())
+                        continue
+                    if b"done" in fields:
+                        self.stats.remote_followers += 1
+                        return True
+                    raise ConnectionError("Coalesced completion failed in another worker")
+        except redis.RedisError as e:
+            self._error(e)
+        if flight.chunks:
+            raise ConnectionError("Coalesced completion was interrupted in another worker")
+        self.stats.fallbacks += 1
+        return False
+
+    def _error(self, e: Exception) -> None:
+        self.stats.errors += 1
+        logger.warning(f"Request coalescing error: {e}")
+
+
+class _Publisher:
+    """
+    Publishes the chunks of a leading flight to Redis once another worker watches the key. The key
+    is read at the first chunk and, when nobody watched it then, at the end: a follower that came
+    in between gets the whole answer at once, and an unwatched flight costs two reads.
+    """
+
+    def __init__(self, coalescer: RequestCoalescer, key: str):
+        self.coalescer = coalescer
+        self.client = coalescer.client
+        self.key = key
+        self.watched = False
+        self.checked = False
+        self.published = 0
+
+    async def publish(self, chunks: list[str], done: bool = False) -> None:
+        try:
+            if not self.watched and (done or not self.checked):
+                self.checked = True
+                self.watched = bool(await self.client.exists(f"coalesce:watch:{self.key}"))
+                self.coalescer.stats.published += self.watched
+            if not self.watched:
+                return
+            stream = f"coalesce:chunks:{self.key}"
+            pipe = self.client.pipeline(transaction=False)
+            for chunk in chunks[self.published :]:
+                pipe.xadd(stream, {"chunk": chunk})
+            if done:
+                pipe.xadd(stream, {"done": 1})
+                pipe.delete(f"coalesce:watch:{self.key}")
+            pipe.expire(stream, int(self.coalescer.lease_ttl))
+            await pipe.execute()
+            self.published = len(chunks)
+        except redis.RedisError as e:
+            self.coalescer._error(e)
+
+    async def fail(self) -> None:
+        if not self.watched:
+            return
+        try:
+            await self.client.xadd(f"coalesce:chunks:{self.key}", {"error": 1})
+        except redis.RedisError as e:
+            self.coalescer._error(e)
+
+
+class CoalescedCompletionProvider(AsyncCompletionProviderInterface):
+    """Async completions provider that runs identical concurrent requests through one upstream call."""
+
+    def __init__(self, provider: AsyncCompletionProviderInterface, coalescer: RequestCoalescer):
+        self.provider = provider
+        self.coalescer = coalescer
+
+    def __getattr__(self, name):
+        return getattr(self.provider, name)
+
+    def init_client(self, *args, **kwargs):
+        pass
+
+    def supports_tools(self, model: str = None) -> bool:
+        return self.provider.supports_tools(model)
+
+    def key(self, messages: list, model: str, tools: list) -> str:
+        return request_key(self.provider.name, model or self.provider.model, messages, tools)
+
+    async def async_generate_response(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> str:
+        if not _coalescing_enabled.get():
+            return await self.provider.async_generate_response(messages, model=model, stream=stream, tools=tools)
+
+        async def upstream():
+            yield await self.provider.async_generate_response(messages, model=model, stream=stream, tools=tools)
+
+        chunks = self.coalescer.stream(self.key(messages, model, tools), upstream)
+        async with aclosing(chunks):
+            return "".join([chunk async for chunk in chunks])
+
+    async def async_generate_response_stream(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> AsyncGenerator:
+        def upstream():
+            return self.provider.async_generate_response_stream(messages, model=model, stream=stream, tools=tools)
+
+        if not _coalescing_enabled.get():
+            chunks = upstream()
+        else:
+            chunks = self.coalescer.stream(self.key(messages, model, tools), upstream)
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                yield chunk
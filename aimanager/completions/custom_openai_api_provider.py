@@ -1,12 +1,169 @@
+import json
+import logging
 import os
-from typing import AsyncGenerator, Generator, Union
-import backoff
-from openai import OpenAI, AsyncOpenAI
+import time
+from contextlib import aclosing
+from typing import AsyncGenerator, Callable, Generator, Union
 
-from ._interface import CompletionProviderInterface, AsyncCompletionProviderInterface
+import openai
+from openai import AsyncOpenAI, OpenAI
 
+from aimanager.metrics import TOKEN_RATE_BUCKETS, metrics
+from aimanager.tracing import tracer
 
-class CustomOpenAIApiProvider(CompletionProviderInterface):
+from ._interface import AsyncCompletionProviderInterface, CompletionProviderInterface, ToolsNotSupportedError
+from .hedging import Hedger
+from .ratelimit import rate_limiter
+from .resilience import RetryPolicy, circuit_breaker
+from .tokens import estimate_tokens
+from .transport import shared_transport
+from .usage import record_usage
+
+logger = logging.getLogger("django")
+
+REQUEST_SECONDS = metrics.histogram(
+    "llm_request_seconds", "Duration of successful completion requests", ("provider", "model", "stream")
+)
+FIRST_TOKEN_SECONDS = metrics.histogram(
+    "llm_time_to_first_token_seconds",
+    "Time from a streamed completion request to its first chunk",
+    ("provider", "model"),
+)
+TOKENS_PER_SECOND = metrics.histogram(
+    "llm_tokens_per_second",
+    "Completion tokens per second, counted from the first chunk of a stream",
+    ("provider", "model"),
+    buckets=TOKEN_RATE_BUCKETS,
+)
+
+
+class CompletionTimer:
+    """
+    Duration, time to first token and generation speed of one completion request, and its span.
+    Metrics are recorded by `finish()` on success, the span is ended on leaving the block.
+    """
+
+    def __init__(self, provider: str, model: str, stream: bool):
+        self.labels = (provider, model)
+        self.stream = stream
+        self.started = time.perf_counter()
+        self.first_chunk = None
+        self.completion_tokens = None
+        self.text = []
+        # not made current: a stream yields to its consumer while the request is open
+        self.span = tracer.start_span("llm.request", provider=provider, model=model, stream=stream)
+
+    def __enter__(self) -> "CompletionTimer":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc is not None:
+            self.span.record_exception(exc)
+        self.span.end()
+
+    def chunk(self, text: str) -> None:
+        if self.first_chunk is None:
+            self.first_chunk = time.perf_counter()
+            FIRST_TOKEN_SECONDS.labels(*self.labels).observe(self.first_chunk - self.started)
+        self.text.append(text)
+
+    def used(self, usage) -> None:
+        tokens = getattr(usage, "completion_tokens", None)
+        if isinstance(tokens, int):
+            self.completion_tokens = tokens
+
+    def finish(self) -> None:
+        finished = time.perf_counter()
+        REQUEST_SECONDS.labels(*self.labels, str(self.stream).lower()).observe(finished - self.started)
+        tokens = self.completion_tokens
+        if tokens is None:
+            # a stream without a usage chunk
+            tokens = estimate_tokens("".join(self.text))
+        generating = finished - (self.first_chunk or self.started)
+        if tokens and generating > 0:
+            TOKENS_PER_SECOND.labels(*self.labels).observe(tokens / generating)
+        self.span.set_attribute("completion_tokens", tokens)
+        if self.first_chunk is not None:
+            self.span.set_attribute("first_token_seconds", round(self.first_chunk - self.started, 4))
+
+
+def tool_calls_to_text(tool_calls: list[dict]) -> str:
+    """Render native tool calls in the JSON protocol understood by `invoker.parse_llm_response`."""
+    calls = []
+    for call in tool_calls:
+        try:
+            parameters = json.loads(call["arguments"] or "{}")
+        except json.JSONDecodeError:
+            parameters = {}
+        calls.append({"function": call["name"], "parameters": parameters})
+    return json.dumps(calls)
+
+
+def message_to_text(message) -> str:
+    if getattr(message, "tool_calls", None):
+        return tool_calls_to_text(
+            [{"name": call.function.name, "arguments": call.function.arguments} for call in message.tool_calls]
+        )
+    return message.content
+
+
+def collect_tool_call_deltas(tool_calls: dict, delta) -> None:
+    """Merge streamed tool call fragments into `tool_calls`, keyed by call index."""
+    for call in getattr(delta, "tool_calls", None) or []:
+        entry = tool_calls.setdefault(call.index, {"name": "", "arguments": ""})
+        if call.function.name:
+            entry["name"] += call.function.name
+        if call.function.arguments:
+            entry["arguments"] += call.function.arguments
+
+
+class NativeToolsMixin:
+    """
+    Native function calling: schemas are passed as `tools=` and `tool_calls` are read from the response.
+    A model that rejects `tools=` is remembered, and `ToolsNotSupportedError` tells the agent to
+    fall back to the prompt protocol.
+    """
+
+    native_tools = os.getenv("CUSTOM_OPENAI_NATIVE_TOOLS", "false").lower() == "true"
+    # streams end with a usage chunk; servers that reject `stream_options` can turn it off
+    stream_usage = os.getenv("CUSTOM_OPENAI_STREAM_USAGE", "true").lower() == "true"
+
+    def supports_tools(self, model: str = None) -> bool:
+        return self.native_tools and (model or self.model) not in self._unsupported_tool_models
+
+    @property
+    def _unsupported_tool_models(self) -> set:
+        return self.__dict__.setdefault("unsupported_tool_models", set())
+
+    def _request_kwargs(self, messages: list, model: str, stream: bool, tools: list) -> dict:
+        kwargs = {"model": model or self.model, "messages": messages, "stream": stream}
+        if tools:
+            kwargs["tools"] = tools
+        if stream and self.stream_usage:
+            kwargs["stream_options"] = {"include_usage": True}
+        return kwargs
+
+    def _check_tools_error(self, e: Exception, model: str, tools: list):
+        is_client_error = isinstance(e, (openai.BadRequestError, openai.NotFoundError, openai.UnprocessableEntityError))
+        if tools and is_client_error and "tool" in str(e).lower():
+            model = model or self.model
+            logger.info(f"Model {model} of provider {self.name} does not support native tools: {e}")
+            self._unsupported_tool_models.add(model)
+            raise ToolsNotSupportedError(str(e)) from e
+
+
+class RetryPolicyMixin:
+    """Retries and the circuit breaker of the provider, see `RetryPolicy`; `retry_policy.report()` has the stats."""
+
+    @property
+    def retry_policy(self) -> RetryPolicy:
+        # subclasses replace init_client, the policy is created on first use
+        if "_retry_policy" not in self.__dict__:
+            self._retry_policy = RetryPolicy(circuit_breaker(self.name))
+        return self._retry_policy
+
+
+class CustomOpenAIApiProvider(RetryPolicyMixin, NativeToolsMixin, CompletionProviderInterface):
     name = "custom"
     model = os.getenv("CUSTOM_OPENAI_MODEL") or "gpt-4o-mini"
     host = os.getenv("CUSTOM_OPENAI_HOST") or "localhost"
@@ -16,28 +173,78 @@ class CustomOpenAIApiProvider(CompletionProviderInterface):
     def init_client(self, *args, **kwargs):
         host = kwargs.get("host") or self.host
         port = kwargs.get("port") or self.port
-        api_key = kwargs.get("api_key") or self.api_key
+        # the rate limiter shares the limits of an API key between its providers
+        self.api_key = api_key = kwargs.get("api_key") or self.api_key
         if port:
             base_url = f"{host}:{port}/v1"
         else:
             base_url = f"{host}/v1"
-        self.client = OpenAI(base_url=base_url, api_key=api_key)
+        # retries are done by `retry_policy`
+        self.client = OpenAI(base_url=base_url, api_key=api_key, max_retries=0)
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=3)
     def generate_response(
-        self, messages: list = None, model: str = None, stream: bool = False
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
     ) -> Union[str, Generator]:
-        response = self.client.chat.completions.create(model=model or self.model, messages=messages, stream=stream)
-        if not stream:
-            return response.choices[0].message.content
-        else:
+        if stream:
+            return self.retry_policy.stream(lambda: self._request_stream(messages, model, tools))
+        return self.retry_policy.call(lambda: self._request(messages, model, tools))
+
+    def _create(self, messages: list, model: str, stream: bool, tools: list):
+        try:
+            return self.client.chat.completions.create(**self._request_kwargs(messages, model, stream, tools))
+        except Exception as e:
+            self._check_tools_error(e, model, tools)
+            raise
+
+    def _request(self, messages: list, model: str, tools: list) -> str:
+        model = model or self.model
+        with rate_limiter().limit(self.name, self.api_key, model, messages) as slot:
+            with CompletionTimer(self.name, model, False) as timer:
+                response = self._create(messages, model, False, tools)
+                slot.used(response.usage)
+                timer.used(response.usage)
+                timer.finish()
+        record_usage(response.usage, self.name, model)
+        return message_to_text(response.choices[0].message)
+
+    def _request_stream(self, messages: list, model: str, tools: list) -> Generator:
+        model = model or self.model
+        with rate_limiter().limit(self.name, self.api_key, model, messages, stream=True) as slot:
+            with CompletionTimer(self.name, model, True) as timer:
+
+                def used(usage):
+                    slot.used(usage)
+                    timer.used(usage)
+                    record_usage(usage, self.name, model)
+
+                for chunk in self._iter_stream(self._create(messages, model, True, tools), used):
+                    slot.chunk(chunk)
+                    timer.chunk(chunk)
+                    yield chunk
+                timer.finish()
+
+    @staticmethod
+    def _iter_stream(response, on_usage: Callable = None) -> Generator:
+        tool_calls = {}
+        try:
             for chunk in response:
-                content = chunk.choices[0].delta.content
-                if content is not None:
-                    yield content
+                if on_usage is not None and getattr(chunk, "usage", None) is not None:
+                    on_usage(chunk.usage)
+                if not chunk.choices:
+                    # the usage chunk at the end of the stream has no choices
+                    continue
+                delta = chunk.choices[0].delta
+                collect_tool_call_deltas(tool_calls, delta)
+                if delta.content is not None:
+                    yield delta.content
+            if tool_calls:
+                yield tool_calls_to_text([tool_calls[index] for index in sorted(tool_calls)])
+        finally:
+            # closing the generator early must release the upstream HTTP stream
+            response.close()
 
 
-class AsyncCustomOpenAIApiProvider(AsyncCompletionProviderInterface):
+class AsyncCustomOpenAIApiProvider(RetryPolicyMixin, NativeToolsMixin, AsyncCompletionProviderInterface):
     name = "custom"
     model = os.getenv("CUSTOM_OPENAI_MODEL") or "gpt-4o-mini"
     host = os.getenv("CUSTOM_OPENAI_HOST") or "localhost"
@@ -47,26 +254,97 @@ class AsyncCustomOpenAIApiProvider(AsyncCompletionProviderInterface):
     def init_client(self, *args, **kwargs):
         host = kwargs.get("host") or self.host
         port = kwargs.get("port") or self.port
-        api_key = kwargs.get("api_key") or self.api_key
+        # the rate limiter shares the limits of an API key between its providers
+        self.api_key = api_key = kwargs.get("api_key") or self.api_key
         if port:
             base_url = f"{host}:{port}/v1"
         else:
             base_url = f"{host}/v1"
-        self.client = lambda: AsyncOpenAI(base_url=base_url, api_key=api_key)
+        self.client_options = {"base_url": base_url, "api_key": api_key}
+
+    @property
+    def client(self) -> AsyncOpenAI:
+        """Client of the running event loop, over the pooled connections of `shared_transport`."""
+        http_client = shared_transport.client()
+        if self.__dict__.get("_http_client") is not http_client:
+            # retries are done by `retry_policy`
+            self._client = AsyncOpenAI(**self.client_options, http_client=http_client, max_retries=0)
+            self._http_client = http_client
+        return self._client
+
+    @property
+    def hedger(self) -> Hedger:
+        # subclasses replace init_client, the hedger is created on first use
+        if "_hedger" not in self.__dict__:
+            self._hedger = Hedger()
+        return self._hedger
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=3)
-    async def async_generate_response(self, messages: list = None, model: str = None, stream: bool = False) -> str:
-        async with self.client() as c:
-            response = await c.chat.completions.create(model=model or self.model, messages=messages, stream=stream)
-            return response.choices[0].message.content
+    async def async_generate_response(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> str:
+        async def request(model: str) -> AsyncGenerator:
+            yield await self.retry_policy.async_call(lambda: self._request(messages, model, stream, tools))
+
+        model = model or self.model
+        responses = self.hedger.stream(model, messages, request, key=f"{model} (response)")
+        async with aclosing(responses):
+            return await anext(responses)
+
+    async def _create(self, messages: list, model: str, stream: bool, tools: list):
+        try:
+            return await self.client.chat.completions.create(**self._request_kwargs(messages, model, stream, tools))
+        except Exception as e:
+            self._check_tools_error(e, model, tools)
+            raise
+
+    async def _request(self, messages: list, model: str, stream: bool, tools: list) -> str:
+        model = model or self.model
+        async with rate_limiter().async_limit(self.name, self.api_key, model, messages) as slot:
+            with CompletionTimer(self.name, model, False) as timer:
+                response = await self._create(messages, model, stream, tools)
+                slot.used(response.usage)
+                timer.used(response.usage)
+                timer.finish()
+        record_usage(response.usage, self.name, model)
+        return message_to_text(response.choices[0].message)
 
-    @backoff.on_exception(backoff.expo, Exception, max_tries=3)
     async def async_generate_response_stream(
-        self, messages: list = None, model: str = None, stream: bool = False
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
     ) -> AsyncGenerator:
-        async with self.client() as c:
-            response = await c.chat.completions.create(model=model or self.model, messages=messages, stream=stream)
-            async for chunk in response:
-                content = chunk.choices[0].delta.content
-                if content is not None:
-                    yield content
+        def request(model: str) -> AsyncGenerator:
+            return self.retry_policy.async_stream(lambda: self._request_stream(messages, model, stream, tools))
+
+        chunks = self.hedger.stream(model or self.model, messages, request)
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                yield chunk
+
+    async def _request_stream(self, messages: list, model: str, stream: bool, tools: list) -> AsyncGenerator:
+        model = model or self.model
+        async with rate_limiter().async_limit(self.name, self.api_key, model, messages, stream=True) as slot:
+            with CompletionTimer(self.name, model, True) as timer:
+                response = await self._create(messages, model, stream, tools)
+                tool_calls = {}
+                try:
+                    async for chunk in response:
+                        if getattr(chunk, "usage", None) is not None:
+                            slot.used(chunk.usage)
+                            timer.used(chunk.usage)
+                            record_usage(chunk.usage, self.name, model)
+                        if not chunk.choices:
+                            # the usage chunk at the end of the stream has no choices
+                            continue
+                        delta = chunk.choices[0].delta
+                        collect_tool_call_deltas(tool_calls, delta)
+                        if delta.content is not None:
+                            slot.chunk(delta.content)
+                            timer.chunk(delta.content)
+                            yield delta.content
+                    if tool_calls:
+                        text = tool_calls_to_text([tool_calls[index] for index in sorted(tool_calls)])
+                        timer.chunk(text)
+                        yield text
+                    timer.finish()
+                finally:
+                    # closing the generator early must release the upstream HTTP stream back to the pool
+                    await response.close()
@@ -0,0 +1,183 @@
+import asyncio
+import logging
+import os
+import time
+from collections import deque
+from typing import AsyncGenerator, Callable
+
+from .tokens import estimate_messages_tokens
+
+logger = logging.getLogger("django")
+
+
+class LatencyTracker:
+    """Recent times to first token of one model."""
+
+    def __init__(self, size: int):
+        self.samples = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self.samples.append(seconds)
+
+    def quantile(self, q: float) -> float:
+        ordered = sorted(self.samples)
+        return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+    def mean_above(self, seconds: float) -> float:
+        """Expected time to first token of a request that has waited `seconds` already."""
+        slower = [sample for sample in self.samples if sample > seconds]
+        return sum(slower) / len(slower) if slower else seconds
+
+
+class HedgeStats:
+    def __init__(self):
+        self.requests = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.skipped = 0
+        self.failed_attempts = 0
+        self.extra_prompt_tokens = 0
+        self.saved_seconds = 0.0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "hedge_rate": self.hedged / self.requests if self.requests else 0.0,
+            "hedge_wins": self.hedge_wins,
+            "skipped": self.skipped,
+            "failed_attempts": self.failed_attempts,
+            "extra_prompt_tokens": self.extra_prompt_tokens,
+            "saved_seconds": round(self.saved_seconds, 3),
+        }
+
+
+class _Attempt:
+    def __init__(self, response: AsyncGenerator):
+        self.response = response
+        self.started = time.monotonic()
+        self.first = asyncio.get_running_loop().create_task(anext(response, None))
+
+    async def discard(self) -> None:
+        if not self.first.done():
+            # the generator finishes with the cancellation and closes its HTTP stream
+            self.first.cancel()
+            await asyncio.wait([self.first])
+        else:
+            await self.response.aclose()
+
+
+class Hedger:
+    """
+    Hedged requests for a completions provider.
+
+    When the first chunk of a request hasn't arrived within the `quantile` of recent times to first
+    token of its model, a second identical request is sent, to `alternate_model` if set. The first
+    of the two to produce a chunk is read, the other one is cancelled. Hedges are paid from a budget
+    that every request adds `max_rate` to, so at most that share of requests is hedged.
+    A model is hedged once `min_samples` times are known; `HEDGE_REQUESTS=true` enables hedging.
+    `saved_seconds` estimates the latency removed from the recent times slower than the hedge,
+    `extra_prompt_tokens` the cost of the extra requests.
+    """
+
+    def __init__(
+        self,
+        enabled: bool = None,
+        quantile: float = None,
+        max_rate: float = None,
+        min_samples: int = None,
+        min_delay: float = None,
+        alternate_model: str = None,
+        window: int = None,
+    ):
+        if enabled is None:
+            enabled = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+        self.enabled = enabled
+        self.quantile = quantile or float(os.getenv("HEDGE_QUANTILE", 0.9))
+        self.max_rate = max_rate if max_rate is not None else float(os.getenv("HEDGE_MAX_RATE", 0.1))
+        self.min_samples = min_samples if min_samples is not None else int(os.getenv("HEDGE_MIN_SAMPLES", 20))
+        self.min_delay = min_delay if min_delay is not None else float(os.getenv("HEDGE_MIN_DELAY", 0.1))
+        self.alternate_model = alternate_model or os.getenv("HEDGE_ALTERNATE_MODEL") or None
+        self.window = window or int(os.getenv("HEDGE_WINDOW", 200))
+        self.trackers = {}
+        self.budget = 1.0
+        self.stats = HedgeStats()
+
+    def tracker(self, key: str) -> LatencyTracker:
+        return self.trackers.setdefault(key, LatencyTracker(self.window))
+
+    def delay(self, key: str) -> float:
+        """Seconds to wait for the first chunk before hedging, None while too little is known."""
+        tracker = self.tracker(key)
+        if not self.enabled or len(tracker.samples) < self.min_samples:
+            return None
+        return max(tracker.quantile(self.quantile), self.min_delay)
+
+    def _take_budget(self) -> bool:
+        if self.budget < 1:
+            self.stats.skipped += 1
+            return False
+        self.budget -= 1
+        return True
+
+    async def stream(
+        self, model: str, messages: list, request: Callable[[str], AsyncGenerator], key: str = None
+    ) -> AsyncGenerator:
+        """
+        Chunks of `request(model)`, hedged with `request(alternate model)` when the first chunk is late.
+        Latencies are tracked by `key`, the model by default.
+        """
+        key = key or model
+        self.stats.requests += 1
+        self.budget = min(self.budget + self.max_rate, 10.0)
+        delay = self.delay(key)
+        primary = _Attempt(request(model))
+        winner, loser = primary, None
+        try:
+            if delay is not None:
+                done, _ = await asyncio.wait([primary.first], timeout=delay)
+                if not done and self._take_budget():
+                    hedge = _Attempt(request(self.alternate_model or model))
+                    winner, loser = await self._race(primary, hedge, messages, self.tracker(key))
+            first = await winner.first
+        except BaseException:
+            await primary.discard()
+            if loser is not None:
+                await loser.discard()
+            raise
+        if loser is not None:
+            await loser.discard()
+        self.tracker(key).add(time.monotonic() - winner.started)
+
+        try:
+            if first is not None:
+                yield first
+            async for chunk in winner.response:
+                yield chunk
+        finally:
+            await winner.response.aclose()
+
+    async def _race(self, primary: _Attempt, hedge: _Attempt, messages: list, tracker: LatencyTracker) -> tuple:
+        self.stats.hedged += 1
+        self.stats.extra_prompt_tokens += estimate_messages_tokens(messages or [])
+        pending = {primary.first, hedge.first}
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            answered = {task for task in done if task.exception() is None}
+            # a failed attempt loses, the other one may still answer
+            self.stats.failed_attempts += len(done) - len(answered)
+            if primary.first in answered:
+                return primary, hedge
+            if hedge.first in answered:
+                self.stats.hedge_wins += 1
+                waited = time.monotonic() - primary.started
+                self.stats.saved_seconds += tracker.mean_above(waited) - waited
+                return hedge, primary
+        # both failed, the error of the first request is raised
+        return primary, hedge
+
+    def report(self) -> dict:
+        return {
+            **self.stats.as_dict(),
+            "delays": {key: self.delay(key) for key in self.trackers},
+        }
@@ -1,6 +1,6 @@
 import os
 
-from .custom_openai_api_provider import CustomOpenAIApiProvider
+from .custom_openai_api_provider import AsyncCustomOpenAIApiProvider, CustomOpenAIApiProvider
 
 
 class LMStudioProvider(CustomOpenAIApiProvider):
@@ -9,3 +9,11 @@ class LMStudioProvider(CustomOpenAIApiProvider):
     api_key = "lm-studio"
     host = os.getenv("LLM_STUDIO_HOST") or "localhost"
     port = os.getenv("LLM_STUDIO_PORT") or 5000
+
+
+class AsyncLMStudioProvider(AsyncCustomOpenAIApiProvider):
+    name = "lmstudio"
+    model = "gpt-4o-mini"
+    api_key = "lm-studio"
+    host = os.getenv("LLM_STUDIO_HOST") or "localhost"
+    port = os.getenv("LLM_STUDIO_PORT") or 5000
@@ -1,5 +1,5 @@
 import os
-from openai import AsyncOpenAI, OpenAI
+from openai import OpenAI
 
 from .custom_openai_api_provider import CustomOpenAIApiProvider, AsyncCustomOpenAIApiProvider
 
@@ -7,14 +7,18 @@ from .custom_openai_api_provider import CustomOpenAIApiProvider, AsyncCustomOpen
 class OpenAIProvider(CustomOpenAIApiProvider):
     name = "openai"
     model = "gpt-4o-mini"
+    native_tools = True
 
     def init_client(self, *args, **kwargs):
-        self.client = OpenAI(api_key=os.getenv("API_KEY"))
+        self.api_key = os.getenv("API_KEY")
+        self.client = OpenAI(api_key=self.api_key, max_retries=0)
 
 
 class AsyncOpenAIProvider(AsyncCustomOpenAIApiProvider):
     name = "openai"
     model = "gpt-4o-mini"
+    native_tools = True
 
     def init_client(self, *args, **kwargs):
-        self.client = lambda: AsyncOpenAI(api_key=os.getenv("API_KEY"))
+        self.api_key = os.getenv("API_KEY")
+        self.client_options = {"api_key": self.api_key}
@@ -1,6 +1,6 @@
 import os
 
-from .custom_openai_api_provider import CustomOpenAIApiProvider
+from .custom_openai_api_provider import AsyncCustomOpenAIApiProvider, CustomOpenAIApiProvider
 
 
 class OpenRouterProvider(CustomOpenAIApiProvider):
@@ -9,3 +9,14 @@ class OpenRouterProvider(CustomOpenAIApiProvider):
     api_key = os.getenv("OPENROUTER_API_KEY")
     host = "https://openrouter.ai/api"
     port = None
+    # OpenRouter answers 404 for models without tool support, so unsupported models fall back on their own
+    native_tools = True
+
+
+class AsyncOpenRouterProvider(AsyncCustomOpenAIApiProvider):
+    name = "openrouter"
+    model = os.getenv("OPENROUTER_MODEL") or "google/gemini-2.0-flash-exp:free"
+    api_key = os.getenv("OPENROUTER_API_KEY")
+    host = "https://openrouter.ai/api"
+    port = None
+    native_tools = True
@@ -0,0 +1,437 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+import weakref
+from contextlib import asynccontextmanager, contextmanager
+from typing import AsyncIterator, Iterator
+
+import redis
+import redis.asyncio as aredis
+
+from .resilience import classify, retry_after
+from .tokens import estimate_messages_tokens, estimate_tokens
+
+logger = logging.getLogger("django")
+
+# Refills the request and token buckets of a limiter, drops the leases and waiters of dead workers
+# and admits the caller when it is among the first waiters that fit in the concurrency limit and
+# the buckets hold enough for it and the waiters before it. Redis time is used on all hosts, also
+# for the arrival of a waiter: its first call queues it, the calls while it waits keep its place.
+ACQUIRE_SCRIPT = """
+local state, inflight, waiting, deadlines = KEYS[1], KEYS[2], KEYS[3], KEYS[4]
+local id, cost = ARGV[1], tonumber(ARGV[2])
+local rpm, tpm, concurrency = tonumber(ARGV[3]), tonumber(ARGV[4]), tonumber(ARGV[5])
+local lease_ttl, waiter_ttl = tonumber(ARGV[6]), tonumber(ARGV[7])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+local s = redis.call('HMGET', state, 'requests', 'tokens', 'updated', 'limit', 'blocked_until')
+local elapsed = math.max(now - (tonumber(s[3]) or now), 0)
+local requests = math.min(rpm, (tonumber(s[1]) or rpm) + elapsed * rpm / 60)
+local tokens = math.min(tpm, (tonumber(s[2]) or tpm) + elapsed * tpm / 60)
+local limit = tonumber(s[4]) or concurrency
+local blocked_until = tonumber(s[5]) or 0
+
+redis.call('ZREMRANGEBYSCORE', inflight, '-inf', now)
+for _, dead in ipairs(redis.call('ZRANGEBYSCORE', deadlines, '-inf', now)) do
+  redis.call('ZREM', waiting, dead)
+  redis.call('ZREM', deadlines, dead)
+end
+redis.call('ZADD', waiting, 'NX', now, id)
+redis.call('ZADD', deadlines, now + waiter_ttl, id)
+
+local rank = redis.call('ZRANK', waiting, id)
+local free = math.floor(limit) - redis.call('ZCARD', inflight)
+cost = math.min(cost, tpm)
+local wait = 0
+if now < blocked_until then
+  wait = blocked_until - now
+elseif rank >= free then
+  wait = -1
+elseif rpm > 0 and requests < rank + 1 then
+  wait = (rank + 1 - requests) * 60 / rpm
+elseif tpm > 0 and tokens < (rank + 1) * cost then
+  wait = ((rank + 1) * cost - tokens) * 60 / tpm
+end
+
+if wait == 0 then
+  redis.call('ZREM', waiting, id)
+  redis.call('ZREM', deadlines, id)
+  redis.call('ZADD', inflight, now + lease_ttl, id)
+  requests = requests - 1
+  tokens = tokens - cost
+end
+redis.call('HSET', state, 'requests', requests, 'tokens', tokens, 'updated', now, 'limit', limit)
+redis.call('EXPIRE', state, 3600)
+for _, key in ipairs({inflight, waiting, deadlines}) do
+  redis.call('EXPIRE', key, 3600)
+end
+return {wait == 0 and 1 or 0, tostring(wait)}
+"""
+
+# Frees the slot, corrects the token bucket with the tokens really used and adapts the concurrency
+# limit: +1/limit on a fast success, *decrease on a 429 or a latency above the target, at most once
+# per cooldown so a burst of errors of requests sent together halves the limit only once.
+RELEASE_SCRIPT = """
+local state, inflight = KEYS[1], KEYS[2]
+local id, tokens, outcome, latency = ARGV[1], tonumber(ARGV[2]), ARGV[3], tonumber(ARGV[4])
+local concurrency, min_concurrency = tonumber(ARGV[5]), tonumber(ARGV[6])
+local decrease, cooldown, latency_field = tonumber(ARGV[7]), tonumber(ARGV[8]), ARGV[9]
+local target, block = tonumber(ARGV[10]), tonumber(ARGV[11])
+local time = redis.call('TIME')
+local now = tonumber(time[1]) + tonumber(time[2]) / 1000000
+
+redis.call('ZREM', inflight, id)
+if tokens ~= 0 then
+  redis.call('HINCRBYFLOAT', state, 'tokens', -tokens)
+end
+local s = redis.call('HMGET', state, 'limit', 'decreased_at', latency_field, latency_field .. '_samples')
+local limit = tonumber(s[1]) or concurrency
+local average, samples = tonumber(s[3]), tonumber(s[4]) or 0
+
+if outcome == 'ok' and latency >= 0 then
+  if target <= 0 and average and samples >= 20 then
+    target = average * 2
+  end
+  if target > 0 and latency > target then
+    outcome = 'slow'
+  end
+  average = average and average + 0.1 * (latency - average) or latency
+  redis.call('HSET', state, latency_field, average, latency_field .. '_samples', samples + 1)
+end
+
+if outcome == 'ok' then
+  limit = math.min(concurrency, limit + 1 / limit)
+elseif outcome == 'throttled' or outcome == 'slow' then
+  if now - (tonumber(s[2]) or 0) >= cooldown then
+    limit = math.max(min_concurrency, limit * decrease)
+    redis.call('HSET', state, 'decreased_at', now)
+    redis.call('HINCRBY', state, outcome, 1)
+  end
+  if block > 0 then
+    local blocked_until = tonumber(redis.call('HGET', state, 'blocked_until')) or 0
+    redis.call('HSET', state, 'blocked_until', math.max(blocked_until, now + block))
+  end
+end
+redis.call('HSET', state, 'limit', limit)
+return tostring(limit)
+"""
+
+
+class RateLimitTimeout(Exception):
+    """A request waited longer than `max_wait` for the distributed rate limiter."""
+
+
+class Limits:
+    def __init__(self, rpm: float = 0, tpm: float = 0, concurrency: int = 64, latency: float = 0):
+        self.rpm = float(rpm)
+        self.tpm = float(tpm)
+        self.concurrency = int(concurrency)
+        # seconds; 0 compares latencies to twice their moving average
+        self.latency = float(latency)
+
+
+def load_limits() -> dict:
+    """
+    Limits by provider or `provider:model` from RATE_LIMITS, a JSON object:
+    `{"openai": {"rpm": 500, "tpm": 200000, "concurrency": 32}, "openai:gpt-4o": {"tpm": 30000}}`.
+    `rpm`/`tpm` of 0 don't limit, `latency` is the latency target of the concurrency limit.
+    """
+    return {name: Limits(**limits) for name, limits in json.loads(os.getenv("RATE_LIMITS") or "{}").items()}
+
+
+class RateLimitStats:
+    def __init__(self):
+        self.acquired = 0
+        self.waited = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+        self.throttled = 0
+        self.errors = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "waited": self.waited,
+            "avg_wait": round(self.wait_seconds / self.waited, 3) if self.waited else 0.0,
+            "timeouts": self.timeouts,
+            "throttled": self.throttled,
+            "errors": self.errors,
+        }
+
+
+class Slot:
+    """A request admitted by the limiter; `chunk()` and `used()` record what the answer cost."""
+
+    def __init__(self, limiter: "RateLimiter", key: str, limits: Limits, prompt_tokens: int, stream: bool):
+        self.limiter = limiter
+        self.key = key
+        self.limits = limits
+        self.id = uuid.uuid4().hex
+        self.prompt_tokens = prompt_tokens
+        self.cost = prompt_tokens + limiter.completion_tokens
+        self.stream = stream
+        self.tokens = None
+        self.text = ""
+        self.started = time.monotonic()
+        self.latency = -1.0
+
+    def chunk(self, text: str) -> None:
+        if self.latency < 0:
+            self.latency = time.monotonic() - self.started
+        self.text += text
+
+    def used(self, usage) -> None:
+        if getattr(usage, "total_tokens", None):
+            self.tokens = usage.total_tokens
+
+    def release_args(self, e: BaseException = None) -> list:
+        outcome, block, correction = "ok", 0.0, 0
+        if e is not None:
+            outcome = "throttled" if classify(e) == "rate_limit" else "error"
+            if outcome == "throttled":
+                self.limiter.stats.throttled += 1
+                block = retry_after(e) or 0.0
+        else:
+            if not self.stream:
+                self.latency = time.monotonic() - self.started
+            if self.limits.tpm:
+                # streamed answers without usage are estimated
+                tokens = self.tokens or self.prompt_tokens + estimate_tokens(self.text)
+                correction = tokens - min(self.cost, self.limits.tpm)
+        return [
+            self.id,
+            correction,
+            outcome,
+            self.latency if outcome == "ok" else -1,
+            self.limits.concurrency,
+            self.limiter.min_concurrency,
+            self.limiter.decrease,
+            self.limiter.cooldown,
+            "ttft" if self.stream else "latency",
+            self.limits.latency,
+            block,
+        ]
+
+
+class RateLimiter:
+    """
+    Rate limiter of provider calls shared by all workers and hosts through Redis.
+
+    Each (provider, API key, model) has a request bucket of `rpm` and a token bucket of `tpm` per minute
+    and a concurrency limit that starts at `concurrency`. The limit grows by 1/limit on each fast answer
+    and is multiplied by `decrease` on a 429 or when latency exceeds its target, at most once every
+    `cooldown` seconds. A 429 with Retry-After pauses the key on every worker. Waiting requests are
+    admitted in arrival order; a request fails with `RateLimitTimeout` after `max_wait` seconds.
+    Tokens are reserved with the estimated prompt plus `completion_tokens` and corrected with the usage
+    of the answer. The limiter fails open when Redis is down. Keys without limits aren't limited.
+    """
+
+    def __init__(
+        self,
+        limits: dict = None,
+        redis_url: str = None,
+        max_wait: float = None,
+        completion_tokens: int = None,
+        min_concurrency: int = 1,
+        decrease: float = 0.5,
+        cooldown: float = None,
+        lease_ttl: float = 300,
+    ):
+        self.limits = limits if limits is not None else load_limits()
+        self.redis_url = redis_url or os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        self.max_wait = max_wait or float(os.getenv("RATE_LIMIT_MAX_WAIT", 60))
+        self.completion_tokens = completion_tokens or int(os.getenv("RATE_LIMIT_COMPLETION_TOKENS", 256))
+        self.min_concurrency = min_concurrency
+        self.decrease = decrease
+        self.cooldown = cooldown if cooldown is not None else float(os.getenv("RATE_LIMIT_COOLDOWN", 2))
+        # leases of a dead worker are freed after this many seconds
+        self.lease_ttl = lease_ttl
+        self.poll_interval = 0.05
+        self.stats = RateLimitStats()
+        self._client = None
+        self._async_clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    @property
+    def client(self) -> redis.StrictRedis:
+        if self._client is None:
+            self._client = redis.StrictRedis.from_url(self.redis_url)
+        return self._client
+
+    @property
+    def async_client(self) -> aredis.Redis:
+        # redis.asyncio clients are bound to the loop they were created in
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if loop not in self._async_clients:
+                self._async_clients[loop] = aredis.Redis.from_pool(aredis.ConnectionPool.from_url(self.redis_url))
+            return self._async_clients[loop]
+
+    def limits_for(self, provider: str, model: str) -> Limits:
+        return self.limits.get(f"{provider}:{model}") or self.limits.get(provider)
+
+    @staticmethod
+    def key(provider: str, api_key: str, model: str) -> str:
+        # the API key itself never reaches Redis
+        account = hashlib.sha256((api_key or "").encode()).hexdigest()[:12]
+        return f"ratelimit:{provider}:{account}:{model}"
+
+    def slot(self, provider: str, api_key: str, model: str, messages: list, stream: bool = False) -> Slot:
+        prompt_tokens = estimate_messages_tokens(messages or [])
+        return Slot(self, self.key(provider, api_key, model), self.limits_for(provider, model), prompt_tokens, stream)
+
+    @contextmanager
+    def limit(self, provider: str, api_key: str, model: str, messages: list, stream: bool = False) -> Iterator[Slot]:
+        """Wait for a slot of the provider, API key and model and hold it during the block."""
+        slot = self.slot(provider, api_key, model, messages, stream)
+        if slot.limits is None:
+            yield slot
+            return
+        self.acquire(slot)
+        try:
+            yield slot
+        except BaseException as e:
+            self.release(slot, e)
+            raise
+        self.release(slot)
+
+    @asynccontextmanager
+    async def async_limit(
+        self, provider: str, api_key: str, model: str, messages: list, stream: bool = False
+    ) -> AsyncIterator[Slot]:
+        slot = self.slot(provider, api_key, model, messages, stream)
+        if slot.limits is None:
+            yield slot
+            return
+        await self.async_acquire(slot)
+        try:
+            yield slot
+        except BaseException as e:
+            await self.async_release(slot, e)
+            raise
+        await self.async_release(slot)
+
+    def _acquire_args(self, slot: Slot) -> tuple:
+        keys = [slot.key, f"{slot.key}:inflight", f"{slot.key}:waiting", f"{slot.key}:deadlines"]
+        limits = slot.limits
+        args = [slot.id, slot.cost, limits.rpm, limits.tpm, limits.concurrency, self.lease_ttl, 5]
+        return keys, args
+
+    def _next_wait(self, slot: Slot, started: float, wait: float) -> float:
+        waited = time.monotonic() - started
+        if waited >= self.max_wait:
+            self.stats.timeouts += 1
+            raise RateLimitTimeout(f"Waited {waited:.1f}s for the rate limit of {slot.key}")
+        # -1: no free slot, the position in the queue is checked again soon
+        return self.poll_interval if wait < 0 else min(max(wait, self.poll_interval), 1.0)
+
+    def _admitted(self, slot: Slot, started: float) -> None:
+        slot.started = time.monotonic()
+        self.stats.acquired += 1
+        if slot.started - started > self.poll_interval:
+            self.stats.waited += 1
+            self.stats.wait_seconds += slot.started - started
+
+    def _error(self, e: Exception) -> None:
+        self.stats.errors += 1
+        logger.warning(f"Rate limiter error: {e}")
+
+    def acquire(self, slot: Slot) -> None:
+        started = time.monotonic()
+        keys, args = self._acquire_args(slot)
+        while True:
+            try:
+                admitted, wait = self.client.eval(ACQUIRE_SCRIPT, len(keys), *keys, *args)
+            except redis.RedisError as e:
+                self._error(e)
+                break
+            if admitted:
+                break
+            time.sleep(self._next_wait(slot, started, float(wait)))
+        self._admitted(slot, started)
+
+    async def async_acquire(self, slot: Slot) -> None:
+        started = time.monotonic()
+        keys, args = self._acquire_args(slot)
+        try:
+            while True:
+                try:
+                    admitted, wait = await self.async_client.eval(ACQUIRE_SCRIPT, len(keys), *keys, *args)
+                except redis.RedisError as e:
+                    self._error(e)
+                    break
+                if admitted:
+                    break
+                await asyncio.sleep(self._next_wait(slot, started, float(wait)))
+        except BaseException:
+            # a cancelled request leaves the queue at once instead of blocking the ones behind it
+            await self._async_leave(slot)
+            raise
+        self._admitted(slot, started)
+
+    async def _async_leave(self, slot: Slot) -> None:
+        try:
+            pipe = self.async_client.pipeline(transaction=False)
+            pipe.zrem(f"{slot.key}:waiting", slot.id)
+            pipe.zrem(f"{slot.key}:deadlines", slot.id)
+            await asyncio.shield(pipe.execute())
+        except (redis.RedisError, asyncio.CancelledError):
+            pass
+
+    def release(self, slot: Slot, e: BaseException = None) -> None:
+        try:
+            self.client.eval(RELEASE_SCRIPT, 2, slot.key, f"{slot.key}:inflight", *slot.release_args(e))
+        except redis.RedisError as error:
+            self._error(error)
+
+    async def async_release(self, slot: Slot, e: BaseException = None) -> None:
+        try:
+            keys = [slot.key, f"{slot.key}:inflight"]
+            await asyncio.shield(self.async_client.eval(RELEASE_SCRIPT, 2, *keys, *slot.release_args(e)))
+        except (redis.RedisError, asyncio.CancelledError) as error:
+            if isinstance(error, redis.RedisError):
+                self._error(error)
+
+    def state(self) -> dict:
+        """Current state of every limited key in Redis, shared by all workers."""
+        state = {}
+        for key in self.client.scan_iter(match="ratelimit:*", count=100):
+            key = key.decode()
+            if key.endswith((":inflight", ":waiting", ":deadlines")):
+                continue
+            values = {name.decode(): float(value) for name, value in self.client.hgetall(key).items()}
+            state[key.removeprefix("ratelimit:")] = {
+                "limit": round(values.get("limit", 0), 2),
+                "in_flight": self.client.zcard(f"{key}:inflight"),
+                "waiting": self.client.zcard(f"{key}:waiting"),
+                "requests_left": round(values.get("requests", 0), 1),
+                "tokens_left": round(values.get("tokens", 0)),
+                "throttled": int(values.get("throttled", 0)),
+                "slow": int(values.get("slow", 0)),
+                "latency": values.get("latency"),
+                "ttft": values.get("ttft"),
+                "blocked_for": max(values.get("blocked_until", 0) - time.time(), 0.0),
+            }
+        return state
+
+    def report(self) -> dict:
+        return self.stats.as_dict()
+
+
+_rate_limiter = None
+_rate_limiter_lock = threading.Lock()
+
+
+def rate_limiter() -> RateLimiter:
+    """The rate limiter of this process, limits are read from RATE_LIMITS once."""
+    global _rate_limiter
+    with _rate_limiter_lock:
+        if _rate_limiter is None:
+            _rate_limiter = RateLimiter()
+        return _rate_limiter
@@ -0,0 +1,272 @@
+import asyncio
+import email.utils
+import logging
+import os
+import random
+import threading
+import time
+from typing import AsyncGenerator, Callable, Generator, Iterator
+
+import httpx
+import openai
+
+from ._interface import ToolsNotSupportedError
+
+logger = logging.getLogger("django")
+
+RETRYABLE = {"rate_limit", "timeout", "connection", "server"}
+
+
+class CircuitOpenError(Exception):
+    """The provider failed too often recently, requests fail fast until it recovers."""
+
+
+def classify(e: BaseException) -> str:
+    """Kind of a completion error: rate_limit, timeout, connection, server, client, tools, circuit or unknown."""
+    if isinstance(e, ToolsNotSupportedError):
+        return "tools"
+    if isinstance(e, CircuitOpenError):
+        return "circuit"
+    if isinstance(e, openai.RateLimitError):
+        return "rate_limit"
+    if isinstance(e, (openai.APITimeoutError, httpx.TimeoutException, TimeoutError)):
+        return "timeout"
+    if isinstance(e, (openai.APIConnectionError, httpx.TransportError, ConnectionError)):
+        return "connection"
+    if isinstance(e, openai.APIStatusError):
+        if e.status_code == 429:
+            return "rate_limit"
+        return "server" if e.status_code >= 500 else "client"
+    return "unknown"
+
+
+def retry_after(e: BaseException) -> float:
+    """Seconds the server asked to wait in `Retry-After`/`retry-after-ms`, None when it didn't."""
+    response = getattr(e, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    if headers.get("retry-after-ms"):
+        try:
+            return float(headers["retry-after-ms"]) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        date = email.utils.parsedate_to_datetime(value)
+        return max(date.timestamp() - time.time(), 0.0) if date else None
+
+
+class CircuitBreaker:
+    """
+    Per-provider circuit breaker. After `failure_threshold` upstream failures in a row the circuit
+    opens and requests fail fast with `CircuitOpenError` for `recovery_timeout` seconds; then a single
+    probe request is let through and closes the circuit again when it succeeds.
+    Client errors are answers of a healthy upstream and don't count as failures.
+    """
+
+    def __init__(self, name: str, failure_threshold: int = None, recovery_timeout: float = None):
+        self.name = name
+        self.failure_threshold = failure_threshold or int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", 5))
+        self.recovery_timeout = recovery_timeout or float(os.getenv("CIRCUIT_RECOVERY_TIMEOUT", 30))
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    def before(self) -> None:
+        with self._lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.recovery_timeout:
+                self.state = "half_open"
+            if self.state == "half_open" and not self.probing:
+                self.probing = True
+                return
+            self.rejected += 1
+        raise CircuitOpenError(f"Circuit of provider {self.name} is open")
+
+    def success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.probing = False
+            self.state = "closed"
+
+    def release(self) -> None:
+        """End a probe that says nothing about the upstream health."""
+        with self._lock:
+            self.probing = False
+
+    def failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            self.probing = False
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.opened += 1
+                    logger.warning(f"Circuit of provider {self.name} opened after {self.failures} failures")
+                self.state = "open"
+                self.opened_at = time.monotonic()
+
+    def as_dict(self) -> dict:
+        return {"state": self.state, "failures": self.failures, "opened": self.opened, "rejected": self.rejected}
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def circuit_breaker(name: str) -> CircuitBreaker:
+    """The circuit breaker of a provider, shared by its sync and async clients in this process."""
+    with _breakers_lock:
+        return _breakers.setdefault(name, CircuitBreaker(name))
+
+
+class RetryStats:
+    def __init__(self):
+        self.calls = 0
+        self.retries = 0
+        self.gave_up = 0
+        self.errors = {}
+
+    def as_dict(self) -> dict:
+        return {"calls": self.calls, "retries": self.retries, "gave_up": self.gave_up, "errors": dict(self.errors)}
+
+
+class RetryPolicy:
+    """
+    Retries of completion calls by error kind: rate limits, timeouts, connection and 5xx errors
+    are retried up to `max_attempts` times, waiting `Retry-After` when the server sent it and
+    exponential backoff with jitter otherwise. Client errors are raised at once.
+    A stream is restarted only while it hasn't produced a chunk: a new completion can't continue
+    the text of the broken one, so later errors reach the caller.
+    """
+
+    def __init__(
+        self,
+        breaker: CircuitBreaker,
+        max_attempts: int = None,
+        base_delay: float = None,
+        max_delay: float = None,
+    ):
+        self.breaker = breaker
+        self.max_attempts = max_attempts or int(os.getenv("RETRY_MAX_ATTEMPTS", 3))
+        self.base_delay = base_delay if base_delay is not None else float(os.getenv("RETRY_BASE_DELAY", 0.5))
+        self.max_delay = max_delay if max_delay is not None else float(os.getenv("RETRY_MAX_DELAY", 20))
+        self.stats = RetryStats()
+
+    def delay(self, attempt: int, e: BaseException) -> float:
+        asked = retry_after(e)
+        if asked is not None:
+            return min(asked, self.max_delay)
+        return random.uniform(0, min(self.base_delay * 2**attempt, self.max_delay))
+
+    def _failed(self, attempt: int, e: BaseException) -> float:
+        """Record a failed attempt; the delay before the next one or None to give up."""
+        kind = classify(e)
+        self.stats.errors[kind] = self.stats.errors.get(kind, 0) + 1
+        if kind in RETRYABLE:
+            self.breaker.failure()
+        elif kind in ("client", "tools"):
+            # the upstream answered, only the request was wrong
+            self.breaker.success()
+        else:
+            self.breaker.release()
+        if kind not in RETRYABLE or attempt + 1 >= self.max_attempts:
+            self.stats.gave_up += kind in RETRYABLE
+            return None
+        self.stats.retries += 1
+        delay = self.delay(attempt, e)
+        logger.info(f"Retrying provider {self.breaker.name} in {delay:.2f}s after {kind} error: {e}")
+        return delay
+
+    def call(self, request: Callable):
+        self.stats.calls += 1
+        attempt = 0
+        while True:
+            self.breaker.before()
+            try:
+                response = request()
+            except Exception as e:
+                delay = self._failed(attempt, e)
+                if delay is None:
+                    raise
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return response
+
+    async def async_call(self, request: Callable):
+        self.stats.calls += 1
+        attempt = 0
+        while True:
+            self.breaker.before()
+            try:
+                response = await request()
+            except Exception as e:
+                delay = self._failed(attempt, e)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.success()
+            return response
+
+    def stream(self, open_stream: Callable[[], Iterator]) -> Generator:
+        """Open a stream with retries until its first chunk; errors before it are raised here."""
+        end = object()
+
+        def first_chunk():
+            chunks = open_stream()
+            try:
+                return chunks, next(chunks, end)
+            except BaseException:
+                chunks.close()
+                raise
+
+        chunks, first = self.call(first_chunk)
+        return self._iter_rest(chunks, first, end)
+
+    def _iter_rest(self, chunks: Generator, first, end) -> Generator:
+        try:
+            if first is not end:
+                yield first
+            yield from chunks
+        except Exception as e:
+            self._failed(self.max_attempts, e)
+            raise
+        finally:
+            chunks.close()
+
+    async def async_stream(self, open_stream: Callable[[], AsyncGenerator]) -> AsyncGenerator:
+        end = object()
+
+        async def first_chunk():
+            chunks = open_stream()
+            try:
+                return chunks, await anext(chunks, end)
+            except BaseException:
+                await chunks.aclose()
+                raise
+
+        chunks, first = await self.async_call(first_chunk)
+        try:
+            if first is not end:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+        except Exception as e:
+            self._failed(self.max_attempts, e)
+            raise
+        finally:
+            await chunks.aclose()
+
+    def report(self) -> dict:
+        return {**self.stats.as_dict(), "circuit": self.breaker.as_dict()}
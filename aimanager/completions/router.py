@@ -0,0 +1,307 @@
+import json
+import logging
+import os
+import random
+import threading
+import time
+from typing import AsyncGenerator, Callable, Generator, Union
+
+from ._interface import AsyncCompletionProviderInterface, CompletionProviderInterface, ToolsNotSupportedError
+
+logger = logging.getLogger("django")
+
+
+def load_targets() -> list[dict]:
+    """
+    Targets of the router from ROUTER_TARGETS, a JSON list in order of preference:
+    `[{"provider": "openai", "model": "gpt-4o-mini"}, {"provider": "openrouter", "weight": 2}]`.
+    """
+    targets = json.loads(os.getenv("ROUTER_TARGETS") or "[]")
+    if not targets:
+        raise ValueError("ROUTER_TARGETS must list at least one provider")
+    return targets
+
+
+class TargetStats:
+    """Moving averages of latency, time to first token and errors of one target."""
+
+    def __init__(self, alpha: float):
+        self.alpha = alpha
+        self.latency = None
+        self.ttft = None
+        self.error_rate = 0.0
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.cooldown_until = 0.0
+
+    def _average(self, current: float, value: float) -> float:
+        return value if current is None else current + self.alpha * (value - current)
+
+    def add_success(self, latency: float, ttft: float = None) -> None:
+        self.requests += 1
+        self.consecutive_failures = 0
+        self.latency = self._average(self.latency, latency)
+        if ttft is not None:
+            self.ttft = self._average(self.ttft, ttft)
+        self.error_rate = self._average(self.error_rate, 0.0)
+
+    def add_failure(self) -> None:
+        self.requests += 1
+        self.failures += 1
+        self.consecutive_failures += 1
+        self.error_rate = self._average(self.error_rate, 1.0)
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "failures": self.failures,
+            "error_rate": round(self.error_rate, 3),
+            "latency": self.latency,
+            "ttft": self.ttft,
+            "healthy": self.cooldown_until <= time.monotonic(),
+        }
+
+
+class Target:
+    def __init__(self, provider, model: str = None, weight: float = 1.0, alpha: float = 0.2):
+        self.provider = provider
+        self.model = model
+        self.weight = weight
+        self.stats = TargetStats(alpha)
+
+    @property
+    def name(self) -> str:
+        return f"{self.provider.name}:{self.model or self.provider.model}"
+
+    def model_for(self, model: str = None) -> str:
+        # a target pinned to a model ignores the model the agent asks for
+        return self.model or model
+
+
+class Router:
+    """
+    Ranks the targets of a router provider by live statistics.
+
+    A target's score is its expected time to first token (whole latency for non-stream calls),
+    raised by its error rate and divided by its weight; targets without measurements come first.
+    After `failure_threshold` failures in a row a target cools down for `cooldown` seconds and
+    is only tried when no healthy target is left. A small `explore` share of requests goes to a
+    random healthy target, so the statistics of slower targets stay current.
+    With the "ordered" strategy healthy targets are tried in configuration order.
+    """
+
+    def __init__(
+        self,
+        targets: list[Target],
+        strategy: str = None,
+        failure_threshold: int = None,
+        cooldown: float = None,
+        explore: float = None,
+    ):
+        self.targets = targets
+        self.strategy = strategy or os.getenv("ROUTER_STRATEGY", "latency")
+        self.failure_threshold = failure_threshold or int(os.getenv("ROUTER_FAILURE_THRESHOLD", 3))
+        self.cooldown = cooldown if cooldown is not None else float(os.getenv("ROUTER_COOLDOWN", 30))
+        self.explore = explore if explore is not None else float(os.getenv("ROUTER_EXPLORE", 0.05))
+        self.failovers = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def score(target: Target, stream: bool) -> float:
+        stats = target.stats
+        expected = stats.ttft if stream and stats.ttft is not None else stats.latency
+        if expected is None:
+            return 0.0
+        return expected * (1 + 4 * stats.error_rate) / target.weight
+
+    def ranked(self, stream: bool = False) -> list[Target]:
+        now = time.monotonic()
+        with self._lock:
+            healthy = [target for target in self.targets if target.stats.cooldown_until <= now]
+            cooling = [target for target in self.targets if target.stats.cooldown_until > now]
+            if self.strategy != "ordered":
+                healthy.sort(key=lambda target: self.score(target, stream))
+                if len(healthy) > 1 and random.random() < self.explore:
+                    healthy.insert(0, healthy.pop(random.randrange(1, len(healthy))))
+            cooling.sort(key=lambda target: target.stats.cooldown_until)
+        return healthy + cooling
+
+    def success(self, target: Target, started: float, first_chunk: float = None) -> None:
+        now = time.monotonic()
+        with self._lock:
+            target.stats.add_success(now - started, first_chunk - started if first_chunk else None)
+            target.stats.cooldown_until = 0.0
+
+    def failure(self, target: Target, e: Exception) -> None:
+        with self._lock:
+            target.stats.add_failure()
+            if target.stats.consecutive_failures >= self.failure_threshold:
+                target.stats.cooldown_until = time.monotonic() + self.cooldown
+        logger.warning(f"Router target {target.name} failed: {e}")
+
+    def failed_over(self) -> None:
+        with self._lock:
+            self.failovers += 1
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                "strategy": self.strategy,
+                "failovers": self.failovers,
+                "targets": {target.name: target.stats.as_dict() for target in self.targets},
+            }
+
+
+def _build_targets(build: Callable, targets: list[dict]) -> list[Target]:
+    return [
+        Target(build(target["provider"]), model=target.get("model"), weight=float(target.get("weight", 1)))
+        for target in targets
+    ]
+
+
+class RouterProvider(CompletionProviderInterface):
+    """
+    Completions provider that sends each request to the best target of a pool of providers and models
+    and fails over to the next one on errors, for streams only while no chunk was sent yet.
+    """
+
+    name = "router"
+
+    def init_client(self, *args, **kwargs):
+        self.router = kwargs.get("router") or Router(
+            _build_targets(kwargs["build"], kwargs.get("targets") or load_targets())
+        )
+
+    @property
+    def model(self) -> str:
+        target = self.router.targets[0]
+        return target.model_for(target.provider.model)
+
+    def supports_tools(self, model: str = None) -> bool:
+        return all(target.provider.supports_tools(target.model_for(model)) for target in self.router.targets)
+
+    def report(self) -> dict:
+        return self.router.report()
+
+    def generate_response(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> Union[str, Generator]:
+        error = None
+        for attempt, target in enumerate(self.router.ranked(stream)):
+            if attempt:
+                self.router.failed_over()
+            started = time.monotonic()
+            try:
+                response = target.provider.generate_response(
+                    messages, model=target.model_for(model), stream=stream, tools=tools
+                )
+                if not stream:
+                    self.router.success(target, started)
+                    return response
+                # the stream is committed to a target once its first chunk arrived
+                first = next(response, None)
+            except ToolsNotSupportedError:
+                raise
+            except Exception as e:
+                self.router.failure(target, e)
+                error = e
+                continue
+            return self._iter_stream(target, started, first, response)
+        raise error
+
+    def _iter_stream(self, target: Target, started: float, first: str, response: Generator) -> Generator:
+        first_chunk = time.monotonic()
+        try:
+            if first is not None:
+                yield first
+            yield from response
+        except Exception as e:
+            self.router.failure(target, e)
+            raise
+        finally:
+            response.close()
+        self.router.success(target, started, first_chunk)
+
+
+class AsyncRouterProvider(AsyncCompletionProviderInterface):
+    """Async `RouterProvider`."""
+
+    name = "router"
+
+    def init_client(self, *args, **kwargs):
+        self.router = kwargs.get("router") or Router(
+            _build_targets(kwargs["build"], kwargs.get("targets") or load_targets())
+        )
+
+    @property
+    def model(self) -> str:
+        target = self.router.targets[0]
+        return target.model_for(target.provider.model)
+
+    def supports_tools(self, model: str = None) -> bool:
+        return all(target.provider.supports_tools(target.model_for(model)) for target in self.router.targets)
+
+    def report(self) -> dict:
+        return self.router.report()
+
+    async def async_generate_response(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> str:
+        error = None
+        for attempt, target in enumerate(self.router.ranked()):
+            if attempt:
+                self.router.failed_over()
+            started = time.monotonic()
+            try:
+                response = await target.provider.async_generate_response(
+                    messages, model=target.model_for(model), stream=stream, tools=tools
+                )
+            except ToolsNotSupportedError:
+                raise
+            except Exception as e:
+                self.router.failure(target, e)
+                error = e
+                continue
+            self.router.success(target, started)
+            return response
+        raise error
+
+    async def async_generate_response_stream(
+        self, messages: list = None, model: str = None, stream: bool = False, tools=None
+    ) -> AsyncGenerator:
+        error = None
+        for attempt, target in enumerate(self.router.ranked(stream=True)):
+            if attempt:
+                self.router.failed_over()
+            started = time.monotonic()
+            response = target.provider.async_generate_response_stream(
+                messages, model=target.model_for(model), stream=stream, tools=tools
+            )
+            try:
+                first = await anext(response, None)
+            except ToolsNotSupportedError:
+                await response.aclose()
+                raise
+            except Exception as e:
+                await response.aclose()
+                self.router.failure(target, e)
+                error = e
+                continue
+            break
+        else:
+            raise error
+
+        # the stream is committed to this target, later errors reach the caller
+        first_chunk = time.monotonic()
+        try:
+            if first is not None:
+                yield first
+            async for chunk in response:
+                yield chunk
+        except Exception as e:
+            self.router.failure(target, e)
+            raise
+        finally:
+            await response.aclose()
+        self.router.success(target, started, first_chunk)
@@ -0,0 +1,353 @@
+import hashlib
+import importlib
+import json
+import math
+import os
+import re
+import threading
+import time
+import zlib
+from collections import deque
+
+import numpy as np
+
+from ._interface import AsyncCompletionProviderInterface
+from .cache import CACHE_LOOKUPS, AsyncCachedCompletionProvider, CachedCompletionProvider
+
+WORD_PATTERN = re.compile(r"\w+")
+SIGNATURE_BITS = 64
+
+
+class HashingEmbedder:
+    """
+    Offline embedder: words, word bigrams and character trigrams hashed into `dim` signed buckets.
+    Good enough to match paraphrases that share most of their words, needs no model or network.
+    Custom embedders implement `embed(texts) -> np.ndarray` of shape (len(texts), dim).
+    """
+
+    def __init__(self, dim: int = None):
+        self.dim = dim or int(os.getenv("SEMANTIC_CACHE_DIM", 256))
+
+    @staticmethod
+    def features(text: str) -> list[tuple[str, float]]:
+        words = WORD_PATTERN.findall(text.casefold())
+        features = [(word, 1.0) for word in words]
+        features += [(f"{first} {second}", 1.0) for first, second in zip(words, words[1:])]
+        for word in words:
+            padded = f"#{word}#"
+            features += [(padded[index : index + 3], 0.5) for index in range(len(padded) - 2)]
+        return features
+
+    def embed(self, texts: list[str]) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            features = self.features(text)
+            if not features:
+                continue
+            hashes = np.array([zlib.crc32(feature.encode()) for feature, _ in features], dtype=np.uint32)
+            weights = np.array([weight for _, weight in features], dtype=np.float32)
+            signs = np.where(hashes & 0x80000000, -1.0, 1.0).astype(np.float32)
+            np.add.at(vectors[row], hashes % self.dim, weights * signs)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        return vectors / np.maximum(norms, 1e-12)
+
+
+def load_embedder():
+    """Embedder class from SEMANTIC_CACHE_EMBEDDER ("package.module.Class"), `HashingEmbedder` by default."""
+    path = os.getenv("SEMANTIC_CACHE_EMBEDDER")
+    if not path:
+        return HashingEmbedder()
+    module, name = path.rsplit(".", 1)
+    return getattr(importlib.import_module(module), name)()
+
+
+class VectorIndex:
+    """
+    Entries of one namespace in NumPy arrays that grow up to `max_entries`.
+
+    Search is two-stage and vectorized over all entries: 64-bit random hyperplane signatures are
+    compared with the query signature by XOR and popcount, and only entries within the Hamming
+    radius that corresponds to the similarity threshold are scored by exact cosine similarity.
+    When the index is full, expired entries are replaced first, then the least recently used.
+    """
+
+    max_candidates = 256
+
+    def __init__(self, dim: int, max_entries: int, capacity: int = 1024):
+        self.dim = dim
+        self.max_entries = max_entries
+        self.size = 0
+        self.vectors = np.zeros((0, dim), dtype=np.float32)
+        self.signatures = np.zeros(0, dtype=np.uint64)
+        self.expires = np.zeros(0, dtype=np.float64)
+        self.used = np.zeros(0, dtype=np.float64)
+        self.questions = []
+        self.answers = []
+        self.slots = {}
+        self._grow(min(capacity, max_entries))
+
+    def _grow(self, capacity: int) -> None:
+        for name in ("vectors", "signatures", "expires", "used"):
+            array = getattr(self, name)
+            grown = np.zeros((capacity, *array.shape[1:]), dtype=array.dtype)
+            grown[: self.size] = array[: self.size]
+            setattr(self, name, grown)
+        self.questions += [None] * (capacity - len(self.questions))
+        self.answers += [None] * (capacity - len(self.answers))
+
+    def _free_slot(self, now: float) -> tuple[int, bool]:
+        if self.size < len(self.expires):
+            self.size += 1
+            return self.size - 1, False
+        if self.size < self.max_entries:
+            self._grow(min(len(self.expires) * 2, self.max_entries))
+            return self._free_slot(now)
+        expired = np.flatnonzero(self.expires[: self.size] <= now)
+        if expired.size:
+            return int(expired[0]), self.answers[int(expired[0])] is not None
+        return int(np.argmin(self.used[: self.size])), True
+
+    def add(self, vector: np.ndarray, signature: int, question: str, answer: str, ttl: float) -> bool:
+        """Store an entry; return True when a live entry was evicted for it."""
+        now = time.time()
+        slot = self.slots.get(question)
+        evicted = False
+        if slot is None:
+            slot, evicted = self._free_slot(now)
+            self.slots.pop(self.questions[slot], None)
+            self.slots[question] = slot
+        self.vectors[slot] = vector
+        self.signatures[slot] = signature
+        self.expires[slot] = now + ttl
+        self.used[slot] = now
+        self.questions[slot] = question
+        self.answers[slot] = answer
+        return evicted
+
+    def remove(self, slot: int) -> None:
+        self.slots.pop(self.questions[slot], None)
+        self.expires[slot] = 0
+        self.questions[slot] = self.answers[slot] = None
+
+    def search(self, vectors: np.ndarray, signatures: np.ndarray, threshold: float, radius: int) -> tuple:
+        """Best slot and score for each query vector; slot -1 when nothing reaches `threshold`."""
+        slots = np.full(len(vectors), -1)
+        scores = np.zeros(len(vectors), dtype=np.float32)
+        if not self.size:
+            return slots, scores
+        now = time.time()
+        distances = np.bitwise_count(self.signatures[: self.size][None, :] ^ signatures[:, None])
+        candidates = (distances <= radius) & (self.expires[: self.size] > now)
+        for row in range(len(vectors)):
+            indexes = np.flatnonzero(candidates[row])
+            if indexes.size > self.max_candidates:
+                nearest = np.argpartition(distances[row, indexes], self.max_candidates)
+                indexes = indexes[nearest[: self.max_candidates]]
+            if not indexes.size:
+                continue
+            similarity = self.vectors[indexes] @ vectors[row]
+            best = int(np.argmax(similarity))
+            if similarity[best] >= threshold:
+                slots[row] = indexes[best]
+                scores[row] = similarity[best]
+                self.used[indexes[best]] = now
+        return slots, scores
+
+
+class SemanticCacheSettings:
+    """
+    Per-agent options from `Agent.metadata["semantic_cache"]`:
+    `true` or `{"enabled": true, "threshold": 0.85, "ttl": seconds, "namespace": "faq"}`.
+    Without a namespace the agent's provider, model, instructions and tools define it.
+    """
+
+    def __init__(self, threshold: float = None, ttl: int = None, namespace: str = None):
+        self.threshold = threshold or float(os.getenv("SEMANTIC_CACHE_THRESHOLD", 0.85))
+        self.ttl = ttl or int(os.getenv("SEMANTIC_CACHE_TTL", 86400))
+        self.namespace = namespace
+
+    @classmethod
+    def from_metadata(cls, metadata: dict = None) -> "SemanticCacheSettings":
+        options = (metadata or {}).get("semantic_cache")
+        if not options:
+            return None
+        if not isinstance(options, dict):
+            options = {}
+        if not options.get("enabled", True):
+            return None
+        return cls(threshold=options.get("threshold"), ttl=options.get("ttl"), namespace=options.get("namespace"))
+
+
+class SemanticCacheStats:
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.stores = 0
+        self.evictions = 0
+        self.false_positives = 0
+        self.hit_similarity = 0.0
+
+    def as_dict(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "stores": self.stores,
+            "evictions": self.evictions,
+            "false_positives": self.false_positives,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "false_positive_rate": self.false_positives / self.hits if self.hits else 0.0,
+            "avg_hit_similarity": self.hit_similarity / self.hits if self.hits else 0.0,
+        }
+
+
+class SemanticCache:
+    """
+    Per-process cache of answers to single-turn questions, matched by similarity of the question.
+
+    Only requests without conversation history are looked up and stored: the same question in the
+    middle of a conversation can mean something else. Recent hits are kept in `hits_log` for review;
+    a wrong answer reported through `report_false_positive` is counted and evicted.
+    """
+
+    settings_class = SemanticCacheSettings
+
+    def __init__(self, embedder=None, max_entries: int = None):
+        self.embedder = embedder or load_embedder()
+        self.max_entries = max_entries or int(os.getenv("SEMANTIC_CACHE_MAX_ENTRIES", 100000))
+        self.indexes = {}
+        self.stats = {}
+        self.hits_log = deque(maxlen=int(os.getenv("SEMANTIC_CACHE_HITS_LOG", 200)))
+        self._lock = threading.Lock()
+        planes = np.random.default_rng(0).standard_normal((SIGNATURE_BITS, self.embedder.dim))
+        self.planes = planes.astype(np.float32)
+
+    @classmethod
+    def build(cls, name: str = None) -> "SemanticCache":
+        # the index lives in process memory, every pool shares it
+        return semantic_cache
+
+    def wrap(self, provider, settings: SemanticCacheSettings):
+        if isinstance(provider, AsyncCompletionProviderInterface):
+            return AsyncCachedCompletionProvider(provider, self, settings)
+        return CachedCompletionProvider(provider, self, settings)
+
+    @staticmethod
+    def question(messages: list[dict]) -> str:
+        """The user message of a single-turn request, None when the request has history."""
+        conversation = [message for message in messages if message.get("role") != "system"]
+        if len(conversation) == 1 and conversation[0].get("role") == "user":
+            return conversation[0].get("content")
+        return None
+
+    @staticmethod
+    def namespace(provider, messages: list, model: str, tools: list, settings: SemanticCacheSettings) -> str:
+        if settings.namespace:
+            return settings.namespace
+        instructions = [message.get("content") for message in messages if message.get("role") == "system"]
+        payload = json.dumps([provider.name, model or provider.model, instructions, tools], sort_keys=True)
+        return hashlib.sha256(payload.encode()).hexdigest()[:16]
+
+    def signatures(self, vectors: np.ndarray) -> np.ndarray:
+        bits = (vectors @ self.planes.T) > 0
+        return np.packbits(bits, axis=1, bitorder="little").view(np.uint64)[:, 0]
+
+    @staticmethod
+    def radius(threshold: float) -> int:
+        # Hamming distance between signatures of two vectors at the threshold similarity, plus three sigma
+        share = math.acos(min(max(threshold, -1.0), 1.0)) / math.pi
+        return int(SIGNATURE_BITS * share + 3 * math.sqrt(SIGNATURE_BITS * share * (1 - share))) + 1
+
+    def _index(self, namespace: str) -> VectorIndex:
+        if namespace not in self.indexes:
+            self.indexes[namespace] = VectorIndex(self.embedder.dim, self.max_entries)
+        return self.indexes[namespace]
+
+    def _stats(self, namespace: str) -> SemanticCacheStats:
+        return self.stats.setdefault(namespace, SemanticCacheStats())
+
+    def search(self, namespace: str, questions: list[str], threshold: float) -> list:
+        """Batched lookup: (answer, similarity) or None for every question."""
+        vectors = self.embedder.embed(questions)
+        signatures = self.signatures(vectors)
+        with self._lock:
+            index = self._index(namespace)
+            stats = self._stats(namespace)
+            slots, scores = index.search(vectors, signatures, threshold, self.radius(threshold))
+            results = []
+            for question, slot, score in zip(questions, slots, scores):
+                if slot < 0:
+                    stats.misses += 1
+                    CACHE_LOOKUPS.labels("semantic", "miss").inc()
+                    results.append(None)
+                    continue
+                stats.hits += 1
+                CACHE_LOOKUPS.labels("semantic", "hit").inc()
+                stats.hit_similarity += float(score)
+                matched = index.questions[slot]
+                self.hits_log.append(
+                    {"namespace": namespace, "question": question, "matched": matched, "similarity": float(score)}
+                )
+                results.append((index.answers[slot], float(score)))
+        return results
+
+    def add(self, namespace: str, question: str, answer: str, ttl: float, vector: np.ndarray = None) -> None:
+        vector = vector if vector is not None else self.embedder.embed([question])[0]
+        signature = self.signatures(vector[None, :])[0]
+        with self._lock:
+            index = self._index(namespace)
+            stats = self._stats(namespace)
+            stats.stores += 1
+            stats.evictions += index.add(vector, signature, question, answer, ttl)
+
+    def lookup(self, provider, messages: list, model: str, tools: list, settings: SemanticCacheSettings) -> tuple:
+        question = self.question(messages)
+        namespace = self.namespace(provider, messages, model, tools, settings)
+        if not question:
+            with self._lock:
+                self._stats(namespace).bypassed += 1
+            return None, None
+        result = self.search(namespace, [question], settings.threshold)[0]
+        if result is not None:
+            return None, result[0]
+        return (namespace, question), None
+
+    def store(self, token: tuple, response: str, settings: SemanticCacheSettings) -> None:
+        namespace, question = token
+        self.add(namespace, question, response, settings.ttl)
+
+    async def async_lookup(self, provider, messages: list, model: str, tools: list, settings) -> tuple:
+        return self.lookup(provider, messages, model, tools, settings)
+
+    async def async_store(self, token: tuple, response: str, settings: SemanticCacheSettings) -> None:
+        self.store(token, response, settings)
+
+    def report_false_positive(self, namespace: str, question: str, threshold: float = None) -> bool:
+        """Count a wrong cached answer to `question` and evict the entry that served it."""
+        threshold = threshold or SemanticCacheSettings().threshold
+        vectors = self.embedder.embed([question])
+        with self._lock:
+            index = self.indexes.get(namespace)
+            if index is None:
+                return False
+            slots, _ = index.search(vectors, self.signatures(vectors), threshold, self.radius(threshold))
+            if slots[0] < 0:
+                return False
+            index.remove(int(slots[0]))
+            self._stats(namespace).false_positives += 1
+            return True
+
+    def report(self) -> dict:
+        with self._lock:
+            return {
+                namespace: {
+                    "size": len(self.indexes[namespace].slots) if namespace in self.indexes else 0,
+                    **stats.as_dict(),
+                }
+                for namespace, stats in self.stats.items()
+            }
+
+
+semantic_cache = SemanticCache()
@@ -0,0 +1,29 @@
+import math
+import re
+
+# words, numbers and single punctuation marks: close enough to BPE tokenizers for budgeting
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+CHARS_PER_TOKEN = 4
+MESSAGE_OVERHEAD = 4
+REPLY_OVERHEAD = 3
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast offline approximation of the number of tokens in a text.
+    Long words are split in chunks of CHARS_PER_TOKEN characters, like a BPE tokenizer does.
+    """
+    if not text:
+        return 0
+    return sum(math.ceil(len(piece) / CHARS_PER_TOKEN) for piece in TOKEN_PATTERN.findall(text))
+
+
+def estimate_message_tokens(message: dict) -> int:
+    content = message.get("content")
+    if not isinstance(content, str):
+        content = str(content or "")
+    return MESSAGE_OVERHEAD + estimate_tokens(content)
+
+
+def estimate_messages_tokens(messages: list[dict]) -> int:
+    return sum(estimate_message_tokens(message) for message in messages) + REPLY_OVERHEAD
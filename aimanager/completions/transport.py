@@ -0,0 +1,142 @@
+import asyncio
+import atexit
+import importlib.util
+import logging
+import os
+import threading
+import weakref
+
+import httpx
+
+logger = logging.getLogger("django")
+
+
+class PoolStats:
+    def __init__(self):
+        self.requests = 0
+        self.connections_opened = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "requests": self.requests,
+            "connections_opened": self.connections_opened,
+            # every request that didn't open a connection went over a kept-alive one
+            "reused": max(self.requests - self.connections_opened, 0),
+        }
+
+
+class HTTPTransport:
+    """
+    Pooled HTTP client of the async OpenAI-compatible providers, shared by all of them in a worker.
+
+    An `httpx.AsyncClient` is bound to the event loop it was first used on, so one client is kept
+    per loop. Connections are kept alive for `keepalive_expiry` seconds and multiplexed over HTTP/2
+    when the `h2` package is installed and `HTTP2` isn't "false". At most `max_connections` are open
+    at a time, a request waits up to `pool_timeout` seconds for one of them.
+    """
+
+    def __init__(
+        self,
+        http2: bool = None,
+        max_connections: int = None,
+        max_keepalive_connections: int = None,
+        keepalive_expiry: float = None,
+        connect_timeout: float = None,
+        read_timeout: float = None,
+        pool_timeout: float = None,
+        transport: httpx.AsyncBaseTransport = None,
+    ):
+        if http2 is None:
+            http2 = os.getenv("HTTP2", "true").lower() == "true"
+        if http2 and importlib.util.find_spec("h2") is None:
+            logger.warning("HTTP/2 needs the h2 package, providers use HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+        self.limits = httpx.Limits(
+            max_connections=max_connections or int(os.getenv("HTTP_MAX_CONNECTIONS", 100)),
+            max_keepalive_connections=max_keepalive_connections or int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", 20)),
+            keepalive_expiry=(
+                keepalive_expiry if keepalive_expiry is not None else float(os.getenv("HTTP_KEEPALIVE_EXPIRY", 30))
+            ),
+        )
+        connect_timeout = connect_timeout or float(os.getenv("HTTP_CONNECT_TIMEOUT", 5))
+        self.timeout = httpx.Timeout(
+            connect=connect_timeout,
+            # a slow model may be silent between chunks for a long time
+            read=read_timeout or float(os.getenv("HTTP_READ_TIMEOUT", 120)),
+            write=connect_timeout,
+            pool=pool_timeout or float(os.getenv("HTTP_POOL_TIMEOUT", 10)),
+        )
+        # a custom transport, e.g. `httpx.MockTransport` of a fake server, replaces the pool
+        self.transport = transport
+        self.stats = PoolStats()
+        self._clients = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def client(self) -> httpx.AsyncClient:
+        """The client of the running event loop."""
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            client = self._clients.get(loop)
+            if client is None or client.is_closed:
+                client = self._clients[loop] = httpx.AsyncClient(
+                    http2=self.http2,
+                    limits=self.limits,
+                    timeout=self.timeout,
+                    transport=self.transport,
+                    event_hooks={"request": [self._on_request]},
+                )
+            return client
+
+    async def _on_request(self, request: httpx.Request) -> None:
+        self.stats.requests += 1
+        request.extensions["trace"] = self._trace
+
+    async def _trace(self, event: str, info: dict) -> None:
+        if event in ("connection.connect_tcp.complete", "connection.connect_unix_socket.complete"):
+            self.stats.connections_opened += 1
+
+    async def aclose(self) -> None:
+        """Close the client of the running event loop, e.g. before `asyncio.run` returns."""
+        with self._lock:
+            client = self._clients.pop(asyncio.get_running_loop(), None)
+        if client is not None:
+            await client.aclose()
+
+    def close(self) -> None:
+        """Close the clients of loops that are still open, at worker shutdown."""
+        with self._lock:
+            clients = list(self._clients.items())
+            self._clients.clear()
+        for loop, client in clients:
+            if loop.is_closed() or client.is_closed:
+                continue
+            try:
+                if loop.is_running():
+                    asyncio.run_coroutine_threadsafe(client.aclose(), loop).result(timeout=5)
+                else:
+                    loop.run_until_complete(client.aclose())
+            except Exception as e:
+                logger.warning(f"Failed to close the HTTP client of a provider: {e}")
+
+    def pool_stats(self) -> dict:
+        """Connections of the pools of all loops: open, idle, serving requests and requests waiting for one."""
+        stats = {"open": 0, "idle": 0, "active": 0, "waiting": 0}
+        with self._lock:
+            clients = list(self._clients.values())
+        for client in clients:
+            pool = getattr(client._transport, "_pool", None)
+            if pool is None:
+                continue
+            for connection in pool.connections:
+                stats["open"] += 1
+                stats["idle" if connection.is_idle() else "active"] += 1
+            stats["waiting"] += len([request for request in getattr(pool, "_requests", []) if request.is_queued()])
+        return stats
+
+    def report(self) -> dict:
+        return {**self.stats.as_dict(), **self.pool_stats(), "http2": self.http2}
+
+
+shared_transport = HTTPTransport()
+atexit.register(shared_transport.close)
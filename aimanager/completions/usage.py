@@ -0,0 +1,95 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+_current_usage = ContextVar("completions_usage", default=None)
+
+
+def _as_int(value) -> int:
+    return value if isinstance(value, int) else 0
+
+
+def _tokens(usage) -> tuple[int, int, int]:
+    """Prompt, completion and cached prompt tokens of an OpenAI-compatible `usage` object (or dict)."""
+    if isinstance(usage, dict):
+        details = usage.get("prompt_tokens_details") or {}
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+        cached_tokens = details.get("cached_tokens")
+    else:
+        details = getattr(usage, "prompt_tokens_details", None)
+        prompt_tokens = getattr(usage, "prompt_tokens", None)
+        completion_tokens = getattr(usage, "completion_tokens", None)
+        cached_tokens = getattr(details, "cached_tokens", None)
+    return _as_int(prompt_tokens), _as_int(completion_tokens), _as_int(cached_tokens)
+
+
+class Usage:
+    """
+    Token usage accumulated over all completion calls made within `track_usage()`.
+    Calls made with a known model are also counted per (provider, model) in `models`, and
+    `rounds` counts the function-call rounds of agent tool loops.
+    """
+
+    def __init__(self, parent: "Usage" = None):
+        # usage of a nested `track_usage()` block counts for the enclosing one too
+        self.parent = parent
+        self.calls = 0
+        self.rounds = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_tokens = 0
+        self.models = {}
+
+    @property
+    def total_tokens(self) -> int:
+        return self.prompt_tokens + self.completion_tokens
+
+    def add(self, usage, provider: str = None, model: str = None) -> None:
+        """Add an OpenAI-compatible `usage` object (or dict) returned by the provider."""
+        if usage is None:
+            return
+        self._add(*_tokens(usage), provider, model)
+
+    def _add(self, prompt_tokens: int, completion_tokens: int, cached_tokens: int, provider: str, model: str) -> None:
+        self.calls += 1
+        self.prompt_tokens += prompt_tokens
+        self.completion_tokens += completion_tokens
+        self.cached_tokens += cached_tokens
+        if model is not None:
+            per_model = self.models.get((provider, model))
+            if per_model is None:
+                per_model = self.models[(provider, model)] = Usage()
+            per_model._add(prompt_tokens, completion_tokens, cached_tokens, None, None)
+        if self.parent is not None:
+            self.parent._add(prompt_tokens, completion_tokens, cached_tokens, provider, model)
+
+    def add_round(self) -> None:
+        self.rounds += 1
+        if self.parent is not None:
+            self.parent.add_round()
+
+    def as_dict(self) -> dict:
+        return {
+            "calls": self.calls,
+            "rounds": self.rounds,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_tokens": self.cached_tokens,
+            "total_tokens": self.total_tokens,
+        }
+
+
+@contextmanager
+def track_usage():
+    """Collect usage reported by providers inside the block, including nested tool-loop calls."""
+    usage = Usage(_current_usage.get())
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+
+
+def record_usage(usage, provider: str = None, model: str = None) -> None:
+    tracker = _current_usage.get()
+    if tracker is not None:
+        tracker.add(usage, provider, model)
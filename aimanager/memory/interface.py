@@ -13,13 +13,22 @@ class MemoryProviderInterface(ABC):
         pass
 
     @abstractmethod
-    def get_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> list[dict]:
+    def get_conversation(
+        self, user_id: str, agent_id: str, conversation_id: str, limit: int = None, offset: int = 0
+    ) -> list[dict]:
         pass
 
     @abstractmethod
     def delete_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
         pass
 
+    def get_summary(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
+        """Running summary `{"content": str, "covered": int}` of the first `covered` messages, if stored."""
+        return None
+
+    def set_summary(self, summary: dict, user_id: str, agent_id: str, conversation_id: str) -> None:
+        pass
+
 
 class AsyncMemoryProviderInterface(ABC):
     @abstractmethod
@@ -33,13 +42,22 @@ class AsyncMemoryProviderInterface(ABC):
         pass
 
     @abstractmethod
-    async def async_get_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> list[dict]:
+    async def async_get_conversation(
+        self, user_id: str, agent_id: str, conversation_id: str, limit: int = None, offset: int = 0
+    ) -> list[dict]:
         pass
 
     @abstractmethod
     async def async_delete_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
         pass
 
+    async def async_get_summary(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
+        """Running summary `{"content": str, "covered": int}` of the first `covered` messages, if stored."""
+        return None
+
+    async def async_set_summary(self, summary: dict, user_id: str, agent_id: str, conversation_id: str) -> None:
+        pass
+
     @abstractmethod
     async def async_close(self):
         pass
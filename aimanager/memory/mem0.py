@@ -17,7 +17,9 @@ class Mem0MemoryProvider(MemoryProviderInterface):
     def add_messages_to_conversation(self, data: list[dict], user_id: str, agent_id: str, conversation_id: str) -> dict:
         self.client.add(data, user_id=user_id, agent_id=agent_id, run_id=conversation_id)
 
-    def get_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> list[dict]:
+    def get_conversation(
+        self, user_id: str, agent_id: str, conversation_id: str, limit: int = None, offset: int = 0
+    ) -> list[dict]:
         return self.client.search(user_id=user_id, agent_id=agent_id, run_id=conversation_id)
 
     def delete_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
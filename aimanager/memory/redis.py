@@ -4,8 +4,28 @@ import os
 import redis
 import redis.asyncio as aredis
 
+from aimanager.metrics import metrics, timed
+from aimanager.tracing import traced
+
 from .interface import AsyncMemoryProviderInterface, MemoryProviderInterface
 
+MEMORY_SECONDS = metrics.histogram(
+    "memory_redis_seconds", "Latency of conversation memory reads and writes in Redis", ("access", "operation")
+)
+
+
+def _conversation_slice(data: list, limit: int = None, offset: int = 0) -> list[dict]:
+    # with an offset the start is read from the head of the list, the limit is applied afterwards
+    if offset and limit:
+        data = data[-limit:]
+    return [json.loads(item) for item in data]
+
+
+def _conversation_start(limit: int = None, offset: int = 0) -> int:
+    if offset:
+        return offset
+    return -limit if limit else 0
+
 
 class RedisMemoryProvider(MemoryProviderInterface):
     def __init__(self, *args, **kwargs):
@@ -16,19 +36,38 @@ class RedisMemoryProvider(MemoryProviderInterface):
         redis_url = kwargs.get("redis_url") or os.getenv("REDIS_URL", "redis://localhost:6379/0")
         self.client = redis.StrictRedis.from_url(redis_url)
 
+    @traced()
+    @timed(MEMORY_SECONDS.labels("write", "add_messages_to_conversation"))
     def add_messages_to_conversation(self, data: list[dict], user_id: str, agent_id: str, conversation_id: str) -> None:
         key = f"{conversation_id}:{user_id}:{agent_id}:conversation"
         json_data = [json.dumps(item) for item in data]
         self.client.rpush(key, *json_data)
 
-    def get_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> list[dict]:
+    @traced()
+    @timed(MEMORY_SECONDS.labels("read", "get_conversation"))
+    def get_conversation(
+        self, user_id: str, agent_id: str, conversation_id: str, limit: int = None, offset: int = 0
+    ) -> list[dict]:
         key = f"{conversation_id}:{user_id}:{agent_id}:conversation"
-        data = self.client.lrange(key, 0, -1)
-        return [json.loads(item) for item in data]
+        data = self.client.lrange(key, _conversation_start(limit, offset), -1)
+        return _conversation_slice(data, limit, offset)
 
+    @traced()
+    @timed(MEMORY_SECONDS.labels("write", "delete_conversation"))
     def delete_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
         key = f"{conversation_id}:{user_id}:{agent_id}:conversation"
-        self.client.delete(key)
+        self.client.delete(key, f"{conversation_id}:{user_id}:{agent_id}:summary")
+
+    @traced()
+    @timed(MEMORY_SECONDS.labels("read", "get_summary"))
+    def get_summary(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
+        data = self.client.get(f"{conversation_id}:{user_id}:{agent_id}:summary")
+        return json.loads(data) if data else None
+
+    @traced()
+    @timed(MEMORY_SECONDS.labels("write", "set_summary"))
+    def set_summary(self, summary: dict, user_id: str, agent_id: str, conversation_id: str) -> None:
+        self.client.set(f"{conversation_id}:{user_id}:{agent_id}:summary", json.dumps(summary))
 
 
 class AIORedisMemoryProvider(AsyncMemoryProviderInterface):
@@ -41,6 +80,8 @@ class AIORedisMemoryProvider(AsyncMemoryProviderInterface):
         pool = aredis.ConnectionPool.from_url(redis_url)
         self.client = aredis.Redis.from_pool(pool)
 
+    @traced()
+    @timed(MEMORY_SECONDS.labels("write", "add_messages_to_conversation"))
     async def async_add_messages_to_conversation(
         self, data: list[dict], user_id: str, agent_id: str, conversation_id: str
     ) -> None:
@@ -48,15 +89,32 @@ class AIORedisMemoryProvider(AsyncMemoryProviderInterface):
         json_data = [json.dumps(item) for item in data]
         await self.client.rpush(key, *json_data)
 
-    async def async_get_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> list[dict]:
+    @traced()
+    @timed(MEMORY_SECONDS.labels("read", "get_conversation"))
+    async def async_get_conversation(
+        self, user_id: str, agent_id: str, conversation_id: str, limit: int = None, offset: int = 0
+    ) -> list[dict]:
         key = f"{conversation_id}:{user_id}:{agent_id}:conversation"
-        data = await self.client.lrange(key, 0, -1)
-        res = [json.loads(item) for item in data]
+        data = await self.client.lrange(key, _conversation_start(limit, offset), -1)
+        res = _conversation_slice(data, limit, offset)
         return res
 
+    @traced()
+    @timed(MEMORY_SECONDS.labels("write", "delete_conversation"))
     async def async_delete_conversation(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
         key = f"{conversation_id}:{user_id}:{agent_id}:conversation"
-        await self.client.delete(key)
+        await self.client.delete(key, f"{conversation_id}:{user_id}:{agent_id}:summary")
+
+    @traced()
+    @timed(MEMORY_SECONDS.labels("read", "get_summary"))
+    async def async_get_summary(self, user_id: str, agent_id: str, conversation_id: str) -> dict:
+        data = await self.client.get(f"{conversation_id}:{user_id}:{agent_id}:summary")
+        return json.loads(data) if data else None
+
+    @traced()
+    @timed(MEMORY_SECONDS.labels("write", "set_summary"))
+    async def async_set_summary(self, summary: dict, user_id: str, agent_id: str, conversation_id: str) -> None:
+        await self.client.set(f"{conversation_id}:{user_id}:{agent_id}:summary", json.dumps(summary))
 
     async def async_close(self):
         self.client.close()
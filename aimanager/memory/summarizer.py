@@ -0,0 +1,170 @@
+import asyncio
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+
+logger = logging.getLogger("django")
+
+SUMMARY_INSTRUCTION = (
+    "You keep a running summary of a conversation between a user and an AI assistant. "
+    "Update the current summary with the new messages. Keep facts, names, numbers, decisions, "
+    "user preferences and open questions, drop greetings and small talk. "
+    "Answer with the updated summary only."
+)
+
+# summaries of the sync agent are written by these threads, never by the request thread
+summary_executor = ThreadPoolExecutor(
+    max_workers=int(os.getenv("SUMMARY_WORKERS", 2)), thread_name_prefix="conversation-summary"
+)
+
+
+def render_messages(messages: list[dict]) -> str:
+    return "\n".join(f"{message.get('role')}: {message.get('content')}" for message in messages)
+
+
+def summary_message(summary: dict) -> dict:
+    return {"role": "system", "content": f"Summary of the earlier conversation:\n{summary['content']}"}
+
+
+class ConversationSummarizer:
+    """
+    Folds older conversation messages into a running summary stored by the memory provider.
+
+    Once more than `threshold` messages follow the summary, all but the latest `keep_recent` of them
+    are folded in with one completion that sees the previous summary and the new messages only,
+    so the summary is never recomputed from the whole conversation. Zero `threshold` disables it.
+    Updates run after the assistant message is saved, off the request path. With an `admission`
+    controller (`AdmissionController`), they are admitted as background work of the tenant the turn
+    was admitted for, e.g. `bot:<id>` for a Telegram bot, `user:<user_id>` when none is given.
+    """
+
+    def __init__(self, threshold: int = None, keep_recent: int = None, model: str = None, admission=None):
+        self.threshold = threshold if threshold is not None else int(os.getenv("SUMMARY_THRESHOLD", 40))
+        self.keep_recent = keep_recent if keep_recent is not None else int(os.getenv("SUMMARY_KEEP_RECENT", 10))
+        # a cheaper model for summaries, the agent's model by default
+        self.model = model or os.getenv("SUMMARY_MODEL") or None
+        self.admission = admission
+        self.running = set()
+        # schedule() is called from request threads, the check and add on `running` must not interleave
+        self._lock = threading.Lock()
+        self.tasks = set()
+        self.updates = 0
+        self.folded_messages = 0
+        self.skipped = 0
+        self.errors = 0
+
+    def pending(self, messages: list[dict]) -> list[dict]:
+        """Messages to fold into the summary now, none while the unsummarized tail is short."""
+        if not self.threshold or len(messages) <= self.threshold:
+            return []
+        end = len(messages) - self.keep_recent
+        # the recent window has to start at a user message, an empty one folds everything
+        while 0 < end < len(messages) and messages[end].get("role") != "user":
+            end -= 1
+        return messages[:end]
+
+    def prompt(self, summary: dict, messages: list[dict]) -> list[dict]:
+        current = summary["content"] or "(empty)"
+        return [
+            {"role": "system", "content": SUMMARY_INSTRUCTION},
+            {"role": "user", "content": f"Current summary:\n{current}\n\nNew messages:\n{render_messages(messages)}"},
+        ]
+
+    def _folded(self, summary: dict, messages: list[dict], content: str) -> dict:
+        self.updates += 1
+        self.folded_messages += len(messages)
+        return {"content": content, "covered": summary["covered"] + len(messages)}
+
+    def update(self, agent, user_id: str, conversation_id: str, tenant: str = None) -> bool:
+        memory = agent.memory
+        summary = memory.get_summary(user_id, agent.name, conversation_id) or {"content": "", "covered": 0}
+        messages = memory.get_conversation(user_id, agent.name, conversation_id, offset=summary["covered"])
+        messages = self.pending(messages or [])
+        if not messages:
+            return False
+        with self._admit(tenant or f"user:{user_id}"):
+            content = agent.completions.generate_response(
+                self.prompt(summary, messages), model=self.model or agent.model
+            )
+        memory.set_summary(self._folded(summary, messages, content), user_id, agent.name, conversation_id)
+        return True
+
+    async def async_update(self, agent, user_id: str, conversation_id: str, tenant: str = None) -> bool:
+        memory = agent.memory
+        summary = await memory.async_get_summary(user_id, agent.name, conversation_id) or {"content": "", "covered": 0}
+        messages = await memory.async_get_conversation(user_id, agent.name, conversation_id, offset=summary["covered"])
+        messages = self.pending(messages or [])
+        if not messages:
+            return False
+        async with self._async_admit(tenant or f"user:{user_id}"):
+            content = await agent.completions.async_generate_response(
+                self.prompt(summary, messages), model=self.model or agent.model
+            )
+        await memory.async_set_summary(self._folded(summary, messages, content), user_id, agent.name, conversation_id)
+        return True
+
+    def _admit(self, tenant: str):
+        # summaries wait behind the chats of the worker
+        return self.admission.admit(tenant, "background") if self.admission else nullcontext()
+
+    def _async_admit(self, tenant: str):
+        return self.admission.async_admit(tenant, "background") if self.admission else nullcontext()
+
+    def _acquire(self, key: tuple) -> bool:
+        # one update per conversation at a time, otherwise the same messages are folded twice
+        if not self.threshold:
+            return False
+        with self._lock:
+            if key in self.running:
+                self.skipped += 1
+                return False
+            self.running.add(key)
+        return True
+
+    def _failed(self, key: tuple, e: Exception) -> None:
+        if self.admission is not None and isinstance(e, self.admission.Rejected):
+            # the worker is busy, the next message schedules the summary again
+            self.skipped += 1
+            return
+        self.errors += 1
+        logger.warning(f"Summary of conversation {key} failed: {e}")
+
+    def _run(self, key: tuple, agent, user_id: str, conversation_id: str, tenant: str = None) -> None:
+        try:
+            self.update(agent, user_id, conversation_id, tenant)
+        except Exception as e:
+            self._failed(key, e)
+        finally:
+            self.running.discard(key)
+
+    async def _async_run(self, key: tuple, agent, user_id: str, conversation_id: str, tenant: str = None) -> None:
+        try:
+            await self.async_update(agent, user_id, conversation_id, tenant)
+        except Exception as e:
+            self._failed(key, e)
+        finally:
+            self.running.discard(key)
+
+    def schedule(self, agent, user_id: str, conversation_id: str, tenant: str = None) -> None:
+        key = (agent.name, user_id, conversation_id)
+        if self._acquire(key):
+            summary_executor.submit(self._run, key, agent, user_id, conversation_id, tenant)
+
+    def async_schedule(self, agent, user_id: str, conversation_id: str, tenant: str = None) -> None:
+        key = (agent.name, user_id, conversation_id)
+        if self._acquire(key):
+            task = asyncio.get_running_loop().create_task(self._async_run(key, agent, user_id, conversation_id, tenant))
+            # the loop keeps only weak references to tasks
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    def as_dict(self) -> dict:
+        return {
+            "updates": self.updates,
+            "folded_messages": self.folded_messages,
+            "skipped": self.skipped,
+            "errors": self.errors,
+            "running": len(self.running),
+        }
@@ -0,0 +1,347 @@
+import atexit
+import bisect
+import functools
+import inspect
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import redis
+
+logger = logging.getLogger("django")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_RATE_BUCKETS = (1, 5, 10, 20, 40, 60, 80, 120, 160, 240, 320, 640)
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _series(name: str, labelnames: tuple, values: tuple, extra: dict = None) -> str:
+    pairs = list(zip(labelnames, values)) + list((extra or {}).items())
+    if not pairs:
+        return name
+    return name + "{" + ",".join(f'{label}="{_escape(str(value))}"' for label, value in pairs) + "}"
+
+
+class Metric:
+    """A metric of the registry; `labels(*values)` gives the series to record into."""
+
+    kind = None
+
+    def __init__(self, registry: "MetricsRegistry", name: str, help: str, labelnames: tuple = ()):
+        self.registry = registry
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        # changes since the last flush, per tuple of label values
+        self._deltas = {}
+        self._children = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values):
+        child = self._children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError(f"Metric {self.name} has labels {self.labelnames}, got {values}")
+            child = self._children.setdefault(values, self.child_class(self, tuple(str(value) for value in values)))
+        return child
+
+    def take(self) -> dict:
+        with self._lock:
+            deltas, self._deltas = self._deltas, {}
+        return deltas
+
+    def restore(self, deltas: dict) -> None:
+        for key, delta in deltas.items():
+            self._merge(key, delta)
+
+    def reset(self) -> None:
+        with self._lock:
+            self._deltas = {}
+
+
+class CounterChild:
+    __slots__ = ("metric", "key")
+
+    def __init__(self, metric: "Counter", key: tuple):
+        self.metric = metric
+        self.key = key
+
+    def inc(self, amount: float = 1) -> None:
+        metric = self.metric
+        if not metric.registry.started:
+            metric.registry.start()
+        with metric._lock:
+            metric._deltas[self.key] = metric._deltas.get(self.key, 0) + amount
+
+
+class Counter(Metric):
+    kind = "counter"
+    child_class = CounterChild
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _merge(self, key: tuple, delta: float) -> None:
+        with self._lock:
+            self._deltas[key] = self._deltas.get(key, 0) + delta
+
+    def fields(self, key: tuple, delta: float) -> dict:
+        # always a float increment, HINCRBY fails on a field that once got a fraction
+        return {json.dumps(key): float(delta)}
+
+    def render(self, values: dict) -> list[str]:
+        return [f"{_series(self.name, self.labelnames, key)} {_format_value(value)}" for key, value in values.items()]
+
+    def parse(self, fields: dict) -> dict:
+        return {tuple(json.loads(field)): float(value) for field, value in fields.items()}
+
+
+class HistogramChild:
+    __slots__ = ("metric", "key")
+
+    def __init__(self, metric: "Histogram", key: tuple):
+        self.metric = metric
+        self.key = key
+
+    def observe(self, value: float) -> None:
+        metric = self.metric
+        if not metric.registry.started:
+            metric.registry.start()
+        # counts per bucket, the last one is +Inf, then the sum of observed values
+        index = bisect.bisect_left(metric.buckets, value)
+        with metric._lock:
+            counts = metric._deltas.get(self.key)
+            if counts is None:
+                counts = metric._deltas[self.key] = [0] * (len(metric.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    @contextmanager
+    def time(self):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+    child_class = HistogramChild
+
+    def __init__(self, registry, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(registry, name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float) -> None:
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+    def _merge(self, key: tuple, delta: list) -> None:
+        with self._lock:
+            counts = self._deltas.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            for index, value in enumerate(delta):
+                counts[index] += value
+
+    def fields(self, key: tuple, delta: list) -> dict:
+        prefix = json.dumps(key)
+        fields = {f"{prefix}|{index}": count for index, count in enumerate(delta[:-1]) if count}
+        fields[f"{prefix}|sum"] = delta[-1]
+        return fields
+
+    def parse(self, fields: dict) -> dict:
+        values = {}
+        for field, value in fields.items():
+            prefix, _, part = field.rpartition("|")
+            counts = values.setdefault(tuple(json.loads(prefix)), [0] * (len(self.buckets) + 1) + [0.0])
+            if part == "sum":
+                counts[-1] = float(value)
+            elif int(part) < len(self.buckets) + 1:
+                counts[int(part)] = int(float(value))
+        return values
+
+    def render(self, values: dict) -> list[str]:
+        lines = []
+        for key, counts in values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts[:-1]):
+                cumulative += count
+                series = _series(f"{self.name}_bucket", self.labelnames, key, {"le": _format_value(bound)})
+                lines.append(f"{series} {cumulative}")
+            lines.append(f"{_series(f'{self.name}_sum', self.labelnames, key)} {_format_value(counts[-1])}")
+            lines.append(f"{_series(f'{self.name}_count', self.labelnames, key)} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """
+    Counters and histograms of the chat pipeline, summed over all worker processes.
+
+    Recording an event only updates a dict of this process under a lock. A daemon thread adds the
+    changes to Redis hashes every `flush_interval` seconds, where the series of every worker and host
+    add up, and `render()` reads them back in the Prometheus text format. A failed flush keeps its
+    changes for the next one; metrics never fail a request.
+    """
+
+    def __init__(self, redis_url: str = None, prefix: str = None, flush_interval: float = None):
+        self.redis_url = (
+            redis_url or os.getenv("METRICS_REDIS_URL") or os.getenv("REDIS_URL", "redis://localhost:6379/0")
+        )
+        self.prefix = prefix or os.getenv("METRICS_PREFIX", "metrics")
+        self.flush_interval = (
+            flush_interval if flush_interval is not None else float(os.getenv("METRICS_FLUSH_INTERVAL", 10))
+        )
+        self.metrics = {}
+        self.started = False
+        self._client = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # a forked worker starts with the changes of its parent already flushed by it
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def client(self) -> redis.StrictRedis:
+        if self._client is None:
+            self._client = redis.StrictRedis.from_url(self.redis_url)
+        return self._client
+
+    def _register(self, metric: Metric) -> Metric:
+        with self._lock:
+            existing = self.metrics.get(metric.name)
+            if existing is not None:
+                if existing.kind != metric.kind or existing.labelnames != metric.labelnames:
+                    raise ValueError(f"Metric {metric.name} is already registered with other labels")
+                return existing
+            self.metrics[metric.name] = metric
+            return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._register(Counter(self, name, help, labels))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(self, name, help, labels, buckets))
+
+    def start(self) -> None:
+        """Start the flush thread of this process on the first recorded event."""
+        if self.started or not self.flush_interval:
+            return
+        with self._lock:
+            if not self.started:
+                threading.Thread(target=self._run, name="metrics-flush", daemon=True).start()
+                self.started = True
+
+    def _after_fork(self) -> None:
+        self.started = False
+        self._client = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        for metric in self.metrics.values():
+            metric._lock = threading.Lock()
+            metric.reset()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def key(self, metric: Metric) -> str:
+        return f"{self.prefix}:{metric.name}"
+
+    def flush(self) -> bool:
+        """Add the changes of this process to Redis; False when Redis failed and they were kept."""
+        with self._flush_lock:
+            taken = [(metric, metric.take()) for metric in list(self.metrics.values())]
+            if not any(deltas for _, deltas in taken):
+                return True
+            try:
+                pipe = self.client.pipeline(transaction=False)
+                for metric, deltas in taken:
+                    for key, delta in deltas.items():
+                        for field, value in metric.fields(key, delta).items():
+                            if isinstance(value, int):
+                                pipe.hincrby(self.key(metric), field, value)
+                            else:
+                                pipe.hincrbyfloat(self.key(metric), field, value)
+                pipe.execute()
+            except redis.RedisError as e:
+                logger.warning(f"Failed to flush metrics, keeping them for the next flush: {e}")
+                for metric, deltas in taken:
+                    metric.restore(deltas)
+                return False
+            return True
+
+    def collect(self) -> dict:
+        """Series of all workers, per metric name and tuple of label values."""
+        self.flush()
+        metrics = list(self.metrics.values())
+        pipe = self.client.pipeline(transaction=False)
+        for metric in metrics:
+            pipe.hgetall(self.key(metric))
+        collected = {}
+        for metric, fields in zip(metrics, pipe.execute()):
+            fields = {field.decode(): value.decode() for field, value in fields.items()}
+            collected[metric.name] = metric.parse(fields)
+        return collected
+
+    def render(self) -> str:
+        collected = self.collect()
+        lines = []
+        for name, metric in sorted(self.metrics.items()):
+            lines.append(f"# HELP {name} {metric.help}")
+            lines.append(f"# TYPE {name} {metric.kind}")
+            lines += metric.render(dict(sorted(collected[name].items())))
+        return "\n".join(lines) + "\n"
+
+    def clear(self) -> None:
+        """Delete the series of every worker, e.g. between benchmark runs."""
+        for metric in self.metrics.values():
+            metric.reset()
+        self.client.delete(*[self.key(metric) for metric in self.metrics.values()])
+
+
+def timed(child: HistogramChild):
+    """Decorator observing the duration of each call of a function or coroutine function into a histogram."""
+
+    def decorator(func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await func(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - started)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                child.observe(time.perf_counter() - started)
+
+        return wrapper
+
+    return decorator
+
+
+metrics = MetricsRegistry()
+atexit.register(metrics.flush)
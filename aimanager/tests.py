@@ -1,12 +1,57 @@
+import asyncio
+import contextlib
+import importlib.util
+import json
+import os
+import tempfile
+import time
 import unittest
-from unittest.mock import Mock, patch
+from unittest.mock import AsyncMock, Mock, patch
+import httpx
+import openai
+import redis
 from aimanager.memory.builder import MemoryProviderBuilder
+from aimanager.completions._interface import ToolsNotSupportedError
 from aimanager.completions.builder import CompletionsClientBuilder
-from aimanager.agent.builder import LLMAgentBuilder
+from aimanager.completions.cache import CacheSettings, CachedCompletionProvider, CompletionCache, cache_key
+from aimanager.completions.coalescing import CoalescedCompletionProvider, RequestCoalescer, no_coalescing
+from aimanager.completions.hedging import Hedger
+from aimanager.completions.ratelimit import ACQUIRE_SCRIPT, Limits, RateLimiter, RateLimitTimeout
+from aimanager.completions.resilience import CircuitBreaker, CircuitOpenError, RetryPolicy, classify, retry_after
+from aimanager.completions.router import AsyncRouterProvider, Router, RouterProvider, Target
+from aimanager.completions.semantic_cache import SemanticCache, SemanticCacheSettings
+from aimanager.completions.custom_openai_api_provider import (
+    AsyncCustomOpenAIApiProvider,
+    CompletionTimer,
+    CustomOpenAIApiProvider,
+)
+from aimanager.agent.admission import AdmissionController, AdmissionRejected
+from aimanager.agent.batch import BatchRunner, RateLimitedCompletionProvider, read_checkpoint
+from aimanager.agent.builder import AgentPool, LLMAgentBuilder
 from aimanager.completions.openai import OpenAIProvider
 from aimanager.completions.lmstudio import LMStudioProvider
 from aimanager.completions.openrouter import OpenRouterProvider
-from aimanager.agent._base import BaseAgent
+from aimanager.agent._base import BaseAgent, BaseAsyncAgent
+from aimanager.agent._budget import ToolBudget
+from aimanager.agent._context import ContextWindow
+from aimanager.agent._prompt import compile_prompt
+from aimanager.completions.transport import HTTPTransport
+from aimanager.completions.tokens import estimate_messages_tokens, estimate_tokens
+from aimanager.completions.usage import record_usage, track_usage
+from aimanager.memory.summarizer import ConversationSummarizer
+from aimanager.metrics import MetricsRegistry
+from aimanager.tools import prompts
+from aimanager.tools.invoker import TOOL_SECONDS, async_trigger_functions, trigger_functions
+from aimanager.tracing import NOT_SAMPLED, FileSpanExporter, tracer
+from aimanager.tools.scheme import llm_tool
+
+try:
+    import fakeredis
+except ImportError:
+    fakeredis = None
+
+# the Redis scripts run on fakeredis when it has a Lua runtime
+LUA_REDIS = fakeredis is not None and importlib.util.find_spec("lupa") is not None
 
 
 class TestMemoryProviderBuilder(unittest.TestCase):
@@ -53,6 +98,83 @@ class TestOpenAIProvider(unittest.TestCase):
         self.assertEqual(response, "Test response")
 
 
+class TestNativeTools(unittest.TestCase):
+    def setUp(self):
+        @llm_tool("Add numbers")
+        def add(a: int, b: int = 0):
+            return a + b
+
+        self.tool = add
+
+    def tool_call(self, index=0, name=None, arguments=None):
+        call = Mock(index=index)
+        call.function.name = name
+        call.function.arguments = arguments
+        return call
+
+    def test_tool_calls_are_rendered_as_function_json(self):
+        provider = CustomOpenAIApiProvider()
+        provider.client = Mock()
+        message = Mock(content=None, tool_calls=[self.tool_call(name="add", arguments='{"a": 1, "b": 2}')])
+        provider.client.chat.completions.create.return_value.choices = [Mock(message=message)]
+        response = provider.generate_response([{"role": "user", "content": "1 + 2"}], tools=[self.tool.llm_schema])
+        self.assertEqual(json.loads(response), [{"function": "add", "parameters": {"a": 1, "b": 2}}])
+        self.assertEqual(provider.client.chat.completions.create.call_args.kwargs["tools"], [self.tool.llm_schema])
+
+    def test_streamed_tool_calls_are_merged(self):
+        chunks = [
+            Mock(choices=[Mock(delta=Mock(content=None, tool_calls=[self.tool_call(name="add", arguments='{"a"')]))]),
+            Mock(choices=[Mock(delta=Mock(content=None, tool_calls=[self.tool_call(arguments=": 1}")]))]),
+        ]
+        response = Mock()
+        response.__iter__ = Mock(return_value=iter(chunks))
+        text = "".join(CustomOpenAIApiProvider._iter_stream(response))
+        self.assertEqual(json.loads(text), [{"function": "add", "parameters": {"a": 1}}])
+        response.close.assert_called_once()
+
+    def test_stream_usage_chunk(self):
+        usage = {"prompt_tokens": 10, "completion_tokens": 2}
+        chunks = [
+            Mock(choices=[Mock(delta=Mock(content="Hi", tool_calls=None))], usage=None),
+            Mock(choices=[], usage=usage),
+        ]
+        response = Mock()
+        response.__iter__ = Mock(return_value=iter(chunks))
+        used = []
+        text = "".join(CustomOpenAIApiProvider._iter_stream(response, used.append))
+        self.assertEqual(text, "Hi")
+        self.assertEqual(used, [usage])
+        provider = CustomOpenAIApiProvider()
+        kwargs = provider._request_kwargs([], "gpt", True, None)
+        self.assertEqual(kwargs["stream_options"], {"include_usage": True})
+        self.assertNotIn("stream_options", provider._request_kwargs([], "gpt", False, None))
+
+    def test_native_prompt_skips_function_instruction(self):
+        compiled = compile_prompt("Be brief", (self.tool,), True)
+        self.assertEqual(compiled.message["content"], "Be brief")
+        self.assertFalse(compiled.tools[0]["function"]["strict"])
+
+    def test_agent_falls_back_to_prompt_protocol(self):
+        memory = Mock()
+        memory.get_conversation.return_value = []
+        memory.get_summary.return_value = None
+        completions = Mock()
+        unsupported = []
+        completions.supports_tools.side_effect = lambda model: not unsupported
+
+        def generate_response(messages, model=None, stream=False, tools=None):
+            if tools:
+                unsupported.append(True)
+                raise ToolsNotSupportedError("tools are not supported")
+            self.assertIn(prompts.FUNCTION_INSTRUCTION, messages[0]["content"])
+            return "Hello"
+
+        completions.generate_response.side_effect = generate_response
+        agent = BaseAgent(memory=memory, completions=completions, tools=[self.tool])
+        self.assertEqual(agent.generate_response("Hi", "user123"), "Hello")
+        self.assertEqual(completions.generate_response.call_count, 2)
+
+
 class TestBaseAgent(unittest.TestCase):
     def setUp(self):
         self.agent = BaseAgent()
@@ -66,6 +188,7 @@ class TestBaseAgent(unittest.TestCase):
     def test_generate_response(self, mock_memory_builder, mock_completions_builder):
         mock_memory = Mock()
         mock_memory.get_conversation.return_value = []
+        mock_memory.get_summary.return_value = None
         mock_memory_builder.build.return_value = mock_memory
 
         mock_completions = Mock()
@@ -76,6 +199,61 @@ class TestBaseAgent(unittest.TestCase):
         response = agent.generate_response("test prompt", "user123")
         self.assertEqual(response, "Test response")
 
+    @patch("aimanager.agent._base.CompletionsClientBuilder")
+    @patch("aimanager.agent._base.MemoryProviderBuilder")
+    def test_generate_response_stream_with_tool(self, mock_memory_builder, mock_completions_builder):
+        mock_memory = Mock()
+        mock_memory.get_conversation.return_value = []
+        mock_memory.get_summary.return_value = None
+        mock_memory_builder.build.return_value = mock_memory
+        streams = [
+            (chunk for chunk in ['{"function": "add", ', '"parameters": {"a": 1, "b": 2}}']),
+            (chunk for chunk in ["The sum ", "is 3"]),
+        ]
+        mock_completions = Mock()
+        mock_completions.generate_response.side_effect = lambda *args, **kwargs: streams.pop(0)
+        mock_completions_builder.build.return_value = mock_completions
+
+        @llm_tool("Add numbers")
+        async def add(a: int, b: int):
+            return a + b
+
+        agent = BaseAgent(tools=[add])
+        chunks = list(agent.generate_response_stream("What is 1 + 2?", "user123"))
+        self.assertEqual(chunks, ["The sum ", "is 3"])
+        follow_up = mock_completions.generate_response.call_args_list[1].args[0]
+        self.assertIn("returned: 3", follow_up[-1]["content"])
+        mock_memory.add_messages_to_conversation.assert_called_with(
+            [{"role": "assistant", "content": "The sum is 3"}], "user123", "base", None
+        )
+
+    @patch("aimanager.agent._base.CompletionsClientBuilder")
+    @patch("aimanager.agent._base.MemoryProviderBuilder")
+    def test_generate_response_with_multiple_tools(self, mock_memory_builder, mock_completions_builder):
+        mock_memory_builder.build.return_value.get_conversation.return_value = []
+        responses = [
+            '[{"function": "create_lead", "parameters": {}}, {"function": "notify_manager", "parameters": {}}]',
+            "Done",
+        ]
+        mock_completions = Mock()
+        mock_completions.generate_response.side_effect = lambda *args, **kwargs: responses.pop(0)
+        mock_completions_builder.build.return_value = mock_completions
+
+        @llm_tool("Create lead")
+        async def create_lead():
+            return "Lead created"
+
+        @llm_tool("Notify manager")
+        def notify_manager():
+            return "Manager notified"
+
+        agent = BaseAgent(tools=[create_lead, notify_manager])
+        self.assertEqual(agent.generate_response("Sign me up", "user123"), "Done")
+        self.assertEqual(mock_completions.generate_response.call_count, 2)
+        follow_up = mock_completions.generate_response.call_args_list[1].args[0]
+        self.assertIn("returned: Lead created", follow_up[-2]["content"])
+        self.assertIn("returned: Manager notified", follow_up[-1]["content"])
+
     def test_clear_conversation(self):
         with patch.object(self.agent.memory, "delete_conversation", return_value=True):
             result = self.agent.clear_conversation("user123")
@@ -92,5 +270,1300 @@ class TestLLMAgentBuilder(unittest.TestCase):
             LLMAgentBuilder.build(None)
 
 
+class TestToolBudget(unittest.TestCase):
+    def build_agent(self, responses, budget):
+        memory = AsyncMock()
+        memory.async_get_conversation.return_value = []
+        memory.async_get_summary.return_value = None
+        completions = Mock()
+        completions.async_generate_response = AsyncMock(side_effect=responses)
+
+        @llm_tool("Create record")
+        async def create_record():
+            return "created"
+
+        return BaseAsyncAgent(memory=memory, completions=completions, tools=[create_record], tool_budget=budget)
+
+    def test_max_rounds(self):
+        call = '{"function": "create_record", "parameters": {}}'
+        agent = self.build_agent([call] * 10, ToolBudget(max_rounds=2, tool_timeout=0, turn_timeout=0))
+        response = asyncio.run(agent.async_generate_response("Create records", "user123"))
+        self.assertEqual(response, prompts.BUDGET_EXHAUSTED_REPLY)
+        # 2 tool rounds, 1 follow-up telling the model to stop
+        self.assertEqual(agent.completions.async_generate_response.call_count, 4)
+        last_messages = agent.completions.async_generate_response.call_args.args[0]
+        self.assertIn('"reason": "max_rounds"', last_messages[-1]["content"])
+        self.assertEqual(agent.budget_stats.as_dict()["exhausted"], {"max_rounds": 1})
+        self.assertEqual(agent.budget_stats.rounds, 2)
+
+    def test_model_answers_after_exhaustion(self):
+        call = '{"function": "create_record", "parameters": {}}'
+        agent = self.build_agent([call, call, "Created one record"], ToolBudget(max_rounds=1))
+        response = asyncio.run(agent.async_generate_response("Create records", "user123"))
+        self.assertEqual(response, "Created one record")
+
+    def test_token_budget(self):
+        budget = ToolBudget(max_rounds=0, max_tokens=100).start(Mock(total_tokens=150))
+        self.assertTrue(budget.check())
+        self.assertEqual(budget.exhausted, "tokens")
+
+    def test_tool_timeout_capped_by_deadline(self):
+        budget = ToolBudget(tool_timeout=30, turn_timeout=5).start()
+        self.assertLessEqual(budget.tool_timeout(), 5)
+        self.assertIsNone(ToolBudget(tool_timeout=0, turn_timeout=0).start().tool_timeout())
+
+
+class TestContextWindow(unittest.TestCase):
+    def history(self, turns, words=50):
+        messages = []
+        for turn in range(turns):
+            messages.append({"role": "user", "content": f"question {turn} " + "word " * words})
+            messages.append({"role": "assistant", "content": f"answer {turn} " + "word " * words})
+        return messages
+
+    def test_short_history_is_kept(self):
+        window = ContextWindow(max_tokens=8000, keep_last=4)
+        history = self.history(3)
+        kept, report = window.fit(
+            [{"role": "system", "content": "Be brief"}], history, [{"role": "user", "content": "Hi"}]
+        )
+        self.assertEqual(kept, history)
+        self.assertEqual(report.saved_tokens, 0)
+
+    def test_old_turns_are_dropped(self):
+        window = ContextWindow(max_tokens=400, keep_last=2)
+        history = self.history(10)
+        kept, report = window.fit(
+            [{"role": "system", "content": "Be brief"}], history, [{"role": "user", "content": "Hi"}]
+        )
+        self.assertEqual(kept[-2:], history[-2:])
+        self.assertEqual(kept[0]["role"], "user")
+        self.assertLessEqual(report.tokens, 400)
+        self.assertGreater(report.saved_tokens, 0)
+        self.assertEqual(report.dropped_messages, len(history) - len(kept))
+
+    def test_latest_turns_are_kept_over_budget(self):
+        window = ContextWindow(max_tokens=10, keep_last=2)
+        history = self.history(2)
+        kept, _ = window.fit([], history, [{"role": "user", "content": "Hi"}])
+        self.assertEqual(kept, history[-2:])
+
+    def test_long_old_messages_are_compressed(self):
+        window = ContextWindow(max_tokens=8000, keep_last=2, max_message_tokens=20)
+        history = self.history(1, words=200) + self.history(1)
+        kept, report = window.fit([], history, [])
+        self.assertEqual(report.compressed_messages, 2)
+        self.assertTrue(kept[0]["content"].endswith("…"))
+        self.assertEqual(kept[-2:], history[-2:])
+
+    def test_per_model_budget(self):
+        window = ContextWindow(max_tokens=1000, model_budgets={"small": 100})
+        self.assertEqual(window.budget_for("small"), 100)
+        self.assertEqual(window.budget_for("gpt-4o-mini"), 1000)
+
+
+class FakeAsyncMemory:
+    def __init__(self, messages=None, summary=None):
+        self.messages = list(messages or [])
+        self.summary = summary
+
+    async def async_get_conversation(self, user_id, agent_id, conversation_id, limit=None, offset=0):
+        messages = self.messages[offset:]
+        return messages[-limit:] if limit else messages
+
+    async def async_add_messages_to_conversation(self, data, user_id, agent_id, conversation_id):
+        self.messages += data
+
+    async def async_get_summary(self, user_id, agent_id, conversation_id):
+        return self.summary
+
+    async def async_set_summary(self, summary, user_id, agent_id, conversation_id):
+        self.summary = summary
+
+
+class TestAsyncAgentEvents(unittest.TestCase):
+    def build_agent(self, streams, tools=None):
+        def generate_stream(*args, **kwargs):
+            async def stream(chunks):
+                for chunk in chunks:
+                    await asyncio.sleep(0)
+                    yield chunk
+
+            return stream(streams.pop(0))
+
+        completions = Mock()
+        completions.supports_tools.return_value = False
+        completions.async_generate_response_stream = generate_stream
+        summarizer = ConversationSummarizer(threshold=0)
+        return BaseAsyncAgent(memory=FakeAsyncMemory(), completions=completions, summarizer=summarizer, tools=tools)
+
+    def test_events_of_a_tool_turn(self):
+        @llm_tool("Add numbers")
+        def add(a: int, b: int):
+            return a + b
+
+        streams = [['{"function": "add", ', '"parameters": {"a": 1, "b": 2}}'], ["The sum ", "is 3"]]
+        agent = self.build_agent(streams, tools=[add])
+
+        async def collect():
+            return [event async for event in agent.async_generate_events("What is 1 + 2?", "user123")]
+
+        events = asyncio.run(collect())
+        self.assertEqual([event["type"] for event in events], ["tool", "delta", "delta", "usage"])
+        self.assertEqual(events[0]["name"], "add")
+        self.assertEqual(agent.memory.messages[-1], {"role": "assistant", "content": "The sum is 3"})
+
+    def test_partial_answer_is_saved_when_consumer_leaves(self):
+        agent = self.build_agent([["Once ", "upon ", "a time"]])
+
+        async def read_two():
+            events = agent.async_generate_events("Tell a story", "user123")
+            chunks = [(await anext(events))["content"], (await anext(events))["content"]]
+            await events.aclose()
+            return chunks
+
+        self.assertEqual(asyncio.run(read_two()), ["Once ", "upon "])
+        self.assertEqual(agent.memory.messages[-1], {"role": "assistant", "content": "Once upon "})
+
+
+class TestConversationSummarizer(unittest.TestCase):
+    def history(self, turns, start=0):
+        messages = []
+        for turn in range(start, start + turns):
+            messages.append({"role": "user", "content": f"question {turn}"})
+            messages.append({"role": "assistant", "content": f"answer {turn}"})
+        return messages
+
+    def build_agent(self, memory, responses):
+        completions = Mock()
+        completions.async_generate_response = AsyncMock(side_effect=responses)
+        summarizer = ConversationSummarizer(threshold=6, keep_recent=2)
+        return BaseAsyncAgent(memory=memory, completions=completions, summarizer=summarizer)
+
+    def test_short_conversation_is_not_summarized(self):
+        agent = self.build_agent(FakeAsyncMemory(self.history(3)), [])
+        self.assertFalse(asyncio.run(agent.summarizer.async_update(agent, "user123", None)))
+        agent.completions.async_generate_response.assert_not_called()
+
+    def test_summary_is_updated_incrementally(self):
+        memory = FakeAsyncMemory(self.history(4))
+        agent = self.build_agent(memory, ["first summary", "second summary"])
+        self.assertTrue(asyncio.run(agent.summarizer.async_update(agent, "user123", None)))
+        self.assertEqual(memory.summary, {"content": "first summary", "covered": 6})
+
+        memory.messages += self.history(3, start=4)
+        self.assertTrue(asyncio.run(agent.summarizer.async_update(agent, "user123", None)))
+        prompt = agent.completions.async_generate_response.call_args.args[0][-1]["content"]
+        self.assertIn("first summary", prompt)
+        self.assertNotIn("question 2", prompt)
+        self.assertIn("question 3", prompt)
+        self.assertEqual(memory.summary, {"content": "second summary", "covered": 12})
+        self.assertEqual(agent.summarizer.as_dict()["folded_messages"], 12)
+
+    def test_rejected_update_is_skipped(self):
+        agent = self.build_agent(FakeAsyncMemory(self.history(4)), ["summary"])
+        agent.summarizer.admission = Mock(Rejected=AdmissionRejected)
+        agent.summarizer.admission.async_admit.side_effect = AdmissionRejected("overload", 1)
+
+        async def run():
+            agent.summarizer.async_schedule(agent, "user123", None)
+            await asyncio.gather(*agent.summarizer.tasks)
+
+        asyncio.run(run())
+        agent.summarizer.admission.async_admit.assert_called_once_with("user:user123", "background")
+        self.assertEqual((agent.summarizer.skipped, agent.summarizer.errors), (1, 0))
+        agent.completions.async_generate_response.assert_not_called()
+
+    def test_summary_of_bot_turn_is_admitted_for_the_bot(self):
+        memory = FakeAsyncMemory(self.history(4))
+        agent = self.build_agent(memory, ["Hello", "summary"])
+        agent.summarizer.admission = Mock(Rejected=AdmissionRejected)
+        agent.summarizer.admission.async_admit.return_value = contextlib.nullcontext()
+
+        async def turn():
+            await agent.async_generate_response("Hi", "12345", "7", tenant="bot:7")
+            await asyncio.gather(*agent.summarizer.tasks)
+
+        asyncio.run(turn())
+        self.assertEqual(memory.summary["content"], "summary")
+        agent.summarizer.admission.async_admit.assert_called_once_with("bot:7", "background")
+
+    def test_pending_without_recent_window(self):
+        messages = self.history(4) + [{"role": "user", "content": "question 4"}]
+        self.assertEqual(ConversationSummarizer(threshold=6, keep_recent=0).pending(messages), messages)
+        self.assertEqual(ConversationSummarizer(threshold=6, keep_recent=2).pending(messages), messages[:6])
+
+    def test_compose_sends_summary_and_recent_messages(self):
+        memory = FakeAsyncMemory(self.history(4), summary={"content": "earlier talk", "covered": 6})
+        agent = self.build_agent(memory, [])
+        messages = asyncio.run(agent._compose_messages_list("Hi", "user123", None))
+        self.assertIn("earlier talk", messages[1]["content"])
+        self.assertEqual(messages[2:], self.history(1, start=3) + [{"role": "user", "content": "Hi"}])
+
+    def test_update_runs_after_the_turn(self):
+        memory = FakeAsyncMemory(self.history(4))
+        agent = self.build_agent(memory, ["Hello", "summary"])
+
+        async def turn():
+            response = await agent.async_generate_response("Hi", "user123")
+            await asyncio.gather(*agent.summarizer.tasks)
+            return response
+
+        self.assertEqual(asyncio.run(turn()), "Hello")
+        self.assertEqual(memory.summary, {"content": "summary", "covered": 8})
+
+
+class FakeBatchAgent:
+    def __init__(self, answer):
+        self.answer = answer
+        self.completions = Mock()
+        self.completions.name = "openai"
+        self.completions.async_generate_response = AsyncMock(return_value="")
+
+    async def async_generate_response(self, prompt, user_id, conversation_id=None):
+        # a tool round and the final answer
+        for _ in range(2):
+            await self.completions.async_generate_response([{"role": "user", "content": prompt}])
+        return await self.answer(prompt, user_id, conversation_id)
+
+
+class TestBatchRunner(unittest.TestCase):
+    def setUp(self):
+        self.output = os.path.join(tempfile.mkdtemp(), "results.jsonl")
+        self.running = 0
+        self.max_running = 0
+        self.agent = FakeBatchAgent(self.answer)
+
+    async def answer(self, prompt, user_id, conversation_id=None):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        await asyncio.sleep(0.01)
+        self.running -= 1
+        if prompt == "fail":
+            raise ConnectionError("upstream failed")
+        record_usage({"prompt_tokens": 10, "completion_tokens": 5})
+        return prompt.upper()
+
+    async def resolve_agent(self, record):
+        return self.agent
+
+    def run_batch(self, records, **kwargs):
+        runner = BatchRunner(self.resolve_agent, **kwargs)
+        return asyncio.run(runner.run(records, self.output))
+
+    def results(self):
+        with open(self.output) as file:
+            return [json.loads(line) for line in file]
+
+    def test_answers_with_bounded_concurrency(self):
+        records = [{"id": index, "user": "u", "prompt": f"p{index}"} for index in range(10)]
+        records.append({"id": 10, "user": "u", "prompt": "fail"})
+        stats = self.run_batch(records, concurrency=3)
+        self.assertEqual(self.max_running, 3)
+        self.assertEqual((stats["done"], stats["failed"]), (10, 1))
+        self.assertEqual(stats["prompt_tokens"], 100)
+        results = {result["id"]: result for result in self.results()}
+        self.assertEqual(results[2]["response"], "P2")
+        self.assertEqual(results[2]["usage"]["total_tokens"], 15)
+        self.assertIn("upstream failed", results[10]["error"])
+
+    def test_resume_from_checkpoint(self):
+        with open(self.output, "w") as file:
+            file.write(json.dumps({"id": 1, "response": "P1", "usage": {}}) + "\n")
+            file.write(json.dumps({"id": 2, "error": "failed", "usage": {}}) + "\n")
+            file.write('{"id": 3, "resp')
+        self.assertEqual(read_checkpoint(self.output), {1})
+
+        records = [{"id": index, "user": "u", "prompt": f"p{index}"} for index in (1, 2, 3)]
+        stats = self.run_batch(records, concurrency=2)
+        self.assertEqual((stats["done"], stats["skipped"]), (2, 1))
+        self.assertEqual([result["id"] for result in self.results()[2:]], [2, 3])
+
+    def test_rate_limit_per_provider(self):
+        records = [{"id": index, "user": "u", "prompt": "p"} for index in range(2)]
+        stats = self.run_batch(records, concurrency=1, rate_limits={"openai": 600})
+        # one completion call every 0.1s after the first, two calls per record
+        self.assertGreaterEqual(stats["elapsed"] + 0.05, 0.3)
+        self.assertEqual(self.agent.completions.async_generate_response.await_count, 4)
+        # the shared agent is left as it was, the limiter belongs to the run
+        self.assertNotIsInstance(self.agent.completions, RateLimitedCompletionProvider)
+
+
+class TestCompiledPrompt(unittest.TestCase):
+    def setUp(self):
+        @llm_tool("Test tool")
+        def lookup(query: str):
+            return query
+
+        self.tool = lookup
+
+    def test_reuses_message_for_same_version(self):
+        first = compile_prompt("Be brief", (self.tool,))
+        second = compile_prompt("Be brief", (self.tool,))
+        self.assertIs(first.message, second.message)
+        self.assertIn('"name": "lookup"', first.message["content"])
+
+    def test_new_version_on_prompt_change(self):
+        first = compile_prompt("Be brief", (self.tool,))
+        second = compile_prompt("Be verbose", (self.tool,))
+        self.assertNotEqual(first.fingerprint, second.fingerprint)
+
+    def test_without_tools(self):
+        compiled = compile_prompt("Be brief")
+        self.assertEqual(compiled.message, {"role": "system", "content": "Be brief"})
+        self.assertGreater(compiled.tokens, 0)
+
+    @patch("aimanager.agent._base.CompletionsClientBuilder")
+    @patch("aimanager.agent._base.MemoryProviderBuilder")
+    def test_agent_reports_cached_tokens(self, mock_memory_builder, mock_completions_builder):
+        mock_memory_builder.build.return_value.get_conversation.return_value = []
+
+        def generate_response(messages, **kwargs):
+            record_usage({"prompt_tokens": 100, "completion_tokens": 5, "prompt_tokens_details": {"cached_tokens": 64}})
+            return "Test response"
+
+        mock_completions_builder.build.return_value.generate_response.side_effect = generate_response
+        agent = BaseAgent(system_prompt="Be brief")
+        agent.generate_response("test prompt", "user123")
+        report = agent.prompt_report()
+        self.assertEqual(report["turns"], 1)
+        self.assertEqual(report["cached_turns"], 1)
+        self.assertEqual(report["cached_tokens"], 64)
+        self.assertEqual(report["compiled_prompt_tokens"], agent.compiled_prompt.tokens)
+
+
+class TestTokens(unittest.TestCase):
+    def test_estimate_tokens(self):
+        self.assertEqual(estimate_tokens(""), 0)
+        self.assertEqual(estimate_tokens("Hello, world!"), 6)
+        self.assertEqual(estimate_tokens("internationalization"), 5)
+
+    def test_estimate_messages_tokens(self):
+        messages = [{"role": "user", "content": "Hello"}]
+        self.assertEqual(estimate_messages_tokens(messages), 9)
+
+    def test_track_usage_outside_scope_is_noop(self):
+        record_usage({"prompt_tokens": 10})
+        with track_usage() as usage:
+            record_usage({"prompt_tokens": 10, "completion_tokens": 2})
+        self.assertEqual(usage.total_tokens, 12)
+
+    def test_usage_per_model_and_rounds(self):
+        with track_usage() as turn:
+            with track_usage() as inner:
+                record_usage({"prompt_tokens": 10, "completion_tokens": 2}, "openai", "gpt-4o-mini")
+                inner.add_round()
+                cached = {"prompt_tokens": 20, "completion_tokens": 3, "prompt_tokens_details": {"cached_tokens": 8}}
+                record_usage(cached, "openai", "gpt-4o-mini")
+            record_usage({"prompt_tokens": 5, "completion_tokens": 1}, "openrouter", "llama")
+        self.assertEqual(turn.as_dict()["rounds"], 1)
+        self.assertEqual(turn.calls, 3)
+        per_model = turn.models[("openai", "gpt-4o-mini")].as_dict()
+        self.assertEqual(per_model["calls"], 2)
+        self.assertEqual(per_model["cached_tokens"], 8)
+        self.assertEqual(turn.models[("openrouter", "llama")].total_tokens, 6)
+        self.assertEqual(list(inner.models), [("openai", "gpt-4o-mini")])
+
+
+class FakeRedisCompletionCache(CompletionCache):
+    def connect(self):
+        client = Mock()
+        client.get.return_value = None
+        client.pipeline.return_value.execute.return_value = [True, 1, 1]
+        return client
+
+
+class TestCompletionCache(unittest.TestCase):
+    def setUp(self):
+        self.provider = Mock()
+        self.provider.name = "openai"
+        self.provider.model = "gpt-4o-mini"
+        self.cache = FakeRedisCompletionCache(max_entries=10, local_size=10)
+        self.completions = CachedCompletionProvider(self.provider, self.cache, CacheSettings(ttl=60))
+        self.messages = [{"role": "system", "content": "Be brief"}, {"role": "user", "content": "What do you offer?"}]
+
+    def test_key_is_normalized(self):
+        same = [{"role": "system", "content": "Be  brief "}, {"role": "user", "content": "what do you offer?"}]
+        self.assertEqual(cache_key("openai", "m", self.messages), cache_key("openai", "m", same))
+        self.assertNotEqual(cache_key("openai", "m", self.messages), cache_key("openai", "other", self.messages))
+        self.assertNotEqual(cache_key("openai", "m", self.messages), cache_key("openai", "m", self.messages, [{}]))
+
+    def test_repeated_request_is_served_from_cache(self):
+        self.provider.generate_response.return_value = "We offer websites"
+        self.assertEqual(self.completions.generate_response(self.messages), "We offer websites")
+        self.assertEqual(self.completions.generate_response(self.messages), "We offer websites")
+        self.provider.generate_response.assert_called_once()
+        self.cache.client.pipeline.return_value.set.assert_called_once()
+        stats = self.cache.stats.as_dict()
+        self.assertEqual((stats["hits"], stats["local_hits"], stats["misses"]), (1, 1, 1))
+
+    def test_stream_is_stored_and_served(self):
+        self.provider.generate_response.return_value = (chunk for chunk in ["We offer ", "websites"])
+        self.assertEqual(
+            list(self.completions.generate_response(self.messages, stream=True)), ["We offer ", "websites"]
+        )
+        self.assertEqual(list(self.completions.generate_response(self.messages, stream=True)), ["We offer websites"])
+        self.provider.generate_response.assert_called_once()
+
+    def test_function_calls_are_not_stored(self):
+        self.provider.generate_response.return_value = '{"function": "create_lead", "parameters": {}}'
+        self.completions.generate_response(self.messages)
+        self.completions.generate_response(self.messages)
+        self.assertEqual(self.provider.generate_response.call_count, 2)
+        self.assertEqual(self.cache.stats.stores, 0)
+
+    def test_settings_from_metadata(self):
+        self.assertIsNone(CacheSettings.from_metadata(None))
+        self.assertIsNone(CacheSettings.from_metadata({"completion_cache": {"enabled": False}}))
+        self.assertEqual(CacheSettings.from_metadata({"completion_cache": {"ttl": 30}}).ttl, 30)
+        self.assertIsNotNone(CacheSettings.from_metadata({"completion_cache": True}))
+
+
+class TestSemanticCache(unittest.TestCase):
+    def setUp(self):
+        self.provider = Mock()
+        self.provider.name = "openai"
+        self.provider.model = "gpt-4o-mini"
+        self.cache = SemanticCache(max_entries=2)
+        self.settings = SemanticCacheSettings(threshold=0.85, namespace="sales")
+        self.completions = CachedCompletionProvider(self.provider, self.cache, self.settings)
+
+    def ask(self, question, history=()):
+        messages = [{"role": "system", "content": "Be brief"}, *history, {"role": "user", "content": question}]
+        return self.completions.generate_response(messages)
+
+    def test_similar_question_is_served_from_cache(self):
+        self.provider.generate_response.side_effect = ["We build websites", "From $500"]
+        self.assertEqual(self.ask("What services do you offer?"), "We build websites")
+        self.assertEqual(self.ask("what services do you offer, please"), "We build websites")
+        self.assertEqual(self.ask("How much does a logo cost?"), "From $500")
+        report = self.cache.report()["sales"]
+        self.assertEqual((report["hits"], report["misses"], report["stores"]), (1, 2, 2))
+        self.assertEqual(self.cache.hits_log[-1]["matched"], "What services do you offer?")
+
+    def test_requests_with_history_bypass_cache(self):
+        self.provider.generate_response.return_value = "Sure"
+        history = [{"role": "user", "content": "Hi"}, {"role": "assistant", "content": "Hello"}]
+        self.ask("What services do you offer?", history)
+        self.ask("What services do you offer?", history)
+        self.assertEqual(self.provider.generate_response.call_count, 2)
+        self.assertEqual(self.cache.report()["sales"]["bypassed"], 2)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for question in ["What services do you offer?", "Where is your office?"]:
+            self.cache.add("sales", question, question, ttl=60)
+        self.cache.search("sales", ["What services do you offer?"], 0.85)
+        self.cache.add("sales", "How much does a logo cost?", "From $500", ttl=60)
+        self.assertEqual(self.cache.report()["sales"]["evictions"], 1)
+        self.assertIsNone(self.cache.search("sales", ["Where is your office?"], 0.85)[0])
+        self.assertIsNotNone(self.cache.search("sales", ["What services do you offer?"], 0.85)[0])
+
+    def test_false_positive_is_evicted(self):
+        self.cache.add("sales", "What services do you offer?", "We build websites", ttl=60)
+        self.assertTrue(self.cache.report_false_positive("sales", "what services do you offer, please"))
+        self.assertIsNone(self.cache.search("sales", ["What services do you offer?"], 0.85)[0])
+        self.assertEqual(self.cache.report()["sales"]["false_positives"], 1)
+
+
+class TestRequestCoalescing(unittest.TestCase):
+    def setUp(self):
+        self.calls = 0
+        self.provider = Mock()
+        self.provider.name = "openai"
+        self.provider.model = "gpt-4o-mini"
+        self.provider.async_generate_response = self.generate
+        self.provider.async_generate_response_stream = self.generate_stream
+        self.coalescer = RequestCoalescer()
+        self.coalescer.client = None
+        self.completions = CoalescedCompletionProvider(self.provider, self.coalescer)
+        self.messages = [{"role": "user", "content": "What do you offer?"}]
+
+    async def generate(self, messages, model=None, stream=False, tools=None):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return "Websites"
+
+    async def generate_stream(self, messages, model=None, stream=False, tools=None):
+        self.calls += 1
+        for chunk in ["Web", "sites"]:
+            await asyncio.sleep(0.01)
+            yield chunk
+
+    async def collect(self):
+        return [chunk async for chunk in self.completions.async_generate_response_stream(self.messages)]
+
+    def test_identical_requests_share_one_call(self):
+        async def run():
+            return await asyncio.gather(*(self.completions.async_generate_response(self.messages) for _ in range(3)))
+
+        self.assertEqual(asyncio.run(run()), ["Websites"] * 3)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(self.coalescer.report()["deduplicated"], 2)
+        self.assertEqual(self.coalescer.report()["in_flight"], 0)
+
+    def test_streams_share_chunks(self):
+        async def run():
+            return await asyncio.gather(self.collect(), self.collect())
+
+        self.assertEqual(asyncio.run(run()), [["Web", "sites"], ["Web", "sites"]])
+        self.assertEqual(self.calls, 1)
+
+    def test_opt_out(self):
+        async def run():
+            with no_coalescing():
+                return await asyncio.gather(self.collect(), self.collect())
+
+        asyncio.run(run())
+        self.assertEqual(self.calls, 2)
+
+    def test_closed_consumer_does_not_stop_others(self):
+        async def first_chunk():
+            stream = self.completions.async_generate_response_stream(self.messages)
+            chunk = await anext(stream)
+            await stream.aclose()
+            return chunk
+
+        async def run():
+            return await asyncio.gather(first_chunk(), self.collect())
+
+        self.assertEqual(asyncio.run(run()), ["Web", ["Web", "sites"]])
+        self.assertEqual(self.calls, 1)
+
+    @unittest.skipUnless(LUA_REDIS, "needs fakeredis and lupa")
+    def test_release_keeps_lease_of_another_worker(self):
+        async def run():
+            self.coalescer.client = fakeredis.aioredis.FakeRedis()
+            await self.coalescer.client.set("coalesce:lease:key", "other")
+            await self.coalescer._release("key", "mine")
+            kept = await self.coalescer.client.get("coalesce:lease:key")
+            await self.coalescer._release("key", "other")
+            return kept, await self.coalescer.client.exists("coalesce:lease:key")
+
+        self.assertEqual(asyncio.run(run()), (b"other", 0))
+        self.assertEqual(self.coalescer.report()["errors"], 0)
+
+    @unittest.skipUnless(LUA_REDIS, "needs fakeredis and lupa")
+    def test_other_worker_follows_the_lease_holder(self):
+        follower = RequestCoalescer()
+        remote = CoalescedCompletionProvider(self.provider, follower)
+
+        async def follow():
+            await asyncio.sleep(0.005)
+            return [chunk async for chunk in remote.async_generate_response_stream(self.messages)]
+
+        async def run():
+            server = fakeredis.FakeServer()
+            self.coalescer.client = fakeredis.aioredis.FakeRedis(server=server)
+            follower.client = fakeredis.aioredis.FakeRedis(server=server)
+            answers = await asyncio.gather(self.collect(), follow())
+            return answers, await self.coalescer.client.keys("coalesce:lease:*")
+
+        self.assertEqual(asyncio.run(run()), ([["Web", "sites"], ["Web", "sites"]], []))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(follower.report()["remote_followers"], 1)
+        self.assertEqual(self.coalescer.report()["published"], 1)
+
+
+class FakeTarget:
+    def __init__(self, name, chunks=None, error=None, fail_after=None, delay=0.0):
+        self.name = name
+        self.model = f"{name}-model"
+        self.chunks = chunks or [f"{name} answer"]
+        self.error = error
+        self.fail_after = fail_after
+        self.delay = delay
+        self.calls = 0
+
+    def supports_tools(self, model=None):
+        return True
+
+    def generate_response(self, messages=None, model=None, stream=False, tools=None):
+        self.calls += 1
+        if self.error and self.fail_after is None:
+            raise self.error
+        return (chunk for chunk in self.chunks) if stream else "".join(self.chunks)
+
+    async def async_generate_response_stream(self, messages=None, model=None, stream=False, tools=None):
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        for index, chunk in enumerate(self.chunks):
+            if self.error and index == (self.fail_after or 0):
+                raise self.error
+            yield chunk
+
+
+class TestRouter(unittest.TestCase):
+    def build(self, *providers, provider_class=RouterProvider, **kwargs):
+        router = Router([Target(provider) for provider in providers], explore=0, **kwargs)
+        return provider_class(router=router)
+
+    def read(self, provider):
+        async def collect():
+            return [chunk async for chunk in provider.async_generate_response_stream([], stream=True)]
+
+        return asyncio.run(collect())
+
+    def test_failover_to_next_target(self):
+        broken, backup = FakeTarget("broken", error=ConnectionError("down")), FakeTarget("backup")
+        provider = self.build(broken, backup, failure_threshold=2, cooldown=60)
+        self.assertEqual(provider.generate_response([]), "backup answer")
+        self.assertEqual(provider.generate_response([]), "backup answer")
+        # the broken target cools down and is not tried first anymore
+        self.assertEqual(provider.generate_response([]), "backup answer")
+        self.assertEqual(broken.calls, 2)
+        report = provider.report()
+        self.assertEqual(report["failovers"], 2)
+        self.assertFalse(report["targets"]["broken:broken-model"]["healthy"])
+
+    def test_stream_fails_over_before_first_token(self):
+        broken = FakeTarget("broken", error=ConnectionError("reset"))
+        provider = self.build(broken, FakeTarget("backup", chunks=["Hel", "lo"]), provider_class=AsyncRouterProvider)
+        self.assertEqual(self.read(provider), ["Hel", "lo"])
+
+    def test_stream_error_after_first_token_is_raised(self):
+        broken = FakeTarget("broken", chunks=["Hel", "lo"], error=ConnectionError("reset"), fail_after=1)
+        provider = self.build(broken, FakeTarget("backup"), provider_class=AsyncRouterProvider)
+        with self.assertRaises(ConnectionError):
+            self.read(provider)
+        self.assertEqual(provider.router.failovers, 0)
+
+    def test_fastest_target_is_preferred(self):
+        slow, fast = FakeTarget("slow", delay=0.05), FakeTarget("fast")
+        provider = self.build(slow, fast, provider_class=AsyncRouterProvider)
+        self.read(provider)  # slow is measured first, fast is still unmeasured
+        self.read(provider)
+        self.read(provider)
+        self.assertEqual((slow.calls, fast.calls), (1, 2))
+        self.assertEqual(provider.router.ranked(stream=True)[0].provider, fast)
+
+
+class TestHedging(unittest.TestCase):
+    def setUp(self):
+        self.closed = []
+
+    def request(self, delays):
+        async def answer(model, delay):
+            try:
+                await asyncio.sleep(delay)
+                yield f"{model} first"
+                yield f"{model} second"
+            finally:
+                self.closed.append(model)
+
+        delays = list(delays)
+        return lambda model: answer(model, delays.pop(0))
+
+    def hedger(self, **kwargs):
+        hedger = Hedger(enabled=True, min_samples=5, min_delay=0.01, **kwargs)
+        for _ in range(5):
+            hedger.tracker("gpt").add(0.02)
+        return hedger
+
+    def read(self, hedger, request):
+        async def collect():
+            return [chunk async for chunk in hedger.stream("gpt", [{"role": "user", "content": "Hi"}], request)]
+
+        return asyncio.run(collect())
+
+    def test_late_first_token_is_hedged(self):
+        hedger = self.hedger(alternate_model="backup", max_rate=1)
+        chunks = self.read(hedger, self.request([1.0, 0.0]))
+        self.assertEqual(chunks, ["backup first", "backup second"])
+        self.assertEqual(self.closed, ["gpt", "backup"])
+        report = hedger.report()
+        self.assertEqual((report["hedged"], report["hedge_wins"]), (1, 1))
+        self.assertGreater(report["extra_prompt_tokens"], 0)
+
+    def test_primary_wins_when_it_answers_first(self):
+        hedger = self.hedger(max_rate=1)
+        self.assertEqual(self.read(hedger, self.request([0.04, 1.0])), ["gpt first", "gpt second"])
+        self.assertEqual(hedger.report()["hedge_wins"], 0)
+
+    def test_hedge_rate_is_capped(self):
+        hedger = self.hedger(max_rate=0)
+        hedger.budget = 0
+        self.assertEqual(self.read(hedger, self.request([0.05])), ["gpt first", "gpt second"])
+        self.assertEqual((hedger.stats.hedged, hedger.stats.skipped), (0, 1))
+
+    def test_no_hedging_until_latencies_are_known(self):
+        hedger = Hedger(enabled=True, min_samples=5)
+        self.assertIsNone(hedger.delay("gpt"))
+        self.read(hedger, self.request([0.0]))
+        self.assertEqual(len(hedger.tracker("gpt").samples), 1)
+
+
+def api_error(status: int, headers: dict = None):
+    response = httpx.Response(status, headers=headers, request=httpx.Request("POST", "http://llm/v1/chat/completions"))
+    error = openai.RateLimitError if status == 429 else openai.APIStatusError
+    return error("error", response=response, body=None)
+
+
+class TestRetryPolicy(unittest.TestCase):
+    def policy(self, **kwargs):
+        breaker = CircuitBreaker("test", failure_threshold=kwargs.pop("failure_threshold", 5), recovery_timeout=60)
+        return RetryPolicy(breaker, max_attempts=3, base_delay=0.001, max_delay=0.01, **kwargs)
+
+    def test_errors_are_classified(self):
+        self.assertEqual(classify(api_error(429)), "rate_limit")
+        self.assertEqual(classify(api_error(503)), "server")
+        self.assertEqual(classify(api_error(400)), "client")
+        self.assertEqual(classify(ToolsNotSupportedError("no tools")), "tools")
+        self.assertEqual(classify(ValueError()), "unknown")
+        self.assertEqual(retry_after(api_error(429, {"retry-after": "2"})), 2.0)
+        self.assertEqual(retry_after(api_error(429, {"retry-after-ms": "150"})), 0.15)
+        self.assertIsNone(retry_after(api_error(503)))
+
+    def test_server_errors_are_retried(self):
+        policy = self.policy()
+        request = Mock(side_effect=[api_error(502), api_error(429, {"retry-after": "0"}), "answer"])
+        self.assertEqual(policy.call(request), "answer")
+        self.assertEqual(request.call_count, 3)
+        self.assertEqual(policy.report()["retries"], 2)
+        self.assertEqual(policy.breaker.state, "closed")
+
+    def test_client_errors_are_not_retried(self):
+        policy = self.policy()
+        request = Mock(side_effect=api_error(400))
+        with self.assertRaises(openai.APIStatusError):
+            policy.call(request)
+        self.assertEqual(request.call_count, 1)
+        self.assertEqual(policy.breaker.failures, 0)
+
+    def test_circuit_opens_and_recovers(self):
+        policy = self.policy(failure_threshold=3)
+        with self.assertRaises(openai.APIStatusError):
+            policy.call(Mock(side_effect=api_error(500)))
+        self.assertEqual(policy.breaker.state, "open")
+        request = Mock(return_value="answer")
+        with self.assertRaises(CircuitOpenError):
+            policy.call(request)
+        request.assert_not_called()
+
+        policy.breaker.opened_at -= 60
+        self.assertEqual(policy.call(request), "answer")
+        self.assertEqual(policy.breaker.as_dict()["state"], "closed")
+
+    def test_stream_is_retried_only_before_first_chunk(self):
+        policy = self.policy()
+        attempts = []
+
+        def open_stream():
+            attempts.append(len(attempts))
+            if len(attempts) == 1:
+                raise api_error(503)
+            yield "first"
+            raise api_error(503)
+
+        chunks = []
+        with self.assertRaises(openai.APIStatusError):
+            for chunk in policy.stream(open_stream):
+                chunks.append(chunk)
+        self.assertEqual(chunks, ["first"])
+        self.assertEqual(len(attempts), 2)
+
+    def test_async_stream_is_retried(self):
+        policy = self.policy()
+        attempts = []
+
+        async def open_stream():
+            attempts.append(len(attempts))
+            if len(attempts) == 1:
+                raise api_error(500)
+            yield "first"
+            yield "second"
+
+        async def collect():
+            return [chunk async for chunk in policy.async_stream(open_stream)]
+
+        self.assertEqual(asyncio.run(collect()), ["first", "second"])
+        self.assertEqual(len(attempts), 2)
+
+
+class TestAdmissionControl(unittest.TestCase):
+    def run_waiting(self, controller, requests):
+        """Hold the only slot, queue `requests` of (tenant, priority), then free slots one by one."""
+        order = []
+
+        async def request(tenant, priority):
+            async with controller.async_admit(tenant, priority):
+                order.append((tenant, priority))
+                await asyncio.sleep(0)
+
+        async def run():
+            held = await controller.async_acquire("user:0")
+            tasks = [asyncio.create_task(request(*args)) for args in requests]
+            await asyncio.sleep(0.01)
+            self.assertEqual(controller.report()["queue_depth"], len(requests))
+            held.release()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            return tasks
+
+        return order, asyncio.run(run())
+
+    def test_interactive_requests_go_first(self):
+        controller = AdmissionController(capacity=1)
+        order, _ = self.run_waiting(
+            controller, [("user:1", "background"), ("user:2", "batch"), ("user:3", "interactive")]
+        )
+        self.assertEqual([priority for _, priority in order], ["interactive", "batch", "background"])
+        self.assertEqual(controller.report()["admitted"]["background"], 1)
+
+    def test_tenants_share_a_class_fairly(self):
+        controller = AdmissionController(capacity=1)
+        order, _ = self.run_waiting(controller, [("bot:1", "interactive")] * 3 + [("bot:2", "interactive")])
+        self.assertEqual([tenant for tenant, _ in order], ["bot:1", "bot:2", "bot:1", "bot:1"])
+
+    def test_tenant_concurrency(self):
+        controller = AdmissionController(capacity=4, tenant_concurrency=1)
+        first = controller.acquire("bot:1")
+        self.assertEqual(controller.acquire("bot:2").tenant, "bot:2")
+        controller.max_wait = 0.05
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.acquire("bot:1")
+        self.assertEqual(rejected.exception.reason, "timeout")
+        first.release()
+        controller.acquire("bot:1")
+
+    def test_overload_sheds_lowest_priority(self):
+        controller = AdmissionController(capacity=1, max_queue=1)
+        _, tasks = self.run_waiting(controller, [("user:1", "background")])
+        self.assertIsNone(tasks[0].result())
+
+        async def run():
+            held = await controller.async_acquire("user:0")
+            background = asyncio.create_task(controller.async_acquire("user:1", "background"))
+            await asyncio.sleep(0.01)
+            interactive = asyncio.create_task(controller.async_acquire("user:2"))
+            await asyncio.sleep(0.01)
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await background
+            self.assertEqual(rejected.exception.reason, "shed")
+            with self.assertRaises(AdmissionRejected) as rejected:
+                await controller.async_acquire("user:3")
+            self.assertEqual(rejected.exception.reason, "overload")
+            held.release()
+            (await interactive).release()
+
+        asyncio.run(run())
+        self.assertEqual(controller.report()["rejected"], {"shed": 1, "overload": 1})
+
+    def test_token_quota(self):
+        controller = AdmissionController(tenant_tpm=60, max_wait=1)
+        with controller.admit("bot:1") as ticket:
+            ticket.charge(120)
+        with self.assertRaises(AdmissionRejected) as rejected:
+            controller.acquire("bot:1")
+        self.assertEqual(rejected.exception.reason, "quota")
+        self.assertGreater(rejected.exception.retry_after, 1)
+        controller.acquire("bot:2").release()
+
+
+class TestRateLimiter(unittest.TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(limits={"openai": Limits(rpm=60, tpm=1000, concurrency=4)}, max_wait=0.2)
+        self.limiter.poll_interval = 0.01
+        self.limiter._client = Mock()
+
+    def test_unlimited_providers_skip_redis(self):
+        with self.limiter.limit("openrouter", "key", "gpt", []) as slot:
+            slot.chunk("Hello")
+        self.limiter.client.eval.assert_not_called()
+
+    def test_requests_wait_for_admission(self):
+        self.limiter.client.eval.side_effect = [[0, b"-1"], [0, b"0.02"], [1, b"0"], b"4"]
+        with self.limiter.limit("openai", "key", "gpt", [{"role": "user", "content": "Hi"}]) as slot:
+            slot.used(Mock(total_tokens=300))
+        self.assertEqual(self.limiter.client.eval.call_count, 4)
+        release = self.limiter.client.eval.call_args.args
+        # reserved tokens are corrected with the usage of the answer
+        self.assertEqual(release[4:7], (slot.id, 300 - slot.cost, "ok"))
+        self.assertNotIn("key", release[2])
+        self.assertEqual(self.limiter.report()["waited"], 1)
+
+    def test_waiting_times_out(self):
+        self.limiter.client.eval.return_value = [0, b"-1"]
+        with self.assertRaises(RateLimitTimeout):
+            with self.limiter.limit("openai", "key", "gpt", []):
+                pass
+        self.assertEqual(self.limiter.report()["timeouts"], 1)
+
+    def test_throttled_requests_decrease_the_limit(self):
+        self.limiter.client.eval.side_effect = [[1, b"0"], b"2"]
+        with self.assertRaises(openai.RateLimitError):
+            with self.limiter.limit("openai", "key", "gpt", []):
+                raise api_error(429, {"retry-after": "3"})
+        release = self.limiter.client.eval.call_args.args
+        self.assertEqual(release[6], "throttled")
+        self.assertEqual(release[-1], 3.0)
+
+    def test_fails_open_without_redis(self):
+        self.limiter.client.eval.side_effect = redis.ConnectionError("down")
+        with self.limiter.limit("openai", "key", "gpt", []):
+            pass
+        self.assertEqual(self.limiter.report()["errors"], 2)
+
+    def test_async_cancelled_waiter_leaves_the_queue(self):
+        client = Mock()
+        client.eval = AsyncMock(return_value=[0, b"-1"])
+        client.pipeline.return_value.execute = AsyncMock()
+        self.limiter.max_wait = 10
+        self.limiter._async_clients = {}
+
+        async def wait():
+            with patch.object(RateLimiter, "async_client", client):
+                task = asyncio.create_task(self.limiter.async_limit("openai", "key", "gpt", []).__aenter__())
+                await asyncio.sleep(0.05)
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+
+        asyncio.run(wait())
+        client.pipeline.return_value.zrem.assert_called()
+
+
+@unittest.skipUnless(LUA_REDIS, "needs fakeredis and lupa")
+class TestRateLimitScripts(unittest.TestCase):
+    def setUp(self):
+        self.limiter = RateLimiter(limits={"openai": Limits(rpm=600, concurrency=1)}, max_wait=1)
+        self.limiter._client = fakeredis.FakeRedis()
+
+    def slot(self):
+        return self.limiter.slot("openai", "key", "gpt", [])
+
+    def acquire_once(self, slot):
+        keys, args = self.limiter._acquire_args(slot)
+        admitted, wait = self.limiter.client.eval(ACQUIRE_SCRIPT, len(keys), *keys, *args)
+        return admitted, float(wait)
+
+    def test_waiters_are_admitted_in_redis_arrival_order(self):
+        first, second, third = self.slot(), self.slot(), self.slot()
+        self.assertEqual(self.acquire_once(first), (1, 0))
+        self.assertEqual(self.acquire_once(second), (0, -1))
+        time.sleep(0.002)
+        self.assertEqual(self.acquire_once(third), (0, -1))
+        seconds, microseconds = self.limiter.client.time()
+        arrival = self.limiter.client.zscore(f"{first.key}:waiting", second.id)
+        self.assertAlmostEqual(arrival, seconds + microseconds / 1_000_000, delta=1)
+
+        self.limiter.release(first)
+        # the later waiter asks first, the earlier one keeps its place
+        self.assertEqual(self.acquire_once(third), (0, -1))
+        self.assertEqual(self.acquire_once(second), (1, 0))
+        self.assertGreater(self.limiter.client.zscore(f"{first.key}:waiting", third.id), arrival)
+
+    def test_throttled_release_pauses_the_key(self):
+        slot = self.slot()
+        self.acquire_once(slot)
+        self.limiter.release(slot, api_error(429, {"retry-after": "3"}))
+        admitted, wait = self.acquire_once(self.slot())
+        self.assertEqual(admitted, 0)
+        self.assertAlmostEqual(wait, 3, delta=0.5)
+        (state,) = self.limiter.state().values()
+        self.assertEqual((state["throttled"], state["limit"], state["in_flight"]), (1, 1, 0))
+
+
+class TestHTTPTransport(unittest.TestCase):
+    def setUp(self):
+        def answer(request):
+            return httpx.Response(
+                200,
+                json={
+                    "id": "1",
+                    "object": "chat.completion",
+                    "created": 0,
+                    "model": "gpt",
+                    "choices": [
+                        {"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": "Hello"}}
+                    ],
+                },
+            )
+
+        self.transport = HTTPTransport(http2=False, transport=httpx.MockTransport(answer))
+        patcher = patch("aimanager.completions.custom_openai_api_provider.shared_transport", self.transport)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_providers_share_the_client_of_a_loop(self):
+        first = AsyncCustomOpenAIApiProvider(api_key="test")
+        second = AsyncCustomOpenAIApiProvider(host="http://other", api_key="test")
+
+        async def clients():
+            return first.client, first.client, second.client
+
+        a, b, c = asyncio.run(clients())
+        self.assertIs(a, b)
+        self.assertIs(a._client, c._client)
+        self.assertEqual(a.max_retries, 0)
+        self.assertIsNot(asyncio.run(clients())[0]._client, a._client)
+
+    def test_requests_go_through_the_pool(self):
+        provider = AsyncCustomOpenAIApiProvider(host="http://llm", api_key="test")
+
+        async def ask():
+            answers = [await provider.async_generate_response([{"role": "user", "content": "Hi"}]) for _ in range(3)]
+            client = self.transport.client()
+            await self.transport.aclose()
+            return answers, client
+
+        answers, client = asyncio.run(ask())
+        self.assertEqual(answers, ["Hello"] * 3)
+        self.assertTrue(client.is_closed)
+        self.assertEqual(self.transport.report()["requests"], 3)
+
+    def test_stream_usage_is_recorded(self):
+        bodies = []
+
+        def answer(request):
+            bodies.append(json.loads(request.content))
+            chunk = {"id": "1", "object": "chat.completion.chunk", "created": 0, "model": "gpt"}
+            events = [
+                {**chunk, "choices": [{"index": 0, "delta": {"content": "Hello"}}]},
+                {**chunk, "choices": [], "usage": {"prompt_tokens": 7, "completion_tokens": 1, "total_tokens": 8}},
+            ]
+            content = "".join(f"data: {json.dumps(event)}\n\n" for event in events) + "data: [DONE]\n\n"
+            return httpx.Response(200, text=content, headers={"content-type": "text/event-stream"})
+
+        self.transport.transport = httpx.MockTransport(answer)
+        provider = AsyncCustomOpenAIApiProvider(host="http://llm", api_key="test")
+
+        async def ask():
+            with track_usage() as usage:
+                chunks = provider.async_generate_response_stream(
+                    [{"role": "user", "content": "Hi"}], model="gpt", stream=True
+                )
+                text = "".join([chunk async for chunk in chunks])
+            await self.transport.aclose()
+            return text, usage
+
+        text, usage = asyncio.run(ask())
+        self.assertEqual(text, "Hello")
+        self.assertEqual(bodies[0]["stream_options"], {"include_usage": True})
+        self.assertEqual(usage.models[("custom", "gpt")].total_tokens, 8)
+
+
+class TestAgentPool(unittest.TestCase):
+    def setUp(self):
+        self.completions_builder = Mock()
+        self.memory_builder = Mock()
+        self.pool = AgentPool(LLMAgentBuilder, self.completions_builder, self.memory_builder, max_size=2)
+
+    def test_reuses_agent_for_same_key(self):
+        first = self.pool.get("base", provider="openai", model="gpt-4o-mini", system_prompt="Be brief")
+        second = self.pool.get("base", provider="openai", model="gpt-4o-mini", system_prompt="Be brief")
+        self.assertIs(first, second)
+        self.assertEqual(self.pool.stats()["hits"], 1)
+        self.assertEqual(self.pool.stats()["misses"], 1)
+
+    def test_shares_clients_between_agents(self):
+        first = self.pool.get("base", provider="openai", model="gpt-4o-mini", system_prompt="A")
+        second = self.pool.get("base", provider="openai", model="gpt-4o-mini", system_prompt="B")
+        self.assertIsNot(first, second)
+        self.assertIs(first.completions, second.completions)
+        self.assertIs(first.memory, second.memory)
+        self.completions_builder.build.assert_called_once_with("openai")
+
+    def test_evicts_least_recently_used(self):
+        first = self.pool.get("base", provider="openai", system_prompt="A")
+        self.pool.get("base", provider="openai", system_prompt="B")
+        self.pool.get("base", provider="openai", system_prompt="A")
+        self.pool.get("base", provider="openai", system_prompt="C")
+        self.assertEqual(self.pool.stats()["evictions"], 1)
+        self.assertIs(self.pool.get("base", provider="openai", system_prompt="A"), first)
+
+    def test_tool_set_is_part_of_key(self):
+        def tool():
+            """Tool"""
+
+        tool.llm_schema = {}
+        plain = self.pool.get("base", provider="openai")
+        with_tools = self.pool.get("base", provider="openai", tools=[tool])
+        self.assertIsNot(plain, with_tools)
+        self.assertIn("tool", with_tools.tools_registry)
+
+    def test_completion_cache_from_metadata(self):
+        pool = AgentPool(
+            LLMAgentBuilder, self.completions_builder, self.memory_builder, cache_builders=(FakeRedisCompletionCache,)
+        )
+        plain = pool.get("base", provider="openai")
+        cached = pool.get("base", provider="openai", metadata={"completion_cache": {"ttl": 60}})
+        self.assertIsNot(plain, cached)
+        self.assertIsInstance(cached.completions, CachedCompletionProvider)
+        self.assertIs(cached.completions.provider, plain.completions)
+
+    def test_unknown_agent(self):
+        self.assertIsNone(self.pool.get("unknown"))
+
+
 if __name__ == "__main__":
     unittest.main()
+
+
+class FakeMetricsRedis:
+    """Hashes of a Redis server shared by the registries of several fake workers."""
+
+    def __init__(self):
+        self.hashes = {}
+        self.commands = []
+
+    def pipeline(self, transaction=True):
+        self.commands = []
+        return self
+
+    def hincrby(self, key, field, value):
+        self.commands.append(("incr", key, field, value))
+
+    hincrbyfloat = hincrby
+
+    def hgetall(self, key):
+        self.commands.append(("get", key))
+
+    def execute(self):
+        results = []
+        for command, key, *args in self.commands:
+            values = self.hashes.setdefault(key, {})
+            if command == "incr":
+                field, value = args
+                values[field] = values.get(field, 0) + value
+                results.append(values[field])
+            else:
+                results.append({field.encode(): str(value).encode() for field, value in values.items()})
+        return results
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        self.redis = FakeMetricsRedis()
+        self.workers = [MetricsRegistry(flush_interval=0) for _ in range(2)]
+        for registry in self.workers:
+            registry._client = self.redis
+            registry.counter("lookups_total", "Cache lookups", ("result",))
+            registry.histogram("turn_seconds", "Turn duration", ("agent",), buckets=(0.1, 1))
+
+    def test_series_of_workers_add_up(self):
+        first, second = self.workers
+        first.metrics["lookups_total"].labels("hit").inc()
+        second.metrics["lookups_total"].labels("hit").inc(2)
+        first.metrics["turn_seconds"].labels("base").observe(0.05)
+        second.metrics["turn_seconds"].labels("base").observe(0.5)
+        second.metrics["turn_seconds"].labels("base").observe(3)
+        first.flush()
+        text = second.render()
+        self.assertIn('lookups_total{result="hit"} 3', text)
+        self.assertIn("# TYPE turn_seconds histogram", text)
+        self.assertIn('turn_seconds_bucket{agent="base",le="0.1"} 1', text)
+        self.assertIn('turn_seconds_bucket{agent="base",le="1"} 2', text)
+        self.assertIn('turn_seconds_bucket{agent="base",le="+Inf"} 3', text)
+        self.assertIn('turn_seconds_count{agent="base"} 3', text)
+        self.assertIn('turn_seconds_sum{agent="base"} 3.55', text)
+
+    def test_failed_flush_keeps_the_changes(self):
+        registry = self.workers[0]
+        registry._client = Mock()
+        registry._client.pipeline.return_value.execute.side_effect = redis.ConnectionError("down")
+        registry.metrics["lookups_total"].labels("miss").inc()
+        self.assertFalse(registry.flush())
+        registry._client = self.redis
+        registry.metrics["lookups_total"].labels("miss").inc()
+        self.assertIn('lookups_total{result="miss"} 2', registry.render())
+
+    def test_tool_calls_are_timed(self):
+        @llm_tool("Add numbers")
+        def add(a: int, b: int = 0):
+            return a + b
+
+        TOOL_SECONDS.reset()
+        calls = [{"name": "add", "parameters": {"a": 1}}, {"name": "made_up", "parameters": {}}]
+        results = trigger_functions(calls, {"add": add})
+        self.assertEqual(results[0], 1)
+        self.assertIsInstance(results[1], ValueError)
+        self.assertEqual(set(TOOL_SECONDS.take()), {("add", "ok"), ("unknown", "error")})
+
+
+class ListSpanExporter:
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans += spans
+
+
+class TestTracing(unittest.TestCase):
+    def setUp(self):
+        self.exporter = ListSpanExporter()
+        for name, value in (("sample_rate", 1), ("flush_interval", 0), ("_exporter", self.exporter)):
+            patcher = patch.object(tracer, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def spans(self):
+        tracer.flush()
+        return {span["name"]: span for span in self.exporter.spans}
+
+    def test_spans_follow_tool_calls_to_other_threads(self):
+        @llm_tool("Add numbers")
+        def add(a: int, b: int = 0):
+            with tracer.span("add.inner"):
+                return a + b
+
+        @llm_tool("Async echo")
+        async def echo(text: str):
+            with tracer.span("echo.inner"):
+                return text
+
+        registry = {"add": add, "echo": echo}
+        with tracer.trace("request") as root:
+            trigger_functions([{"name": "add", "parameters": {"a": 1}}], registry)
+            trigger_functions([{"name": "echo", "parameters": {"text": "hi"}}], registry)
+            asyncio.run(async_trigger_functions([{"name": "add", "parameters": {"a": 2}}], registry))
+        tracer.flush()
+        spans = self.exporter.spans
+        self.assertEqual({span["trace_id"] for span in spans}, {root.trace_id})
+        by_id = {span["span_id"]: span for span in spans}
+        for inner in ("add.inner", "echo.inner"):
+            nested = [span for span in spans if span["name"] == inner]
+            self.assertTrue(nested)
+            for span in nested:
+                tool_call = by_id[span["parent_id"]]
+                self.assertEqual(tool_call["name"], "tool.call")
+                self.assertEqual(tool_call["attributes"]["outcome"], "ok")
+                self.assertEqual(tool_call["parent_id"], root.span_id)
+        self.assertTrue(any(span["thread"].startswith("llm-tool") for span in spans if span["name"] == "add.inner"))
+
+    def test_head_sampling(self):
+        tracer.sample_rate = 0
+        with tracer.trace("request") as root:
+            self.assertIs(root, NOT_SAMPLED)
+            with tracer.span("child") as child:
+                self.assertIs(child, NOT_SAMPLED)
+        self.assertEqual(self.spans(), {})
+
+        # the caller's sampling decision is followed
+        traceparent = "00-0af7651916cd43dd8448eb211c80319c-b7ad6b7169203331-01"
+        with tracer.trace("request", traceparent):
+            with tracer.span("child"):
+                pass
+        spans = self.spans()
+        self.assertEqual(spans["request"]["trace_id"], "0af7651916cd43dd8448eb211c80319c")
+        self.assertEqual(spans["request"]["parent_id"], "b7ad6b7169203331")
+        self.assertEqual(spans["child"]["parent_id"], spans["request"]["span_id"])
+
+    def test_failed_completion_span(self):
+        with tracer.trace("request"):
+            with self.assertRaises(openai.APIConnectionError):
+                with CompletionTimer("custom", "gpt-4o-mini", False):
+                    raise openai.APIConnectionError(request=httpx.Request("POST", "http://llm"))
+        span = self.spans()["llm.request"]
+        self.assertEqual(span["status"], "error")
+        self.assertEqual(span["attributes"]["model"], "gpt-4o-mini")
+        self.assertEqual(span["attributes"]["error.type"], "APIConnectionError")
+
+    def test_file_exporter(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "traces.jsonl")
+            tracer._exporter = FileSpanExporter(path)
+            with tracer.trace("request", bot_id=1):
+                pass
+            tracer.flush()
+            with open(path) as f:
+                spans = [json.loads(line) for line in f]
+        self.assertEqual([span["name"] for span in spans], ["request"])
+        self.assertEqual(spans[0]["attributes"], {"bot_id": 1})
@@ -1,10 +1,101 @@
+import asyncio
+import atexit
+import inspect
 import json
+import os
+import threading
+import time
+import weakref
+from concurrent.futures import Future, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FuturesTimeoutError
+
+from aimanager.metrics import metrics
+from aimanager.tracing import bind, tracer, wrap
+
+# worker threads for sync tools, so several calls of one turn run concurrently
+tool_executor = ThreadPoolExecutor(max_workers=int(os.getenv("TOOL_WORKERS", 8)), thread_name_prefix="llm-tool")
+
+TOOL_SECONDS = metrics.histogram("tool_call_seconds", "Execution time of tool calls", ("tool", "outcome"))
+
+
+class ToolLoop:
+    """
+    One long-lived event loop on a daemon thread, where coroutine tools called from sync code run.
+
+    Creating a loop per call is slow, drops async clients bound to the old loop and fails when
+    the caller already runs inside a loop (sync views under an ASGI worker). The loop is started
+    lazily and again in a forked worker process.
+    """
+
+    def __init__(self, name: str = "llm-tool-loop"):
+        self.name = name
+        self._loop = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid() or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._run, args=(self._loop,), name=self.name, daemon=True)
+                self._thread.start()
+                self._pid = os.getpid()
+            return self._loop
+
+    @staticmethod
+    def _run(loop: asyncio.AbstractEventLoop) -> None:
+        asyncio.set_event_loop(loop)
+        loop.run_forever()
+
+    def submit(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def run(self, coroutine, timeout: float = None):
+        """Run a coroutine on the loop and wait for it; it is cancelled after `timeout` seconds."""
+        future = self.submit(coroutine)
+        try:
+            return future.result(timeout)
+        except FuturesTimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._loop is None or self._pid != os.getpid():
+                return
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join(timeout=5)
+            self._loop = self._thread = None
+
+
+tool_loop = ToolLoop()
+atexit.register(tool_loop.stop)
+
+_shared_clients = weakref.WeakKeyDictionary()
+
+
+def shared_async_client(name: str, factory):
+    """
+    Async client (httpx, aiohttp, redis.asyncio...) created once per event loop and reused by tools.
+    Coroutine tools of the sync agent always run on `tool_loop`, so they share one client per process.
+    """
+    clients = _shared_clients.setdefault(asyncio.get_running_loop(), {})
+    if name not in clients:
+        clients[name] = factory()
+    return clients[name]
+
+
+def _is_call(data) -> bool:
+    return isinstance(data, dict) and "function" in data and "parameters" in data
 
 
 def parse_llm_response(response_text: str):
     """
     Attempt to parse the LLM response as JSON.
     If it contains a 'function' key and 'parameters', assume it is a function call.
+    A list of such objects is a batch of independent calls, listed under "calls".
     Otherwise, return the text response.
     """
     try:
@@ -13,8 +104,12 @@ def parse_llm_response(response_text: str):
         # Not valid JSON; treat as plain text.
         return {"type": "text", "content": response_text}
 
-    if isinstance(data, dict) and "function" in data and "parameters" in data:
-        return {"type": "function", "name": data["function"], "parameters": data["parameters"]}
+    if _is_call(data):
+        call = {"name": data["function"], "parameters": data["parameters"]}
+        return {"type": "function", **call, "calls": [call]}
+    if isinstance(data, list) and data and all(_is_call(item) for item in data):
+        calls = [{"name": item["function"], "parameters": item["parameters"]} for item in data]
+        return {"type": "function", "calls": calls}
     return {"type": "text", "content": response_text}
 
 
@@ -42,3 +137,190 @@ def trigger_function(call_request: dict, functions_registry: dict):
 
     func = functions_registry[func_name]
     return func(*args, **kwargs)
+
+
+def _is_coroutine_tool(call_request: dict, functions_registry: dict) -> bool:
+    return inspect.iscoroutinefunction(functions_registry.get(call_request["name"]))
+
+
+def _observe_call(call_request: dict, functions_registry: dict, started: float, outcome: str) -> None:
+    # names the model made up are not known tools, they'd add a series each
+    name = call_request["name"] if call_request["name"] in functions_registry else "unknown"
+    TOOL_SECONDS.labels(name, outcome).observe(time.perf_counter() - started)
+
+
+def _timed_trigger_function(call_request: dict, functions_registry: dict):
+    started, outcome = time.perf_counter(), "error"
+    with tracer.span("tool.call", tool=call_request["name"]) as span:
+        try:
+            result = trigger_function(call_request, functions_registry)
+            outcome = "ok"
+            return result
+        finally:
+            span.set_attribute("outcome", outcome)
+            _observe_call(call_request, functions_registry, started, outcome)
+
+
+async def _timed_call(call_request: dict, functions_registry: dict, call_function, timeout: float):
+    started, outcome = time.perf_counter(), "error"
+    with tracer.span("tool.call", tool=call_request["name"]) as span:
+        try:
+            result = await asyncio.wait_for(call_function(call_request), timeout)
+            outcome = "ok"
+            return result
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            raise _timeout_error(call_request, timeout)
+        finally:
+            span.set_attribute("outcome", outcome)
+            _observe_call(call_request, functions_registry, started, outcome)
+
+
+def _remaining(deadline: float) -> float:
+    return max(deadline - time.monotonic(), 0) if deadline is not None else None
+
+
+def _timeout_error(call_request: dict, timeout: float) -> TimeoutError:
+    return TimeoutError(f"Function {call_request['name']} timed out after {timeout:g}s")
+
+
+async def _gather_calls(calls: list, functions_registry: dict, timeout: float = None) -> list:
+    async def call_function(call: dict):
+        return await trigger_function(call, functions_registry)
+
+    calls = (_timed_call(call, functions_registry, call_function, timeout) for call in calls)
+    return await asyncio.gather(*calls, return_exceptions=True)
+
+
+def trigger_functions(
+    calls: list, functions_registry: dict, executor: ThreadPoolExecutor = None, timeout: float = None
+) -> list:
+    """
+    Call several independent functions concurrently from sync code.
+    Sync functions run on worker threads, coroutine functions are gathered on the `tool_loop` thread.
+    Returns results in the order of calls; a failed call gives its exception instead of a result,
+    a call running longer than `timeout` seconds gives TimeoutError. Coroutine functions are cancelled
+    on timeout, sync functions can't be interrupted and finish in the background.
+    """
+    executor = executor or tool_executor
+    deadline = time.monotonic() + timeout if timeout is not None else None
+    results = [None] * len(calls)
+    coroutine_calls, futures = {}, {}
+    for index, call in enumerate(calls):
+        if _is_coroutine_tool(call, functions_registry):
+            coroutine_calls[index] = call
+        else:
+            # timed on the worker thread, a call that timed out for the turn still reports its runtime
+            futures[index] = executor.submit(wrap(_timed_trigger_function), call, functions_registry)
+
+    gathered = None
+    if coroutine_calls:
+        gathered = tool_loop.submit(bind(_gather_calls(list(coroutine_calls.values()), functions_registry, timeout)))
+    for index, future in futures.items():
+        try:
+            result = future.result(timeout=_remaining(deadline))
+            if inspect.iscoroutine(result):
+                result = tool_loop.run(result, timeout=_remaining(deadline))
+            results[index] = result
+        except FuturesTimeoutError:
+            future.cancel()
+            results[index] = _timeout_error(calls[index], timeout)
+        except Exception as e:
+            results[index] = e
+    if gathered is not None:
+        # every call is bounded by `timeout` inside the loop
+        for index, result in zip(coroutine_calls, gathered.result()):
+            results[index] = result
+    return results
+
+
+async def async_trigger_functions(
+    calls: list, functions_registry: dict, executor: ThreadPoolExecutor = None, timeout: float = None
+) -> list:
+    """
+    Call several independent functions concurrently from async code.
+    Coroutine functions are gathered, sync functions run on worker threads and never block the loop.
+    Returns results in the order of calls; a failed call gives its exception instead of a result,
+    a call running longer than `timeout` seconds is cancelled and gives TimeoutError.
+    """
+    loop = asyncio.get_running_loop()
+
+    async def call_function(call: dict):
+        if _is_coroutine_tool(call, functions_registry):
+            return await trigger_function(call, functions_registry)
+        result = await loop.run_in_executor(executor or tool_executor, wrap(trigger_function), call, functions_registry)
+        if inspect.iscoroutine(result):
+            result = await result
+        return result
+
+    calls = (_timed_call(call, functions_registry, call_function, timeout) for call in calls)
+    return await asyncio.gather(*calls, return_exceptions=True)
+
+
+class StreamingCallDetector:
+    """
+    Incrementally detects a function call JSON in a streamed LLM response.
+
+    Feed chunks as they arrive: `feed` returns the text that can be sent to the client right away.
+    Plain-text answers are passed through from the first chunk. Answers starting with "{" or "[" are
+    held back until the top-level JSON value is closed; then `call` is set if it is a function call
+    (or a list of calls), otherwise the held text is released.
+    """
+
+    def __init__(self):
+        self.buffer = ""
+        self.mode = None
+        self.call = None
+        self._depth = 0
+        self._in_string = False
+        self._escape = False
+
+    def feed(self, chunk: str) -> str:
+        if self.mode == "text":
+            return chunk
+        start = len(self.buffer)
+        self.buffer += chunk
+        if self.mode is None:
+            stripped = self.buffer.lstrip()
+            if not stripped:
+                return ""
+            if not stripped.startswith(("{", "[")):
+                self.mode = "text"
+                return self.buffer
+            self.mode = "json"
+        return self._scan(start)
+
+    def flush(self) -> str:
+        """Release held text once the stream ended without a complete function call."""
+        if self.mode == "text" or self.call is not None:
+            return ""
+        self.mode = "text"
+        return self.buffer
+
+    def _scan(self, start: int) -> str:
+        for index in range(start, len(self.buffer)):
+            char = self.buffer[index]
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif char == "\\":
+                    self._escape = True
+                elif char == '"':
+                    self._in_string = False
+            elif char == '"':
+                self._in_string = True
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]":
+                self._depth -= 1
+                if self._depth == 0:
+                    return self._complete(index + 1)
+        return ""
+
+    def _complete(self, end: int) -> str:
+        response = parse_llm_response(self.buffer[:end])
+        if response["type"] == "function":
+            self.call = response
+            return ""
+        self.mode = "text"
+        return self.buffer
@@ -1,8 +1,17 @@
 import asyncio
 import json
+import time
 import unittest
 
-from aimanager.tools.invoker import parse_llm_response, trigger_function
+from aimanager.tools.invoker import (
+    StreamingCallDetector,
+    async_trigger_functions,
+    parse_llm_response,
+    shared_async_client,
+    tool_loop,
+    trigger_function,
+    trigger_functions,
+)
 from aimanager.tools.scheme import llm_tool
 
 
@@ -75,6 +84,24 @@ class TestInvoker(unittest.TestCase):
         self.assertEqual(result["name"], "test_func")
         self.assertEqual(result["parameters"], {"x": 42})
 
+    def test_parse_multiple_function_calls(self):
+        response = json.dumps(
+            [
+                {"function": "test_func", "parameters": {"x": 1}},
+                {"function": "test_async_func", "parameters": {"a": 2}},
+            ]
+        )
+        result = parse_llm_response(response)
+        self.assertEqual(result["type"], "function")
+        self.assertEqual(
+            result["calls"],
+            [{"name": "test_func", "parameters": {"x": 1}}, {"name": "test_async_func", "parameters": {"a": 2}}],
+        )
+
+    def test_parse_list_without_calls(self):
+        result = parse_llm_response("[1, 2]")
+        self.assertEqual(result["type"], "text")
+
     def test_parse_text_response(self):
         response = "This is a plain text response"
         result = parse_llm_response(response)
@@ -107,11 +134,135 @@ class TestInvoker(unittest.TestCase):
         with self.assertRaises(ValueError):
             trigger_function(call_request, self.registry)
 
+    def test_trigger_functions_runs_calls_concurrently(self):
+        @llm_tool("Slow sync function")
+        def slow(x: int):
+            time.sleep(0.2)
+            return x
+
+        registry = {**self.registry, "slow": slow}
+        calls = [
+            {"name": "slow", "parameters": {"x": 1}},
+            {"name": "slow", "parameters": {"x": 2}},
+            {"name": "test_async_func", "parameters": {"a": 1, "b": 2}},
+            {"name": "unknown_func", "parameters": {}},
+        ]
+        started = time.perf_counter()
+        results = trigger_functions(calls, registry)
+        self.assertLess(time.perf_counter() - started, 0.35)
+        self.assertEqual(results[:3], [1, 2, 3])
+        self.assertIsInstance(results[3], ValueError)
+
+    def test_async_trigger_functions(self):
+        calls = [
+            {"name": "test_func", "parameters": {"x": 1}},
+            {"name": "test_async_func", "parameters": {"a": 5, "b": 3}},
+            {"name": "test_async_func", "parameters": {"missing": 1}},
+        ]
+        results = asyncio.run(async_trigger_functions(calls, self.registry))
+        self.assertEqual(results[:2], ["x=1, y=default", 8])
+        self.assertIsInstance(results[2], TypeError)
+
+    def test_async_trigger_functions_timeout_cancels_tool(self):
+        cancelled = []
+
+        @llm_tool("Hanging function")
+        async def hang():
+            try:
+                await asyncio.sleep(10)
+            except asyncio.CancelledError:
+                cancelled.append(True)
+                raise
+
+        calls = [{"name": "hang", "parameters": {}}, {"name": "test_func", "parameters": {"x": 1}}]
+        results = asyncio.run(async_trigger_functions(calls, {**self.registry, "hang": hang}, timeout=0.05))
+        self.assertIsInstance(results[0], TimeoutError)
+        self.assertEqual(results[1], "x=1, y=default")
+        self.assertEqual(cancelled, [True])
+
+    def test_trigger_functions_timeout(self):
+        @llm_tool("Slow sync function")
+        def slow():
+            time.sleep(0.3)
+
+        results = trigger_functions([{"name": "slow", "parameters": {}}], {"slow": slow}, timeout=0.05)
+        self.assertIsInstance(results[0], TimeoutError)
+
+    def test_coroutine_tools_share_one_loop(self):
+        @llm_tool("Loop of the call")
+        async def current_loop():
+            return asyncio.get_running_loop()
+
+        calls = [{"name": "current_loop", "parameters": {}}]
+        first = trigger_functions(calls, {"current_loop": current_loop})[0]
+        second = trigger_functions(calls, {"current_loop": current_loop})[0]
+        self.assertIs(first, second)
+        self.assertIs(first, tool_loop.loop)
+
+    def test_trigger_functions_inside_running_loop(self):
+        async def handler():
+            # a sync agent called from an async view
+            return trigger_functions([{"name": "test_async_func", "parameters": {"a": 1, "b": 2}}], self.registry)
+
+        self.assertEqual(asyncio.run(handler()), [3])
+
+    def test_trigger_functions_coroutine_timeout(self):
+        @llm_tool("Hanging function")
+        async def hang():
+            await asyncio.sleep(10)
+
+        results = trigger_functions([{"name": "hang", "parameters": {}}], {"hang": hang}, timeout=0.05)
+        self.assertIsInstance(results[0], TimeoutError)
+
+    def test_shared_async_client(self):
+        @llm_tool("Shared client")
+        async def client():
+            return shared_async_client("test", object)
+
+        calls = [{"name": "client", "parameters": {}}] * 2
+        first, second = trigger_functions(calls, {"client": client})
+        self.assertIs(first, second)
+
     def test_default_parameters(self):
         call_request = {"name": "test_func", "parameters": {"x": 42}}  # y has default value
         result = trigger_function(call_request, self.registry)
         self.assertEqual(result, "x=42, y=default")
 
 
+class TestStreamingCallDetector(unittest.TestCase):
+    def feed_all(self, detector, chunks):
+        return "".join(detector.feed(chunk) for chunk in chunks)
+
+    def test_plain_text_is_passed_through(self):
+        detector = StreamingCallDetector()
+        self.assertEqual(detector.feed("Hello"), "Hello")
+        self.assertEqual(detector.feed(", world"), ", world")
+        self.assertEqual(detector.flush(), "")
+        self.assertIsNone(detector.call)
+
+    def test_function_call_is_detected(self):
+        detector = StreamingCallDetector()
+        chunks = ['{"func', 'tion": "test_func", "param', 'eters": {"x": "}"}', "}"]
+        self.assertEqual(self.feed_all(detector, chunks), "")
+        self.assertEqual(detector.call["calls"], [{"name": "test_func", "parameters": {"x": "}"}}])
+
+    def test_function_call_list_is_detected(self):
+        detector = StreamingCallDetector()
+        chunks = ['[{"function": "a", "parameters": {}}, ', '{"function": "b", "parameters": {}}]']
+        self.assertEqual(self.feed_all(detector, chunks), "")
+        self.assertEqual([call["name"] for call in detector.call["calls"]], ["a", "b"])
+
+    def test_json_without_function_is_released(self):
+        detector = StreamingCallDetector()
+        self.assertEqual(self.feed_all(detector, ['{"answer": ', "42}"]), '{"answer": 42}')
+        self.assertEqual(detector.feed(" done"), " done")
+        self.assertIsNone(detector.call)
+
+    def test_incomplete_json_is_flushed(self):
+        detector = StreamingCallDetector()
+        self.assertEqual(detector.feed('{"function": "test'), "")
+        self.assertEqual(detector.flush(), '{"function": "test')
+
+
 if __name__ == "__main__":
     unittest.main()
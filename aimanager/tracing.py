@@ -0,0 +1,360 @@
+import asyncio
+import atexit
+import functools
+import inspect
+import json
+import logging
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+import httpx
+
+logger = logging.getLogger("django")
+
+_current_span = ContextVar("tracing_span", default=None)
+
+TRACEPARENT = re.compile(r"^00-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits):0{bits // 4}x}"
+
+
+class Span:
+    """A timed operation of a trace; ended spans are handed to the tracer for export."""
+
+    sampled = True
+
+    def __init__(self, tracer: "Tracer", name: str, trace_id: str, parent_id: str = None, attributes: dict = None):
+        self.tracer = tracer
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.attributes = attributes or {}
+        self.status = "ok"
+        self.thread = threading.current_thread().name
+        self.start_time = time.time_ns()
+        self.end_time = None
+
+    def set_attribute(self, key: str, value) -> None:
+        self.attributes[key] = value
+
+    def record_exception(self, e: BaseException) -> None:
+        if isinstance(e, (GeneratorExit, asyncio.CancelledError)):
+            # an aborted stream or a cancelled task is not a failure of the operation
+            self.status = "cancelled"
+            return
+        self.status = "error"
+        self.attributes["error.type"] = type(e).__name__
+        self.attributes["error.message"] = str(e)
+
+    def end(self) -> None:
+        if self.end_time is None:
+            self.end_time = time.time_ns()
+            self.tracer.finish(self)
+
+    @property
+    def traceparent(self) -> str:
+        """W3C trace context header continuing this trace in another service."""
+        return f"00-{self.trace_id}-{self.span_id}-01"
+
+    def as_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start": self.start_time,
+            "end": self.end_time,
+            "duration_ms": round((self.end_time - self.start_time) / 1e6, 3),
+            "status": self.status,
+            "thread": self.thread,
+            "attributes": self.attributes,
+        }
+
+
+class NonRecordingSpan:
+    """Span of a trace left out by sampling; its children are not recorded either."""
+
+    sampled = False
+    traceparent = None
+
+    def set_attribute(self, key: str, value) -> None:
+        pass
+
+    def record_exception(self, e: BaseException) -> None:
+        pass
+
+    def end(self) -> None:
+        pass
+
+
+NOT_SAMPLED = NonRecordingSpan()
+
+
+class FileSpanExporter:
+    """
+    Ended spans appended to a file as JSON lines, e.g. for `jq` or a collector tailing the file.
+    Each batch is a single append, so the workers of a host can share one file.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+
+    def export(self, spans: list[dict]) -> None:
+        data = "".join(json.dumps(span, default=str) + "\n" for span in spans)
+        with open(self.path, "a") as f:
+            f.write(data)
+
+
+class HTTPSpanExporter:
+    """Ended spans posted in batches as `{"spans": [...]}` JSON to a collector endpoint."""
+
+    def __init__(self, endpoint: str, timeout: float = 5):
+        self.endpoint = endpoint
+        self.client = httpx.Client(timeout=timeout)
+
+    def export(self, spans: list[dict]) -> None:
+        response = self.client.post(self.endpoint, content=json.dumps({"spans": spans}, default=str))
+        response.raise_for_status()
+
+
+def build_exporter():
+    endpoint = os.getenv("TRACING_ENDPOINT")
+    if endpoint:
+        return HTTPSpanExporter(endpoint)
+    return FileSpanExporter(os.getenv("TRACING_FILE", "traces.jsonl"))
+
+
+class TracingStats:
+    def __init__(self):
+        self.traces = 0
+        self.sampled = 0
+        self.spans = 0
+        self.dropped = 0
+        self.exported = 0
+        self.failed = 0
+
+    def as_dict(self) -> dict:
+        return {
+            "traces": self.traces,
+            "sampled": self.sampled,
+            "spans": self.spans,
+            "dropped": self.dropped,
+            "exported": self.exported,
+            "failed": self.failed,
+        }
+
+
+class Tracer:
+    """
+    Spans of the chat pipeline, from an entry point such as the Telegram webhook down to completion
+    requests, tool calls and memory reads.
+
+    A trace is started by `trace()` and sampled at its head: with probability `sample_rate`, or as the
+    caller decided when it passes a W3C `traceparent`. `span()` only records inside a sampled trace,
+    so an unsampled request costs a context variable lookup per instrumented call. The current span
+    lives in a context variable: asyncio tasks inherit it, thread hops carry it with `wrap()` and
+    `bind()`. Ended spans are queued and exported in batches by a daemon thread every
+    `flush_interval` seconds; a full queue drops spans and a failed export loses its batch.
+    """
+
+    def __init__(self, sample_rate: float = None, exporter=None, flush_interval: float = None, max_queue: int = None):
+        self.sample_rate = sample_rate if sample_rate is not None else float(os.getenv("TRACING_SAMPLE_RATE", 0))
+        self.flush_interval = (
+            flush_interval if flush_interval is not None else float(os.getenv("TRACING_FLUSH_INTERVAL", 5))
+        )
+        self.max_queue = max_queue or int(os.getenv("TRACING_MAX_QUEUE", 2048))
+        self.stats = TracingStats()
+        self.started = False
+        self._exporter = exporter
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        # spans queued by the parent were exported by it
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def exporter(self):
+        if self._exporter is None:
+            self._exporter = build_exporter()
+        return self._exporter
+
+    def _sample(self, traceparent: str = None) -> tuple:
+        """Trace id, remote parent span id and sampling decision of a new trace."""
+        match = TRACEPARENT.match(traceparent.strip().lower()) if traceparent else None
+        if match:
+            trace_id, parent_id, flags = match.groups()
+            return trace_id, parent_id, bool(int(flags, 16) & 1)
+        return _new_id(128), None, random.random() < self.sample_rate
+
+    def start_trace(self, name: str, traceparent: str = None, **attributes):
+        self.stats.traces += 1
+        trace_id, parent_id, sampled = self._sample(traceparent)
+        if not sampled:
+            return NOT_SAMPLED
+        self.stats.sampled += 1
+        return Span(self, name, trace_id, parent_id, attributes)
+
+    def start_span(self, name: str, **attributes):
+        """A child of the current span, not made current; for leaves that must be ended explicitly."""
+        parent = _current_span.get()
+        if parent is None or not parent.sampled:
+            return NOT_SAMPLED
+        return Span(self, name, parent.trace_id, parent.span_id, attributes)
+
+    @contextmanager
+    def _activate(self, span):
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.record_exception(e)
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end()
+
+    def trace(self, name: str, traceparent: str = None, **attributes):
+        """Context manager starting a trace, or a span of the current one when called inside a trace."""
+        if _current_span.get() is not None:
+            return self.span(name, **attributes)
+        return self._activate(self.start_trace(name, traceparent, **attributes))
+
+    def span(self, name: str, **attributes):
+        """Context manager recording a span of the current trace and making it current."""
+        span = self.start_span(name, **attributes)
+        if span is NOT_SAMPLED:
+            return _noop_context
+        return self._activate(span)
+
+    def finish(self, span: Span) -> None:
+        if not self.started:
+            self.start()
+        if len(self._queue) >= self.max_queue:
+            self.stats.dropped += 1
+            return
+        self.stats.spans += 1
+        self._queue.append(span)
+
+    def start(self) -> None:
+        """Start the export thread of this process on the first ended span."""
+        if self.started or not self.flush_interval:
+            return
+        with self._lock:
+            if not self.started:
+                threading.Thread(target=self._run, name="tracing-export", daemon=True).start()
+                self.started = True
+
+    def _after_fork(self) -> None:
+        self.started = False
+        self._queue = deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+
+    def _run(self) -> None:
+        while True:
+            time.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self) -> int:
+        """Export the queued spans, return the number exported."""
+        with self._flush_lock:
+            spans = []
+            while self._queue:
+                spans.append(self._queue.popleft().as_dict())
+            if not spans:
+                return 0
+            try:
+                self.exporter.export(spans)
+            except Exception as e:
+                logger.warning(f"Failed to export {len(spans)} spans: {e}")
+                self.stats.failed += len(spans)
+                return 0
+            self.stats.exported += len(spans)
+            return len(spans)
+
+    def report(self) -> dict:
+        return {**self.stats.as_dict(), "queued": len(self._queue), "sample_rate": self.sample_rate}
+
+
+class _NoopContext:
+    def __enter__(self):
+        return NOT_SAMPLED
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_noop_context = _NoopContext()
+
+
+def current_span():
+    """The span of the running code, `NOT_SAMPLED` outside a sampled trace."""
+    span = _current_span.get()
+    return span if span is not None else NOT_SAMPLED
+
+
+def wrap(func):
+    """`func` running in the current span wherever it is called, e.g. on an executor thread."""
+    span = _current_span.get()
+    if span is None or not span.sampled:
+        return func
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        token = _current_span.set(span)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _current_span.reset(token)
+
+    return wrapper
+
+
+def bind(coroutine):
+    """`coroutine` running in the current span when it is scheduled on the loop of another thread."""
+    span = _current_span.get()
+    if span is None or not span.sampled:
+        return coroutine
+
+    async def bound():
+        _current_span.set(span)
+        return await coroutine
+
+    return bound()
+
+
+def traced(name: str = None):
+    """Decorator recording each call of a function or coroutine function as a span of the current trace."""
+
+    def decorator(func):
+        span_name = name or func.__qualname__
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args, **kwargs):
+                with tracer.span(span_name):
+                    return await func(*args, **kwargs)
+
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with tracer.span(span_name):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+tracer = Tracer()
+atexit.register(tracer.flush)
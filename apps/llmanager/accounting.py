@@ -0,0 +1,226 @@
+import atexit
+import logging
+import os
+import threading
+from contextlib import aclosing
+from datetime import datetime, timezone
+from decimal import Decimal
+from typing import AsyncGenerator, Generator, Iterator
+
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F
+
+from aimanager.completions.usage import Usage, track_usage
+from apps.llmanager.models import ModelPrice, UsageRollup
+
+logger = logging.getLogger("django")
+
+COUNTERS = ("turns", "calls", "rounds", "prompt_tokens", "completion_tokens", "cached_tokens")
+ATTRIBUTIONS = ("agent", "bot", "user")
+MILLION = Decimal(1_000_000)
+
+
+def current_period() -> datetime:
+    """Start of the hour rollups are kept for."""
+    return datetime.now(timezone.utc).replace(minute=0, second=0, microsecond=0)
+
+
+def load_prices() -> dict:
+    return {(price.provider, price.model): price for price in ModelPrice.objects.all()}
+
+
+def usage_cost(prices: dict, provider: str, model: str, counts: dict) -> Decimal:
+    """Cost of the tokens by the price of the provider's model, or of the model at any provider; 0 when unknown."""
+    price = prices.get((provider, model)) or prices.get(("", model))
+    if price is None:
+        return Decimal(0)
+    cached_price = price.cached_price if price.cached_price is not None else price.prompt_price
+    cached = min(counts["cached_tokens"], counts["prompt_tokens"])
+    return (
+        (counts["prompt_tokens"] - cached) * price.prompt_price
+        + cached * cached_price
+        + counts["completion_tokens"] * price.completion_price
+    ) / MILLION
+
+
+def _merge(pending: dict, key: tuple, counts: dict) -> None:
+    merged = pending.setdefault(key, dict.fromkeys(COUNTERS, 0))
+    for name, value in counts.items():
+        merged[name] += value
+
+
+class UsageStats:
+    def __init__(self):
+        self.turns = 0
+        self.flushes = 0
+        self.rows = 0
+        self.failed = 0
+
+    def as_dict(self) -> dict:
+        return {"turns": self.turns, "flushes": self.flushes, "rows": self.rows, "failed": self.failed}
+
+
+class UsageStore:
+    """
+    Write-behind store of the usage of agent turns, attributed to an agent, a Telegram bot and a user.
+
+    `add()` only sums a turn into an in-memory buffer keyed by hour, attribution, provider and model,
+    so it is safe on the event loop. A background thread writes the buffer into `UsageRollup` rows every
+    `flush_interval` seconds, earlier when it holds `max_pending` keys, and at exit; zero disables
+    the thread and only `flush()` writes. Rows are incremented in the database, so the flushes of all
+    workers add up. Each rollup is written in its own transaction: a failed one is kept for the next
+    flush without holding back the others, and usage of a deleted agent, bot or user is kept
+    unattributed. Cost is priced by `ModelPrice` at flush time.
+    """
+
+    def __init__(self, flush_interval: float = None, max_pending: int = None):
+        self.flush_interval = (
+            flush_interval if flush_interval is not None else float(os.getenv("USAGE_FLUSH_INTERVAL", 30))
+        )
+        self.max_pending = max_pending or int(os.getenv("USAGE_MAX_PENDING", 1000))
+        self.stats = UsageStats()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+
+    def add(self, usage: Usage, agent_id: int = None, bot_id: int = None, user_id: int = None) -> None:
+        if not usage.models:
+            return
+        period = current_period()
+        # the turn and its tool rounds are counted once, for the model that made most of its calls
+        primary = max(usage.models, key=lambda provider_model: usage.models[provider_model].calls)
+        with self._lock:
+            for (provider, model), model_usage in usage.models.items():
+                key = (period, agent_id, bot_id, user_id, provider or "", model)
+                counts = self._pending.setdefault(key, dict.fromkeys(COUNTERS, 0))
+                counts["calls"] += model_usage.calls
+                counts["prompt_tokens"] += model_usage.prompt_tokens
+                counts["completion_tokens"] += model_usage.completion_tokens
+                counts["cached_tokens"] += model_usage.cached_tokens
+                if (provider, model) == primary:
+                    counts["turns"] += 1
+                    counts["rounds"] += usage.rounds
+            self.stats.turns += 1
+            full = len(self._pending) >= self.max_pending
+        if self.flush_interval:
+            self._start()
+            if full:
+                self._wakeup.set()
+
+    def track(self, chunks: Iterator, **attribution) -> Generator:
+        """Pass the chunks of a streamed turn through and add its usage, also of an aborted one."""
+        with track_usage() as usage:
+            try:
+                yield from chunks
+            finally:
+                self.add(usage, **attribution)
+
+    async def async_track(self, events: AsyncGenerator, **attribution) -> AsyncGenerator:
+        with track_usage() as usage:
+            try:
+                async with aclosing(events):
+                    async for event in events:
+                        yield event
+            finally:
+                self.add(usage, **attribution)
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run, name="usage-store", daemon=True)
+                self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            finally:
+                # the connection of this thread would otherwise stay open between flushes
+                connection.close()
+
+    def flush(self) -> int:
+        """Write the buffered usage into the database, return the number of rows written."""
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, {}
+            if not pending:
+                return 0
+            try:
+                prices = load_prices()
+                pending = self._without_deleted(pending)
+            except Exception as e:
+                logger.error(f"Failed to write the usage of {len(pending)} rollups, retrying later: {e}")
+                self.stats.failed += 1
+                self._restore(pending)
+                return 0
+            failed = {}
+            for key, counts in pending.items():
+                try:
+                    # a savepoint per rollup: foreign keys are checked at its commit, not the whole batch's
+                    with transaction.atomic():
+                        self._write(key, counts, prices)
+                except Exception as e:
+                    logger.error(f"Failed to write the usage rollup {key}, retrying later: {e}")
+                    failed[key] = counts
+            if failed:
+                self.stats.failed += 1
+                self._restore(failed)
+            written = len(pending) - len(failed)
+            self.stats.flushes += 1
+            self.stats.rows += written
+            return written
+
+    @staticmethod
+    def _without_deleted(pending: dict) -> dict:
+        """The rollups with the agents, bots and users deleted since the turn left unattributed."""
+        existing = []
+        for index, name in enumerate(ATTRIBUTIONS, start=1):
+            ids = {key[index] for key in pending if key[index] is not None}
+            model = UsageRollup._meta.get_field(name).related_model
+            existing.append(set(model.objects.filter(id__in=ids).values_list("id", flat=True)) if ids else set())
+        merged = {}
+        for key, counts in pending.items():
+            period, *ids, provider, model = key
+            ids = [value if value in found else None for value, found in zip(ids, existing)]
+            _merge(merged, (period, *ids, provider, model), counts)
+        return merged
+
+    @staticmethod
+    def _write(key: tuple, counts: dict, prices: dict) -> None:
+        period, agent_id, bot_id, user_id, provider, model = key
+        lookup = {
+            "period": period,
+            "agent_id": agent_id,
+            "bot_id": bot_id,
+            "user_id": user_id,
+            "provider": provider,
+            "model": model,
+        }
+        values = {**counts, "cost": usage_cost(prices, provider, model, counts)}
+        increments = {name: F(name) + value for name, value in values.items()}
+        if UsageRollup.objects.filter(**lookup).update(**increments):
+            return
+        try:
+            with transaction.atomic():
+                UsageRollup.objects.create(**lookup, **values)
+        except IntegrityError:
+            # another worker created the row since, the unique key of the rollups made this a conflict
+            UsageRollup.objects.filter(**lookup).update(**increments)
+
+    def _restore(self, pending: dict) -> None:
+        with self._lock:
+            for key, counts in pending.items():
+                _merge(self._pending, key, counts)
+
+    def report(self) -> dict:
+        with self._lock:
+            pending = len(self._pending)
+        return {**self.stats.as_dict(), "pending": pending}
+
+
+usage_store = UsageStore()
+atexit.register(usage_store.flush)
@@ -1,8 +1,22 @@
 from django.contrib import admin
 from solo.admin import SingletonModelAdmin
-from .models import DefaultConfig, Conversation, Agent
+from .models import DefaultConfig, Conversation, Agent, ModelPrice, UsageRollup
+
+
+class ModelPriceAdmin(admin.ModelAdmin):
+    list_display = ("model", "provider", "prompt_price", "cached_price", "completion_price")
+    search_fields = ("model", "provider")
+
+
+class UsageRollupAdmin(admin.ModelAdmin):
+    list_display = ("period", "agent", "bot", "user", "provider", "model", "calls", "prompt_tokens", "cost")
+    list_filter = ("provider", "model", "agent")
+    raw_id_fields = ("user", "bot")
+    date_hierarchy = "period"
 
 
 admin.site.register(DefaultConfig, SingletonModelAdmin)
 admin.site.register(Conversation)
 admin.site.register(Agent)
+admin.site.register(ModelPrice, ModelPriceAdmin)
+admin.site.register(UsageRollup, UsageRollupAdmin)
@@ -0,0 +1,198 @@
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+
+WORDS = (
+    "the assistant answers every question with care and gives clear short steps so the user can follow "
+    "along and ask again when something is missing from the answer"
+).split()
+
+
+class FakeCompletionSettings:
+    """
+    Behaviour of the fake completions server:
+    `latency` seconds (+ up to `jitter`) before the first chunk, `token_rate` tokens per second after it
+    (0 sends them at once), `chunk_tokens` tokens per streamed chunk, `response_tokens` per answer,
+    `error_rate` of requests failing with `error_status` and `tool_call_rate` of requests with tools
+    answered by a call of the first tool.
+    """
+
+    def __init__(
+        self,
+        latency: float = None,
+        jitter: float = None,
+        token_rate: float = None,
+        chunk_tokens: int = None,
+        response_tokens: int = None,
+        error_rate: float = None,
+        error_status: int = None,
+        tool_call_rate: float = None,
+    ):
+        self.latency = latency if latency is not None else float(os.getenv("FAKE_LLM_LATENCY", 0.3))
+        self.jitter = jitter if jitter is not None else float(os.getenv("FAKE_LLM_JITTER", 0.1))
+        self.token_rate = token_rate if token_rate is not None else float(os.getenv("FAKE_LLM_TOKEN_RATE", 80))
+        self.chunk_tokens = chunk_tokens or int(os.getenv("FAKE_LLM_CHUNK_TOKENS", 1))
+        self.response_tokens = response_tokens or int(os.getenv("FAKE_LLM_RESPONSE_TOKENS", 120))
+        self.error_rate = error_rate if error_rate is not None else float(os.getenv("FAKE_LLM_ERROR_RATE", 0))
+        self.error_status = error_status or int(os.getenv("FAKE_LLM_ERROR_STATUS", 500))
+        self.tool_call_rate = (
+            tool_call_rate if tool_call_rate is not None else float(os.getenv("FAKE_LLM_TOOL_CALL_RATE", 0))
+        )
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+def _prompt_tokens(messages: list) -> int:
+    # about 4 characters a token, like `estimate_tokens`
+    return sum(len(str(message.get("content") or "")) for message in messages) // 4 + 1
+
+
+def _placeholder(schema: dict):
+    kind = schema.get("type")
+    if kind in ("integer", "number"):
+        return 1
+    if kind == "boolean":
+        return True
+    if kind == "array":
+        return []
+    if kind == "object":
+        return {}
+    return "benchmark"
+
+
+def _tool_arguments(tool: dict) -> str:
+    parameters = tool.get("function", {}).get("parameters") or {}
+    properties = parameters.get("properties") or {}
+    required = parameters.get("required", list(properties))
+    return json.dumps({name: _placeholder(properties.get(name, {})) for name in required})
+
+
+class FakeOpenAIServer:
+    """
+    ASGI app standing in for an OpenAI-compatible API in benchmarks: `POST /v1/chat/completions`
+    (plain and streamed, with the `include_usage` chunk) and `GET /v1/models`. Point
+    `CustomOpenAIApiProvider` at it with `CUSTOM_OPENAI_HOST=http://127.0.0.1` and `CUSTOM_OPENAI_PORT`.
+    A tool call is only answered to a user message, so agent tool loops end after one round.
+    """
+
+    def __init__(self, settings: FakeCompletionSettings = None, seed: int = None):
+        self.settings = settings or FakeCompletionSettings()
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.errors = 0
+        self.tool_calls = 0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return
+        path, method = scope["path"].rstrip("/"), scope["method"]
+        if method == "GET" and path.endswith("/models"):
+            await self._json(send, 200, {"object": "list", "data": [{"id": "fake", "object": "model"}]})
+        elif method == "POST" and path.endswith("/chat/completions"):
+            await self._completion(json.loads(await self._body(receive) or b"{}"), send)
+        else:
+            await self._json(send, 404, {"error": {"message": f"No route {method} {path}", "type": "not_found"}})
+
+    @staticmethod
+    async def _body(receive) -> bytes:
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if not message.get("more_body"):
+                return body
+
+    @staticmethod
+    async def _json(send, status: int, data: dict, headers: list = ()) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": status,
+                "headers": [(b"content-type", b"application/json"), *headers],
+            }
+        )
+        await send({"type": "http.response.body", "body": json.dumps(data).encode()})
+
+    def _tool_call(self, request: dict) -> dict:
+        tools = request.get("tools")
+        messages = request.get("messages") or [{}]
+        if not tools or messages[-1].get("role") != "user" or self.random.random() >= self.settings.tool_call_rate:
+            return None
+        self.tool_calls += 1
+        return {
+            "index": 0,
+            "id": f"call_{uuid.uuid4().hex[:24]}",
+            "type": "function",
+            "function": {"name": tools[0]["function"]["name"], "arguments": _tool_arguments(tools[0])},
+        }
+
+    def _tokens(self) -> list[str]:
+        return [" " + WORDS[index % len(WORDS)] for index in range(self.settings.response_tokens)]
+
+    async def _completion(self, request: dict, send) -> None:
+        settings = self.settings
+        self.requests += 1
+        await asyncio.sleep(settings.latency + self.random.uniform(0, settings.jitter))
+        if self.random.random() < settings.error_rate:
+            self.errors += 1
+            error = {"error": {"message": "Injected error", "type": "server_error", "code": settings.error_status}}
+            await self._json(send, settings.error_status, error, [(b"retry-after", b"1")])
+            return
+
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        model = request.get("model", "fake")
+        tool_call = self._tool_call(request)
+        tokens = [] if tool_call else self._tokens()
+        usage = {
+            "prompt_tokens": _prompt_tokens(request.get("messages") or []),
+            "completion_tokens": len(tokens) or 20,
+            "total_tokens": 0,
+        }
+        usage["total_tokens"] = usage["prompt_tokens"] + usage["completion_tokens"]
+        base = {"id": completion_id, "created": int(time.time()), "model": model}
+
+        if not request.get("stream"):
+            if settings.token_rate:
+                await asyncio.sleep(usage["completion_tokens"] / settings.token_rate)
+            message = {"role": "assistant", "content": None if tool_call else "".join(tokens).strip()}
+            if tool_call:
+                message["tool_calls"] = [{key: value for key, value in tool_call.items() if key != "index"}]
+            choice = {"index": 0, "message": message, "finish_reason": "tool_calls" if tool_call else "stop"}
+            await self._json(send, 200, {**base, "object": "chat.completion", "choices": [choice], "usage": usage})
+            return
+
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 200,
+                "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache")],
+            }
+        )
+
+        async def event(delta: dict = None, finish_reason: str = None, totals: dict = None) -> None:
+            # the usage chunk at the end has no choices
+            choices = [] if totals else [{"index": 0, "delta": delta or {}, "finish_reason": finish_reason}]
+            chunk = {**base, "object": "chat.completion.chunk", "choices": choices, "usage": totals}
+            await send(
+                {"type": "http.response.body", "body": f"data: {json.dumps(chunk)}\n\n".encode(), "more_body": True}
+            )
+
+        await event({"role": "assistant", "content": ""})
+        if tool_call:
+            await event({"tool_calls": [tool_call]})
+        for start in range(0, len(tokens), settings.chunk_tokens):
+            chunk = tokens[start : start + settings.chunk_tokens]
+            if settings.token_rate:
+                await asyncio.sleep(len(chunk) / settings.token_rate)
+            await event({"content": "".join(chunk)})
+        await event(finish_reason="tool_calls" if tool_call else "stop")
+        if (request.get("stream_options") or {}).get("include_usage"):
+            await event(totals=usage)
+        await send({"type": "http.response.body", "body": b"data: [DONE]\n\n"})
+
+    def report(self) -> dict:
+        return {"requests": self.requests, "errors": self.errors, "tool_calls": self.tool_calls}
@@ -0,0 +1,310 @@
+import asyncio
+import logging
+import math
+import os
+import time
+
+import httpx
+
+logger = logging.getLogger("django")
+
+# (metric path in the results, True when higher is better)
+COMPARED_METRICS = (
+    ("load.requests_per_second", True),
+    ("load.ttft.p50", False),
+    ("load.ttft.p95", False),
+    ("load.ttft.p99", False),
+    ("load.latency.p50", False),
+    ("load.latency.p95", False),
+    ("load.latency.p99", False),
+    ("load.error_rate", False),
+    ("server.cpu_percent", False),
+    ("server.rss_mb_peak", False),
+)
+
+
+def percentile(values: list, q: float) -> float:
+    """Nearest-rank percentile, `q` in 0..100; None without values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(max(math.ceil(q / 100 * len(ordered)) - 1, 0), len(ordered) - 1)
+    return ordered[index]
+
+
+def _summary(values: list) -> dict:
+    return {name: _round(percentile(values, q)) for name, q in (("p50", 50), ("p95", 95), ("p99", 99))}
+
+
+def _round(value, digits: int = 4):
+    return round(value, digits) if value is not None else None
+
+
+class ProcessSampler:
+    """
+    CPU time and resident memory of a server process and its worker processes, read from /proc.
+    Only Linux has /proc; elsewhere `report()` is empty.
+    """
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.available = os.path.isdir(f"/proc/{pid}")
+        self.page_size = os.sysconf("SC_PAGE_SIZE") if self.available else 0
+        self.ticks = os.sysconf("SC_CLK_TCK") if self.available else 0
+        self.rss_samples = []
+        self.workers = 0
+        self._cpu = {}
+        self._started = None
+
+    def _children(self) -> list[int]:
+        children = []
+        for entry in os.listdir("/proc"):
+            if entry.isdigit():
+                stat = self._stat(int(entry))
+                if stat and int(stat[1]) == self.pid:
+                    children.append(int(entry))
+        return children
+
+    @staticmethod
+    def _stat(pid: int) -> list:
+        try:
+            with open(f"/proc/{pid}/stat") as f:
+                # the command name may contain spaces, the fields after it don't
+                return f.read().rpartition(")")[2].split()
+        except OSError:
+            return None
+
+    def _rss(self, pid: int) -> int:
+        try:
+            with open(f"/proc/{pid}/statm") as f:
+                return int(f.read().split()[1]) * self.page_size
+        except OSError:
+            return 0
+
+    def sample(self) -> None:
+        if not self.available:
+            return
+        pids = [self.pid] + self._children()
+        rss = 0
+        for pid in pids:
+            stat = self._stat(pid)
+            if stat is None:
+                continue
+            # utime and stime in clock ticks; a worker that exited keeps its last reading
+            self._cpu[pid] = (int(stat[11]) + int(stat[12])) / self.ticks
+            rss += self._rss(pid)
+        self.workers = max(self.workers, len(pids) - 1)
+        self.rss_samples.append(rss)
+
+    def cpu_seconds(self) -> float:
+        return sum(self._cpu.values())
+
+    def start(self) -> None:
+        """Start measuring, e.g. at the end of the warmup."""
+        self.sample()
+        self.rss_samples = []
+        self._started = (time.monotonic(), self.cpu_seconds())
+
+    async def run(self) -> None:
+        while True:
+            self.sample()
+            await asyncio.sleep(self.interval)
+
+    def report(self) -> dict:
+        if not self.available or self._started is None:
+            return {}
+        self.sample()
+        started, cpu = self._started
+        elapsed = time.monotonic() - started
+        mb = 1024 * 1024
+        return {
+            "workers": self.workers,
+            # percent of one core, summed over the processes
+            "cpu_percent": _round((self.cpu_seconds() - cpu) / elapsed * 100 if elapsed > 0 else 0, 1),
+            "rss_mb_peak": _round(max(self.rss_samples) / mb, 1),
+            "rss_mb_avg": _round(sum(self.rss_samples) / len(self.rss_samples) / mb, 1),
+        }
+
+
+class LoadStats:
+    """Turns of the virtual users finished after the warmup."""
+
+    def __init__(self):
+        self.ttft = []
+        self.latency = []
+        self.requests = 0
+        self.errors = {}
+        self.started = None
+        self.finished = None
+
+    def add(self, status: int, ttft: float, latency: float, error: str = None) -> None:
+        self.requests += 1
+        if error is not None or status >= 400:
+            key = error or str(status)
+            self.errors[key] = self.errors.get(key, 0) + 1
+            return
+        if ttft is not None:
+            self.ttft.append(ttft)
+        self.latency.append(latency)
+
+    def as_dict(self) -> dict:
+        if self.started is None:
+            elapsed = 0
+        else:
+            elapsed = (self.finished if self.finished is not None else time.monotonic()) - self.started
+        succeeded = len(self.latency)
+        failed = sum(self.errors.values())
+        return {
+            "seconds": _round(elapsed, 2),
+            "requests": self.requests,
+            "succeeded": succeeded,
+            "errors": self.errors,
+            "error_rate": _round(failed / self.requests if self.requests else 0),
+            "requests_per_second": _round(succeeded / elapsed if elapsed else 0, 2),
+            "ttft": _summary(self.ttft),
+            "latency": _summary(self.latency),
+        }
+
+
+class VirtualUser:
+    """One chat user: an API token and the conversation it keeps sending prompts to."""
+
+    def __init__(self, token: str, conversation_id: int):
+        self.token = token
+        self.conversation_id = conversation_id
+
+    @property
+    def headers(self) -> dict:
+        return {"Authorization": f"Token {self.token}"}
+
+
+class LoadGenerator:
+    """
+    Closed-loop load on a conversation: every virtual user sends a prompt, reads the answer to its end
+    and sends the next one after `think_time` seconds. Only turns started after `warmup` seconds are
+    counted. With `stream` the prompts go to the SSE endpoint `/chatbot/conversation/<id>/stream/` and
+    time to first token is the time to the first `delta` event; the deprecated sync endpoint
+    `/chatbot/conversation/<id>/` answers at once behind ASGI, its turns have no time to first token.
+    """
+
+    def __init__(
+        self,
+        url: str,
+        users: list[VirtualUser],
+        prompt: str,
+        duration: float,
+        warmup: float = 0,
+        think_time: float = 0,
+        timeout: float = 120,
+        sampler: ProcessSampler = None,
+        stream: bool = True,
+    ):
+        self.url = url.rstrip("/")
+        self.users = users
+        self.prompt = prompt
+        self.duration = duration
+        self.warmup = warmup
+        self.think_time = think_time
+        self.timeout = timeout
+        self.sampler = sampler
+        self.stream = stream
+        self.stats = LoadStats()
+
+    def conversation_url(self, user: VirtualUser) -> str:
+        return f"{self.url}/chatbot/conversation/{user.conversation_id}/"
+
+    def prompt_url(self, user: VirtualUser) -> str:
+        return f"{self.conversation_url(user)}stream/" if self.stream else self.conversation_url(user)
+
+    async def turn(self, client: httpx.AsyncClient, user: VirtualUser) -> tuple:
+        started = time.monotonic()
+        status, ttft, error = 0, None, None
+        try:
+            request = client.stream("POST", self.prompt_url(user), json={"prompt": self.prompt}, headers=user.headers)
+            async with request as response:
+                status = response.status_code
+                if not self.stream or status >= 400:
+                    await response.aread()
+                else:
+                    async for line in response.aiter_lines():
+                        if line == "event: delta" and ttft is None:
+                            ttft = time.monotonic() - started
+                        elif line == "event: error":
+                            error = "stream_error"
+        except httpx.HTTPError as e:
+            error = type(e).__name__
+        return started, status, ttft, time.monotonic() - started, error
+
+    async def user_loop(self, client: httpx.AsyncClient, user: VirtualUser, measured_from: float, deadline: float):
+        while time.monotonic() < deadline:
+            started, status, ttft, latency, error = await self.turn(client, user)
+            if started >= measured_from:
+                self.stats.add(status, ttft, latency, error)
+            failed = error is not None or status >= 400
+            # a failing server is not hammered in a busy loop
+            pause = max(self.think_time, 0.1 if failed else 0)
+            if pause:
+                await asyncio.sleep(pause)
+
+    async def _measure(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self.stats.started = time.monotonic()
+        if self.sampler is not None:
+            self.sampler.start()
+
+    async def run(self) -> dict:
+        now = time.monotonic()
+        measured_from, deadline = now + self.warmup, now + self.warmup + self.duration
+        limits = httpx.Limits(max_connections=len(self.users), max_keepalive_connections=len(self.users))
+        sampling = asyncio.create_task(self.sampler.run()) if self.sampler is not None else None
+        try:
+            async with httpx.AsyncClient(timeout=self.timeout, limits=limits) as client:
+                await asyncio.gather(
+                    self._measure(self.warmup),
+                    *(self.user_loop(client, user, measured_from, deadline) for user in self.users),
+                )
+        finally:
+            if sampling is not None:
+                sampling.cancel()
+        # users finish their last turn after the deadline, throughput is counted until then
+        self.stats.finished = time.monotonic()
+        return {"load": self.stats.as_dict(), "server": self.sampler.report() if self.sampler else {}}
+
+    async def clear(self) -> None:
+        """Delete the conversations of the users, with their memory."""
+        async with httpx.AsyncClient(timeout=self.timeout) as client:
+            for user in self.users:
+                try:
+                    await client.delete(self.conversation_url(user), headers=user.headers)
+                except httpx.HTTPError as e:
+                    logger.warning(f"Failed to delete benchmark conversation {user.conversation_id}: {e}")
+
+
+def _lookup(results: dict, path: str):
+    for key in path.split("."):
+        if not isinstance(results, dict):
+            return None
+        results = results.get(key)
+    return results
+
+
+def compare(results: dict, baseline: dict, tolerance: float = 0.1) -> list[dict]:
+    """Metrics of the results against a baseline; `regressed` when worse by more than `tolerance`."""
+    rows = []
+    for path, higher_is_better in COMPARED_METRICS:
+        current, base = _lookup(results, path), _lookup(baseline, path)
+        if current is None or base is None:
+            continue
+        change = (current - base) / base if base else (0 if current == base else float("inf"))
+        worse = -change if higher_is_better else change
+        rows.append(
+            {
+                "metric": path,
+                "baseline": base,
+                "current": current,
+                "change": _round(change),
+                "regressed": worse > tolerance and abs(current - base) > 1e-3,
+            }
+        )
+    return rows
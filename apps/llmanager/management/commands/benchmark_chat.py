@@ -0,0 +1,199 @@
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+from pathlib import Path
+
+import httpx
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.authtoken.models import Token
+
+from apps.llmanager.benchmark.load import LoadGenerator, ProcessSampler, VirtualUser, compare
+from apps.llmanager.repositories.conversation import ConversationRepository
+from apps.llmanager.repositories.provider_config import ConfigRepository
+
+from .fake_openai_server import FAKE_LLM_OPTIONS, add_fake_llm_arguments, fake_llm_settings
+
+PROJECT_DIR = Path(__file__).resolve().parents[4]
+
+
+class Command(BaseCommand):
+    help = (
+        "Load test /chatbot/conversation/<id>/stream/ end to end: starts the fake OpenAI-compatible server and the "
+        "ASGI app under gunicorn with the custom provider pointed at it, drives concurrent users through it "
+        "and reports requests/s, time to first token, turn latency and worker CPU and memory. Needs the "
+        "database and Redis of the settings. Results are saved as JSON and compared with --baseline."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=10, help="concurrent virtual users")
+        parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+        parser.add_argument("--warmup", type=float, default=5, help="seconds of load before measuring")
+        parser.add_argument("--think-time", type=float, default=0, help="seconds a user waits between turns")
+        parser.add_argument("--prompt", default="Give me three tips for a productive morning.")
+        parser.add_argument(
+            "--endpoint",
+            choices=("stream", "sync"),
+            default="stream",
+            help="the SSE endpoint, or the deprecated sync one that has no time to first token",
+        )
+        parser.add_argument("--model", default="fake-model", help="model the default config is switched to")
+        parser.add_argument("--workers", type=int, default=2, help="gunicorn workers of the app")
+        parser.add_argument("--port", type=int, default=8055, help="port of the app")
+        parser.add_argument("--fake-port", type=int, default=5055, help="port of the fake completions server")
+        parser.add_argument(
+            "--url", help="benchmark an app already running there; its custom provider must use the fake server"
+        )
+        parser.add_argument("--server-pid", type=int, help="process of the --url app to measure CPU and memory of")
+        parser.add_argument("--output", default="benchmark-results.json", help="JSON file the results are saved to")
+        parser.add_argument("--baseline", help="results of an earlier run to compare with")
+        parser.add_argument("--tolerance", type=float, default=0.1, help="allowed change before a regression")
+        add_fake_llm_arguments(parser)
+
+    def handle(self, *args, **options):
+        fake_llm = fake_llm_settings(options)
+        processes = []
+        try:
+            if options["url"]:
+                url, pid = options["url"], options["server_pid"]
+            else:
+                processes.append(self.start_fake_llm(fake_llm, options))
+                self.wait_ready(f"http://127.0.0.1:{options['fake_port']}/v1/models", processes[-1])
+                processes.append(self.start_app(options))
+                url, pid = f"http://127.0.0.1:{options['port']}", processes[-1].pid
+                self.wait_ready(f"{url}/chatbot/agents/", processes[-1])
+            users = self.create_users(options["users"])
+            generator = LoadGenerator(
+                url,
+                users,
+                options["prompt"],
+                duration=options["duration"],
+                warmup=options["warmup"],
+                think_time=options["think_time"],
+                sampler=ProcessSampler(pid) if pid else None,
+                stream=options["endpoint"] == "stream",
+            )
+            self.stdout.write(f"Running {len(users)} users against {url} for {options['duration']:g}s ...")
+            with self.benchmark_config(options["model"]):
+                try:
+                    measured = asyncio.run(generator.run())
+                finally:
+                    asyncio.run(generator.clear())
+        finally:
+            for process in reversed(processes):
+                self.stop(process)
+
+        results = {
+            "started_at": timezone.now().isoformat(),
+            "options": {
+                name: options[name]
+                for name in ("users", "duration", "warmup", "think_time", "prompt", "endpoint", "model", "workers")
+            },
+            "fake_llm": fake_llm.as_dict() if not options["url"] else None,
+            **measured,
+        }
+        with open(options["output"], "w") as f:
+            json.dump(results, f, indent=2)
+        self.stdout.write(json.dumps(measured, indent=2))
+        self.stdout.write(self.style.SUCCESS(f"Results saved to {options['output']}"))
+        if options["baseline"]:
+            self.compare(results, options["baseline"], options["tolerance"])
+
+    def start_fake_llm(self, fake_llm, options: dict) -> subprocess.Popen:
+        command = [sys.executable, "manage.py", "fake_openai_server", "--port", str(options["fake_port"])]
+        for name in FAKE_LLM_OPTIONS:
+            command += [f"--{name.replace('_', '-')}", str(getattr(fake_llm, name))]
+        if options["seed"] is not None:
+            command += ["--seed", str(options["seed"])]
+        return subprocess.Popen(command, cwd=PROJECT_DIR)
+
+    def start_app(self, options: dict) -> subprocess.Popen:
+        env = {
+            **os.environ,
+            "CUSTOM_OPENAI_HOST": "http://127.0.0.1",
+            "CUSTOM_OPENAI_PORT": str(options["fake_port"]),
+            "CUSTOM_OPENAI_API_KEY": "benchmark",
+        }
+        command = [
+            sys.executable,
+            "-m",
+            "gunicorn",
+            "main.asgi:application",
+            "--worker-class",
+            "uvicorn_worker.UvicornWorker",
+            "--workers",
+            str(options["workers"]),
+            "--bind",
+            f"127.0.0.1:{options['port']}",
+            "--timeout",
+            "120",
+            "--log-level",
+            "warning",
+        ]
+        return subprocess.Popen(command, cwd=PROJECT_DIR, env=env)
+
+    @staticmethod
+    def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60) -> None:
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError(f"{' '.join(process.args)} exited with {process.returncode}")
+            try:
+                # any answer, also 401, means the server is up
+                httpx.get(url, timeout=1)
+                return
+            except httpx.HTTPError:
+                time.sleep(0.2)
+        raise CommandError(f"{url} did not answer within {timeout:g}s")
+
+    @staticmethod
+    def stop(process: subprocess.Popen) -> None:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+    @staticmethod
+    def create_users(count: int) -> list[VirtualUser]:
+        """A user per virtual user, so admission control sees them as separate tenants."""
+        users = []
+        for index in range(count):
+            user, created = get_user_model().objects.get_or_create(username=f"benchmark-{index}")
+            if created:
+                user.set_unusable_password()
+                user.save()
+            token, _ = Token.objects.get_or_create(user=user)
+            conversation = ConversationRepository.create(user.id, title="benchmark")
+            users.append(VirtualUser(token.key, conversation.id))
+        return users
+
+    @contextmanager
+    def benchmark_config(self, model: str):
+        """The default config on the custom provider during the run, restored afterwards."""
+        config = ConfigRepository.get_default()
+        previous = config.provider, config.model
+        config.provider, config.model = "custom", model
+        config.save()
+        try:
+            yield
+        finally:
+            config.provider, config.model = previous
+            config.save()
+
+    def compare(self, results: dict, baseline_path: str, tolerance: float) -> None:
+        with open(baseline_path) as f:
+            baseline = json.load(f)
+        rows = compare(results, baseline, tolerance)
+        for row in rows:
+            line = f"{row['metric']}: {row['baseline']} -> {row['current']} ({row['change']:+.1%})"
+            self.stdout.write(self.style.ERROR(line) if row["regressed"] else line)
+        regressed = [row["metric"] for row in rows if row["regressed"]]
+        if regressed:
+            raise CommandError(f"Regressed beyond {tolerance:.0%} of {baseline_path}: {', '.join(regressed)}")
+        self.stdout.write(self.style.SUCCESS(f"No regressions against {baseline_path}"))
@@ -0,0 +1,49 @@
+import uvicorn
+from django.core.management.base import BaseCommand
+
+from apps.llmanager.benchmark.fake_openai import FakeCompletionSettings, FakeOpenAIServer
+
+FAKE_LLM_OPTIONS = (
+    "latency",
+    "jitter",
+    "token_rate",
+    "chunk_tokens",
+    "response_tokens",
+    "error_rate",
+    "error_status",
+    "tool_call_rate",
+)
+
+
+def add_fake_llm_arguments(parser) -> None:
+    parser.add_argument("--latency", type=float, help="seconds before the first chunk")
+    parser.add_argument("--jitter", type=float, help="up to these seconds are added to the latency")
+    parser.add_argument("--token-rate", type=float, help="tokens per second, 0 sends the answer at once")
+    parser.add_argument("--chunk-tokens", type=int, help="tokens per streamed chunk")
+    parser.add_argument("--response-tokens", type=int, help="tokens of an answer")
+    parser.add_argument("--error-rate", type=float, help="fraction of requests failing")
+    parser.add_argument("--error-status", type=int, help="HTTP status of failed requests, e.g. 429 or 500")
+    parser.add_argument("--tool-call-rate", type=float, help="fraction of requests with tools answered by a call")
+    parser.add_argument("--seed", type=int, help="seed of the random latency, errors and tool calls")
+
+
+def fake_llm_settings(options: dict) -> FakeCompletionSettings:
+    return FakeCompletionSettings(**{name: options[name] for name in FAKE_LLM_OPTIONS})
+
+
+class Command(BaseCommand):
+    help = (
+        "Run a local OpenAI-compatible stand-in for benchmarks. Point the custom provider at it with "
+        "CUSTOM_OPENAI_HOST=http://127.0.0.1 and CUSTOM_OPENAI_PORT=<port>."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--host", default="127.0.0.1")
+        parser.add_argument("--port", type=int, default=5055)
+        add_fake_llm_arguments(parser)
+
+    def handle(self, *args, **options):
+        settings = fake_llm_settings(options)
+        self.stdout.write(f"Fake completions on http://{options['host']}:{options['port']}/v1 {settings.as_dict()}")
+        server = FakeOpenAIServer(settings, seed=options["seed"])
+        uvicorn.run(server, host=options["host"], port=options["port"], log_level="warning", lifespan="off")
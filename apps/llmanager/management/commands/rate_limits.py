@@ -0,0 +1,17 @@
+import json
+
+from django.core.management.base import BaseCommand
+
+from aimanager.completions.ratelimit import rate_limiter
+
+
+class Command(BaseCommand):
+    help = "Show the shared rate limiter state of every provider, API key and model, as all workers see it"
+
+    def handle(self, *args, **options):
+        state = rate_limiter().state()
+        if not state:
+            self.stdout.write("No rate limited requests yet, limits are configured in RATE_LIMITS")
+            return
+        for key, values in sorted(state.items()):
+            self.stdout.write(f"{key}: {json.dumps(values)}")
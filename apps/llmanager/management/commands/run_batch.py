@@ -0,0 +1,93 @@
+import asyncio
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from aimanager.agent.batch import BatchRunner, read_records
+from aimanager.agent.builder import async_agent_pool
+from aimanager.completions.transport import shared_transport
+from apps.llmanager.repositories.agent import AgentRepository
+from apps.llmanager.repositories.provider_config import ConfigRepository
+
+
+class Command(BaseCommand):
+    help = (
+        "Answer the prompts of a JSONL file with async agents. Input records have `prompt`, `user` and "
+        "optional `agent` (id or name), `conversation` and `id`. Run it again with the same output to resume."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("input", help="JSONL file with the records to answer")
+        parser.add_argument("output", help="JSONL file the results are appended to")
+        parser.add_argument("--concurrency", type=int, help="records answered at a time")
+        parser.add_argument(
+            "--rate-limit",
+            action="append",
+            default=[],
+            metavar="PROVIDER=RPM",
+            help="completion calls per minute to a provider, tool rounds included, can be repeated",
+        )
+        parser.add_argument("--progress-interval", type=float, help="seconds between progress lines")
+
+    def handle(self, *args, **options):
+        runner = BatchRunner(
+            self.resolve_agent,
+            concurrency=options["concurrency"],
+            rate_limits=self.parse_rate_limits(options["rate_limit"]),
+            progress=self.print_progress,
+            progress_interval=options["progress_interval"],
+        )
+        self.agents = {}
+        stats = asyncio.run(self.run(runner, options))
+        self.stdout.write(self.style.SUCCESS(f"Batch finished: {json.dumps(stats)}"))
+
+    @staticmethod
+    async def run(runner: BatchRunner, options: dict) -> dict:
+        try:
+            return await runner.run(read_records(options["input"]), options["output"])
+        finally:
+            # the pooled connections belong to this loop, which closes with the command
+            await shared_transport.aclose()
+
+    @staticmethod
+    def parse_rate_limits(values: list[str]) -> dict:
+        limits = {}
+        for value in values:
+            provider, _, per_minute = value.partition("=")
+            try:
+                limits[provider] = float(per_minute)
+            except ValueError:
+                raise CommandError(f"Invalid rate limit {value!r}, expected PROVIDER=RPM")
+        return limits
+
+    def print_progress(self, stats: dict) -> None:
+        self.stdout.write(
+            f"done {stats['done']}, failed {stats['failed']}, skipped {stats['skipped']} | "
+            f"{stats['records_per_second']} records/s, error rate {stats['error_rate']:.1%} | "
+            f"{stats['prompt_tokens']} prompt + {stats['completion_tokens']} completion tokens"
+        )
+
+    async def resolve_agent(self, record: dict):
+        agent = record.get("agent")
+        if agent not in self.agents:
+            # agent records are read once per batch
+            self.agents[agent] = await self.load_agent_model(agent)
+        agent_model = self.agents[agent]
+        if agent_model is None:
+            config = await ConfigRepository.async_get_default()
+            return async_agent_pool.get(agent_name=config.agent, provider=config.provider, model=config.model)
+        return async_agent_pool.get(
+            agent_name="base",
+            provider=agent_model.provider,
+            model=agent_model.model,
+            system_prompt=agent_model.instructions,
+            metadata=agent_model.metadata,
+        )
+
+    @staticmethod
+    async def load_agent_model(agent):
+        if agent is None:
+            return None
+        if isinstance(agent, int) or str(agent).isdigit():
+            return await AgentRepository.async_get(int(agent))
+        return await AgentRepository.async_get_agent_by_name(agent)
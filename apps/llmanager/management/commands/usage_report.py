@@ -0,0 +1,31 @@
+import json
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from apps.llmanager.repositories.usage import UsageRepository
+
+
+class Command(BaseCommand):
+    help = "Show token usage and cost of completions, summed per agent, bot, user, provider, model or period"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--by",
+            default="model",
+            help="comma separated fields to group by: agent, bot, user, provider, model, hour, day, month",
+        )
+        parser.add_argument("--days", type=int, default=30, help="usage of the last days")
+
+    def handle(self, *args, **options):
+        group_by = [name.strip() for name in options["by"].split(",") if name.strip()]
+        since = timezone.now() - timedelta(days=options["days"])
+        rows = UsageRepository.rollup(group_by, since=since)
+        if not rows:
+            self.stdout.write("No usage recorded yet, model prices are set in the admin")
+            return
+        for row in rows:
+            self.stdout.write(json.dumps(row, default=str))
+        totals = UsageRepository.totals(since=since)
+        self.stdout.write(self.style.SUCCESS(f"Total: {json.dumps(totals, default=str)}"))
@@ -0,0 +1,85 @@
+# Generated by Django 5.1.5 on 2026-10-18 10:32
+
+import django.db.models.deletion
+import django.db.models.functions.comparison
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    dependencies = [
+        ("llmanager", "0003_agent_conversation_agent"),
+        ("telegrambot", "0008_alter_lead_status"),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name="ModelPrice",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("provider", models.CharField(blank=True, max_length=255)),
+                ("model", models.CharField(max_length=255)),
+                ("prompt_price", models.DecimalField(decimal_places=6, max_digits=12)),
+                ("cached_price", models.DecimalField(blank=True, decimal_places=6, max_digits=12, null=True)),
+                ("completion_price", models.DecimalField(decimal_places=6, max_digits=12)),
+            ],
+            options={
+                "verbose_name": "Model price",
+                "verbose_name_plural": "Model prices",
+                "constraints": [models.UniqueConstraint(fields=("provider", "model"), name="unique_model_price")],
+            },
+        ),
+        migrations.CreateModel(
+            name="UsageRollup",
+            fields=[
+                ("id", models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name="ID")),
+                ("period", models.DateTimeField(db_index=True)),
+                ("provider", models.CharField(blank=True, max_length=255)),
+                ("model", models.CharField(max_length=255)),
+                ("turns", models.PositiveIntegerField(default=0)),
+                ("calls", models.PositiveIntegerField(default=0)),
+                ("rounds", models.PositiveIntegerField(default=0)),
+                ("prompt_tokens", models.PositiveBigIntegerField(default=0)),
+                ("completion_tokens", models.PositiveBigIntegerField(default=0)),
+                ("cached_tokens", models.PositiveBigIntegerField(default=0)),
+                ("cost", models.DecimalField(decimal_places=6, default=0, max_digits=16)),
+                (
+                    "agent",
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to="llmanager.agent"
+                    ),
+                ),
+                (
+                    "bot",
+                    models.ForeignKey(
+                        blank=True,
+                        null=True,
+                        on_delete=django.db.models.deletion.SET_NULL,
+                        to="telegrambot.telegrambot",
+                    ),
+                ),
+                (
+                    "user",
+                    models.ForeignKey(
+                        blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL
+                    ),
+                ),
+            ],
+            options={
+                "verbose_name": "Usage rollup",
+                "verbose_name_plural": "Usage rollups",
+                "constraints": [
+                    models.UniqueConstraint(
+                        models.F("period"),
+                        django.db.models.functions.comparison.Coalesce("agent", 0),
+                        django.db.models.functions.comparison.Coalesce("bot", 0),
+                        django.db.models.functions.comparison.Coalesce("user", 0),
+                        models.F("provider"),
+                        models.F("model"),
+                        name="llmanager_usagerollup_unique_key",
+                    )
+                ],
+            },
+        ),
+    ]
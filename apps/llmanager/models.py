@@ -1,5 +1,6 @@
 from django.utils.translation import gettext_lazy as _
 from django.db import models
+from django.db.models.functions import Coalesce
 from django.contrib.auth import get_user_model
 from solo.models import SingletonModel
 
@@ -44,6 +45,62 @@ class Conversation(models.Model):
         return f"Conversation {self.id} for User {self.user.username}"
 
 
+class ModelPrice(models.Model):
+    """Price of a model in USD per million tokens; a blank provider matches every provider of the model."""
+
+    provider = models.CharField(max_length=255, blank=True)
+    model = models.CharField(max_length=255)
+    prompt_price = models.DecimalField(max_digits=12, decimal_places=6)
+    # prompt tokens served from the provider's prompt cache, the prompt price when not set
+    cached_price = models.DecimalField(max_digits=12, decimal_places=6, null=True, blank=True)
+    completion_price = models.DecimalField(max_digits=12, decimal_places=6)
+
+    class Meta:
+        verbose_name = _("Model price")
+        verbose_name_plural = _("Model prices")
+        constraints = [models.UniqueConstraint(fields=["provider", "model"], name="unique_model_price")]
+
+    def __str__(self):
+        return f"{self.provider or '*'}/{self.model}"
+
+
+class UsageRollup(models.Model):
+    """Token usage and cost of completions per hour, agent, Telegram bot, user, provider and model."""
+
+    period = models.DateTimeField(db_index=True)
+    agent = models.ForeignKey(Agent, on_delete=models.SET_NULL, null=True, blank=True)
+    bot = models.ForeignKey("telegrambot.TelegramBot", on_delete=models.SET_NULL, null=True, blank=True)
+    user = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True)
+    provider = models.CharField(max_length=255, blank=True)
+    model = models.CharField(max_length=255)
+    turns = models.PositiveIntegerField(default=0)
+    calls = models.PositiveIntegerField(default=0)
+    rounds = models.PositiveIntegerField(default=0)
+    prompt_tokens = models.PositiveBigIntegerField(default=0)
+    completion_tokens = models.PositiveBigIntegerField(default=0)
+    cached_tokens = models.PositiveBigIntegerField(default=0)
+    cost = models.DecimalField(max_digits=16, decimal_places=6, default=0)
+
+    class Meta:
+        verbose_name = _("Usage rollup")
+        verbose_name_plural = _("Usage rollups")
+        constraints = [
+            # one row per key; NULL attributions are compared as 0, NULLs would otherwise never conflict
+            models.UniqueConstraint(
+                "period",
+                Coalesce("agent", 0),
+                Coalesce("bot", 0),
+                Coalesce("user", 0),
+                "provider",
+                "model",
+                name="llmanager_usagerollup_unique_key",
+            ),
+        ]
+
+    def __str__(self):
+        return f"Usage of {self.provider}/{self.model} at {self.period:%Y-%m-%d %H:00}"
+
+
 # class LLModel(models.Model):
 #     name = models.CharField(max_length=255)
 #     description = models.TextField()
@@ -8,6 +8,10 @@ class AgentRepository:
     def get(agent_id: int):
         return Agent.objects.get(id=agent_id)
 
+    @staticmethod
+    async def async_get(agent_id: int):
+        return await Agent.objects.aget(id=agent_id)
+
     @staticmethod
     def get_system_prompt_for_agent(agent_id: int):
         agent = AgentRepository.get(agent_id=agent_id)
@@ -31,6 +35,10 @@ class AgentRepository:
     def get_agent_by_name(agent_name: str):
         return Agent.objects.get(name=agent_name)
 
+    @staticmethod
+    async def async_get_agent_by_name(agent_name: str):
+        return await Agent.objects.aget(name=agent_name)
+
     @staticmethod
     def create_agent(
         name: str, description: str, instructions: str, model: str, provider: str, metadata: dict, is_active: bool
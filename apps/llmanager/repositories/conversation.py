@@ -12,10 +12,18 @@ class ConversationRepository:
     def update_title(cls, id, title):
         return Conversation.objects.filter(id=id).update(title=title)
 
+    @classmethod
+    async def async_update_title(cls, id, title):
+        return await Conversation.objects.filter(id=id).aupdate(title=title)
+
     @classmethod
     def get(cls, id):
         return Conversation.objects.get(id=id)
 
+    @classmethod
+    async def async_get(cls, id):
+        return await Conversation.objects.aget(id=id)
+
     @classmethod
     def get_user_conversations(cls, user_id):
         return Conversation.objects.filter(user=user_id)
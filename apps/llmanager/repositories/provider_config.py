@@ -6,6 +6,11 @@ class ConfigRepository:
     def get_default(cls):
         return DefaultConfig.get_solo()
 
+    @classmethod
+    async def async_get_default(cls):
+        obj, _ = await DefaultConfig.objects.aget_or_create(pk=DefaultConfig.singleton_instance_id)
+        return obj
+
     @classmethod
     def get_agent(cls):
         return DefaultConfig.get_solo().agent
@@ -0,0 +1,38 @@
+from django.db.models import Sum
+from django.db.models.functions import TruncDay, TruncMonth
+
+from apps.llmanager.models import UsageRollup
+
+TOTALS = ("turns", "calls", "rounds", "prompt_tokens", "completion_tokens", "cached_tokens", "cost")
+PERIODS = {"hour": "period", "day": TruncDay("period"), "month": TruncMonth("period")}
+
+
+class UsageRepository:
+    """Rollups of the hourly `UsageRollup` rows"""
+
+    @staticmethod
+    def rollup(group_by=("model",), since=None, until=None, **filters):
+        """
+        Usage summed per `group_by` fields, e.g. agent, bot, user, provider, model and hour, day or month.
+        Each row has the grouped fields and `total_<counter>` sums, ordered by the grouped fields.
+        """
+        rows = UsageRollup.objects.filter(**filters)
+        if since is not None:
+            rows = rows.filter(period__gte=since)
+        if until is not None:
+            rows = rows.filter(period__lt=until)
+        group_by = list(group_by)
+        periods = {name: PERIODS[name] for name in group_by if name in PERIODS and name != "hour"}
+        if periods:
+            rows = rows.annotate(**periods)
+        group_by = ["period" if name == "hour" else name for name in group_by]
+        return rows.values(*group_by).annotate(**{f"total_{name}": Sum(name) for name in TOTALS}).order_by(*group_by)
+
+    @staticmethod
+    def totals(since=None, until=None, **filters) -> dict:
+        rows = UsageRollup.objects.filter(**filters)
+        if since is not None:
+            rows = rows.filter(period__gte=since)
+        if until is not None:
+            rows = rows.filter(period__lt=until)
+        return rows.aggregate(**{f"total_{name}": Sum(name) for name in TOTALS})
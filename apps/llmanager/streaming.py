@@ -0,0 +1,84 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from contextlib import aclosing
+from typing import AsyncGenerator
+
+from aimanager.metrics import metrics
+
+logger = logging.getLogger("django")
+
+FIRST_DELTA_SECONDS = metrics.histogram(
+    "chat_stream_first_token_seconds", "Time from the start of an answer stream to its first text event"
+)
+
+HEARTBEAT_INTERVAL = float(os.getenv("SSE_HEARTBEAT_INTERVAL", 15))
+# how long a disconnected stream may take to abort the completion and save the partial answer
+ABORT_TIMEOUT = float(os.getenv("SSE_ABORT_TIMEOUT", 5))
+
+
+def format_event(event: str, data: dict, event_id: int = None) -> str:
+    lines = [] if event_id is None else [f"id: {event_id}"]
+    lines += [f"event: {event}", f"data: {json.dumps(data, ensure_ascii=False)}"]
+    return "\n".join(lines) + "\n\n"
+
+
+async def charge_usage(events: AsyncGenerator[dict], ticket) -> AsyncGenerator[dict]:
+    """Agent events, the tokens of the `usage` event are charged to the admission ticket of the request."""
+    async with aclosing(events):
+        async for event in events:
+            if event["type"] == "usage":
+                ticket.charge(event.get("total_tokens"))
+            yield event
+
+
+async def _produce(events: AsyncGenerator[dict], queue: asyncio.Queue) -> None:
+    try:
+        async with aclosing(events):
+            async for event in events:
+                queue.put_nowait(event)
+    except Exception as e:
+        logger.error("Answer stream failed", exc_info=e)
+        queue.put_nowait({"type": "error", "message": str(e)})
+    else:
+        queue.put_nowait({"type": "done"})
+
+
+async def sse_stream(events: AsyncGenerator[dict], heartbeat: float = None) -> AsyncGenerator[str]:
+    """
+    Server-sent events of an agent answer: `delta`, `tool`, `usage`, then `done` or `error`.
+
+    The agent events are produced by a separate task, so a comment line is sent every `heartbeat`
+    seconds while the model is silent and proxies keep the connection open. When the client
+    disconnects, the ASGI handler closes this generator and the producer task is cancelled,
+    which aborts the upstream completion.
+    """
+    heartbeat = heartbeat or HEARTBEAT_INTERVAL
+    started = time.perf_counter()
+    queue = asyncio.Queue()
+    producer = asyncio.get_running_loop().create_task(_produce(events, queue))
+    event_id = 0
+    try:
+        # the first bytes flush the response headers through buffering proxies
+        yield ": stream opened\n\n"
+        while True:
+            try:
+                event = await asyncio.wait_for(queue.get(), heartbeat)
+            except TimeoutError:
+                yield ": heartbeat\n\n"
+                continue
+            event_id += 1
+            kind = event.pop("type")
+            if kind == "delta" and started is not None:
+                FIRST_DELTA_SECONDS.observe(time.perf_counter() - started)
+                started = None
+            yield format_event(kind, event, event_id)
+            if kind in ("done", "error"):
+                return
+    finally:
+        if not producer.done():
+            logger.info("Client disconnected, aborting the answer stream")
+            producer.cancel()
+            await asyncio.wait([producer], timeout=ABORT_TIMEOUT)
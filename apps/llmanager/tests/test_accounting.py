@@ -0,0 +1,72 @@
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import IntegrityError, transaction
+from django.test import TestCase
+
+from aimanager.completions.usage import record_usage, track_usage
+
+from ..accounting import UsageStore
+from ..models import Agent, ModelPrice, UsageRollup
+from ..repositories.usage import UsageRepository
+
+
+class UsageRepositoryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.agent = Agent.objects.create(name="Support", instructions="Be nice")
+        ModelPrice.objects.create(
+            model="gpt-4o-mini",
+            prompt_price=Decimal("0.15"),
+            cached_price=Decimal("0.075"),
+            completion_price=Decimal("0.6"),
+        )
+        self.store = UsageStore(flush_interval=0)
+
+    def turn(self, rounds=0):
+        with track_usage() as usage:
+            usage.rounds = rounds
+            details = {"cached_tokens": 200_000}
+            record_usage(
+                {"prompt_tokens": 1_000_000, "completion_tokens": 100_000, "prompt_tokens_details": details},
+                "openai",
+                "gpt-4o-mini",
+            )
+            record_usage({"prompt_tokens": 100, "completion_tokens": 10}, "openrouter", "llama")
+        return usage
+
+    def test_usage_is_written_behind(self):
+        self.store.add(self.turn(rounds=2), agent_id=self.agent.id, user_id=self.user.id)
+        self.store.add(self.turn(), agent_id=self.agent.id, user_id=self.user.id)
+        self.assertFalse(UsageRollup.objects.exists())
+        self.assertEqual(self.store.flush(), 2)
+        self.store.add(self.turn(), user_id=self.user.id)
+        self.store.flush()
+
+        rows = {row["model"]: row for row in UsageRepository.rollup(["model"])}
+        gpt = rows["gpt-4o-mini"]
+        self.assertEqual(gpt["total_turns"], 3)
+        self.assertEqual(gpt["total_rounds"], 2)
+        self.assertEqual(gpt["total_calls"], 3)
+        self.assertEqual(gpt["total_cached_tokens"], 600_000)
+        # 800k prompt, 200k cached and 100k completion tokens per turn
+        self.assertEqual(gpt["total_cost"], Decimal("0.195") * 3)
+        self.assertEqual(rows["llama"]["total_cost"], 0)
+        by_agent = list(UsageRepository.rollup(["agent", "day"], model="gpt-4o-mini"))
+        self.assertCountEqual([row["agent"] for row in by_agent], [self.agent.id, None])
+        self.assertEqual(UsageRollup.objects.count(), 4)
+        self.assertEqual(self.store.report()["pending"], 0)
+
+    def test_usage_of_deleted_user_is_kept_unattributed(self):
+        other = User.objects.create_user(username="gone", password="12345")
+        self.store.add(self.turn(), agent_id=self.agent.id, user_id=other.id)
+        self.store.add(self.turn(), agent_id=self.agent.id)
+        other.delete()
+        self.assertEqual(self.store.flush(), 2)
+
+        row = UsageRollup.objects.get(model="gpt-4o-mini")
+        self.assertIsNone(row.user_id)
+        self.assertEqual((row.agent_id, row.turns), (self.agent.id, 2))
+        self.assertEqual(self.store.report()["pending"], 0)
+        with self.assertRaises(IntegrityError), transaction.atomic():
+            UsageRollup.objects.create(period=row.period, agent=self.agent, provider="openai", model="gpt-4o-mini")
@@ -0,0 +1,101 @@
+import asyncio
+
+import httpx
+import openai
+from django.test import SimpleTestCase
+
+from ..benchmark.fake_openai import FakeCompletionSettings, FakeOpenAIServer
+from ..benchmark.load import LoadGenerator, LoadStats, VirtualUser, compare, percentile
+
+TOOL = {
+    "type": "function",
+    "function": {
+        "name": "create_lead",
+        "parameters": {
+            "type": "object",
+            "properties": {"email": {"type": "string"}, "count": {"type": "integer"}},
+            "required": ["email", "count"],
+        },
+    },
+}
+
+
+class FakeOpenAIServerTest(SimpleTestCase):
+    def setUp(self):
+        self.settings = FakeCompletionSettings(latency=0, jitter=0, token_rate=0, chunk_tokens=2, response_tokens=5)
+        self.server = FakeOpenAIServer(self.settings, seed=1)
+
+    def complete(self, **kwargs):
+        async def run():
+            transport = httpx.ASGITransport(app=self.server)
+            async with httpx.AsyncClient(transport=transport) as http_client:
+                client = openai.AsyncOpenAI(
+                    base_url="http://fake/v1", api_key="fake", http_client=http_client, max_retries=0
+                )
+                messages = [{"role": "user", "content": "Hello there"}]
+                response = await client.chat.completions.create(model="fake", messages=messages, **kwargs)
+                if not kwargs.get("stream"):
+                    return response
+                return [chunk async for chunk in response]
+
+        return asyncio.run(run())
+
+    def test_streamed_answer_with_usage(self):
+        chunks = self.complete(stream=True, stream_options={"include_usage": True})
+        text = "".join(chunk.choices[0].delta.content or "" for chunk in chunks if chunk.choices)
+        self.assertEqual(len(text.split()), 5)
+        # 5 tokens in chunks of 2 after the role chunk, then the finish and the usage chunk
+        self.assertEqual(len(chunks), 6)
+        self.assertEqual(chunks[-1].choices, [])
+        self.assertEqual(chunks[-1].usage.completion_tokens, 5)
+
+    def test_tool_call_and_errors(self):
+        self.settings.tool_call_rate = 1
+        response = self.complete(tools=[TOOL])
+        call = response.choices[0].message.tool_calls[0]
+        self.assertEqual(call.function.name, "create_lead")
+        self.assertEqual(call.function.arguments, '{"email": "benchmark", "count": 1}')
+
+        self.settings.error_rate, self.settings.error_status = 1, 429
+        with self.assertRaises(openai.RateLimitError):
+            self.complete()
+        self.assertEqual(self.server.report(), {"requests": 2, "errors": 1, "tool_calls": 1})
+
+
+class LoadReportTest(SimpleTestCase):
+    def test_stats_and_baseline(self):
+        stats = LoadStats()
+        stats.started, stats.finished = 0, 10
+        for index in range(1, 101):
+            stats.add(200, index / 100, index / 10)
+        stats.add(500, None, 0.1)
+        results = {"load": stats.as_dict()}
+        self.assertEqual(results["load"]["requests_per_second"], 10)
+        self.assertEqual(results["load"]["ttft"], {"p50": 0.5, "p95": 0.95, "p99": 0.99})
+        self.assertEqual(results["load"]["errors"], {"500": 1})
+        self.assertEqual(percentile([3, 1, 2], 50), 2)
+
+        baseline = {"load": {**results["load"], "requests_per_second": 12, "ttft": {"p50": 0.5}}}
+        rows = {row["metric"]: row for row in compare(results, baseline, tolerance=0.1)}
+        self.assertTrue(rows["load.requests_per_second"]["regressed"])
+        self.assertFalse(rows["load.ttft.p50"]["regressed"])
+        self.assertNotIn("load.ttft.p95", rows)
+
+    def test_turns_of_both_endpoints(self):
+        def answer(request):
+            if request.url.path.endswith("/stream/"):
+                body = ": stream opened\n\nid: 1\nevent: delta\ndata: {}\n\nid: 2\nevent: done\ndata: {}\n\n"
+                return httpx.Response(200, text=body, headers={"content-type": "text/event-stream"})
+            return httpx.Response(200, text="Hello there")
+
+        async def turn(stream):
+            generator = LoadGenerator("http://app/", [], "Hi", duration=1, stream=stream)
+            user = VirtualUser("token", 7)
+            async with httpx.AsyncClient(transport=httpx.MockTransport(answer)) as client:
+                return generator.prompt_url(user), await generator.turn(client, user)
+
+        url, (_, status, ttft, latency, error) = asyncio.run(turn(stream=True))
+        self.assertEqual((url, status, error), ("http://app/chatbot/conversation/7/stream/", 200, None))
+        self.assertLessEqual(ttft, latency)
+        url, (_, status, ttft, _, error) = asyncio.run(turn(stream=False))
+        self.assertEqual((url, status, ttft, error), ("http://app/chatbot/conversation/7/", 200, None, None))
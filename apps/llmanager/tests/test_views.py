@@ -1,9 +1,16 @@
+import asyncio
+from unittest.mock import AsyncMock, Mock, patch
+
 from django.test import TestCase
 from django.urls import reverse
 from django.contrib.auth.models import User
+from rest_framework.authtoken.models import Token
 from rest_framework.test import APIClient
 from rest_framework import status
+from aimanager.agent.admission import AdmissionRejected
 from ..models import Conversation
+from ..streaming import sse_stream
+from ..views import AdmittedStreamingHttpResponse
 
 
 class ConversationViewTest(TestCase):
@@ -52,3 +59,144 @@ class ConversationViewTest(TestCase):
         self.client.force_authenticate(user=None)
         response = self.client.get(reverse("conversation-list"))
         self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+
+class FakeStreamingAgent:
+    async def async_generate_events(self, prompt, user_id, conversation_id):
+        for chunk in ["Hello", " there"]:
+            yield {"type": "delta", "content": chunk}
+
+
+class FakeSyncAgent:
+    def generate_response_stream(self, prompt, user_id, conversation_id):
+        yield from ["Hello", " there"]
+
+
+class ChatbotPromptViewTest(TestCase):
+    def setUp(self):
+        self.client = APIClient()
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.client.force_authenticate(user=self.user)
+        self.conversation = Conversation.objects.create(user=self.user)
+
+    @patch("apps.llmanager.views.ConfigRepository")
+    @patch("apps.llmanager.views.agent_pool")
+    def test_deprecated_plain_text_answer(self, mock_pool, mock_config):
+        mock_pool.get.return_value = FakeSyncAgent()
+        url = reverse("read-update-delete-conversation", kwargs={"conversation_id": self.conversation.id})
+        response = self.client.post(url, {"prompt": "Hi"}, format="json")
+        self.assertEqual(b"".join(response.streaming_content), b"Hello there")
+        self.assertEqual(response["Content-Type"], "text/plain; charset=utf-8")
+        self.assertEqual(response["Deprecation"], "true")
+        stream_url = reverse("stream-conversation", kwargs={"conversation_id": self.conversation.id})
+        self.assertEqual(response["Link"], f'<{stream_url}>; rel="successor-version"')
+        response.close()
+
+
+class ChatbotStreamViewTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(username="testuser", password="12345")
+        self.headers = {"Authorization": f"Token {Token.objects.create(user=self.user).key}"}
+        self.conversation = Conversation.objects.create(user=self.user)
+        self.url = reverse("stream-conversation", kwargs={"conversation_id": self.conversation.id})
+
+    @patch("apps.llmanager.views.async_agent_pool")
+    async def test_stream_answer(self, mock_pool):
+        mock_pool.get.return_value = FakeStreamingAgent()
+        response = await self.async_client.post(
+            self.url, {"prompt": "Hi"}, content_type="application/json", headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        body = b"".join([chunk async for chunk in response.streaming_content]).decode()
+        self.assertIn('id: 1\nevent: delta\ndata: {"content": "Hello"}\n\n', body)
+        self.assertIn('id: 2\nevent: delta\ndata: {"content": " there"}\n\n', body)
+        self.assertTrue(body.endswith("id: 3\nevent: done\ndata: {}\n\n"))
+        conversation = await Conversation.objects.aget(id=self.conversation.id)
+        self.assertEqual(conversation.title, "Hi")
+
+    @patch("apps.llmanager.views.admission")
+    @patch("apps.llmanager.views.async_agent_pool")
+    async def test_busy_when_overloaded(self, mock_pool, mock_admission):
+        mock_pool.get.return_value = FakeStreamingAgent()
+        mock_admission.async_acquire = AsyncMock(side_effect=AdmissionRejected("overload", 3))
+        response = await self.async_client.post(
+            self.url, {"prompt": "Hi"}, content_type="application/json", headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEqual(response["Retry-After"], "3")
+
+    async def test_unauthorized_access(self):
+        response = await self.async_client.post(self.url, {"prompt": "Hi"}, content_type="application/json")
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
+
+    async def test_foreign_conversation(self):
+        other = await User.objects.acreate(username="other")
+        conversation = await Conversation.objects.acreate(user=other)
+        url = reverse("stream-conversation", kwargs={"conversation_id": conversation.id})
+        response = await self.async_client.post(
+            url, {"prompt": "Hi"}, content_type="application/json", headers=self.headers
+        )
+        self.assertEqual(response.status_code, status.HTTP_404_NOT_FOUND)
+
+
+class AdmittedStreamingHttpResponseTest(TestCase):
+    def test_close_releases_ticket_of_unread_stream(self):
+        ticket = Mock()
+        response = AdmittedStreamingHttpResponse(iter([b"never read"]), ticket=ticket)
+        ticket.release.assert_not_called()
+        response.close()
+        ticket.release.assert_called_once_with()
+
+
+class SSEStreamTest(TestCase):
+    async def collect(self, events, heartbeat=None):
+        return [chunk async for chunk in sse_stream(events, heartbeat=heartbeat)]
+
+    async def test_heartbeat_while_model_is_silent(self):
+        async def events():
+            await asyncio.sleep(0.05)
+            yield {"type": "delta", "content": "Hi"}
+
+        chunks = await self.collect(events(), heartbeat=0.01)
+        self.assertIn(": heartbeat\n\n", chunks)
+        self.assertEqual(chunks[-1], "id: 2\nevent: done\ndata: {}\n\n")
+
+    async def test_error_event(self):
+        async def events():
+            yield {"type": "delta", "content": "Hi"}
+            raise ConnectionError("upstream failed")
+
+        chunks = await self.collect(events())
+        self.assertEqual(chunks[-1], 'id: 2\nevent: error\ndata: {"message": "upstream failed"}\n\n')
+
+    async def test_disconnect_aborts_events(self):
+        closed = asyncio.Event()
+
+        async def events():
+            try:
+                yield {"type": "delta", "content": "Hi"}
+                await asyncio.sleep(10)
+                yield {"type": "delta", "content": "never sent"}
+            finally:
+                closed.set()
+
+        stream = sse_stream(events())
+        await anext(stream)
+        self.assertIn("Hi", await anext(stream))
+        await stream.aclose()
+        self.assertTrue(closed.is_set())
+
+
+class MetricsViewTest(TestCase):
+    @patch("apps.llmanager.views.metrics")
+    def test_prometheus_text(self, metrics):
+        metrics.render.return_value = "# TYPE agent_turn_seconds histogram\n"
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_200_OK)
+        self.assertTrue(response["Content-Type"].startswith("text/plain; version=0.0.4"))
+        self.assertEqual(response.content, b"# TYPE agent_turn_seconds histogram\n")
+
+    @patch.dict("os.environ", {"METRICS_TOKEN": "secret"})
+    def test_token_is_required(self):
+        response = self.client.get(reverse("metrics"))
+        self.assertEqual(response.status_code, status.HTTP_401_UNAUTHORIZED)
@@ -6,6 +6,8 @@ urlpatterns = [
     path(
         "conversation/<int:conversation_id>/", views.ChatbotPromptView.as_view(), name="read-update-delete-conversation"
     ),
+    path("conversation/<int:conversation_id>/stream/", views.ChatbotStreamView.as_view(), name="stream-conversation"),
     path("conversation/", views.ConversationView.as_view(), name="list-create-conversation"),
     path("agents/", views.AgentViewSet.as_view({"get": "list"}), name="list-agents"),
+    path("metrics/", views.MetricsView.as_view(), name="metrics"),
 ]
@@ -1,23 +1,62 @@
 import json
 import logging
-
-from django.http import StreamingHttpResponse
+import os
+import secrets
+
+import redis
+from django.http import HttpResponse, JsonResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.decorators import method_decorator
+from django.views import View
+from django.views.decorators.csrf import csrf_exempt
 from rest_framework import status, viewsets
+from rest_framework.authtoken.models import Token
 from rest_framework.permissions import IsAuthenticated
 from rest_framework.response import Response
 from rest_framework.views import APIView
 
-from aimanager.agent.builder import LLMAgentBuilder
+from aimanager.agent.admission import AdmissionRejected, admission
+from aimanager.agent.builder import agent_pool, async_agent_pool
+from aimanager.metrics import metrics
+from apps.llmanager.accounting import usage_store
+from apps.llmanager.models import Conversation
 from apps.llmanager.repositories.agent import AgentRepository
 from apps.llmanager.repositories.conversation import ConversationRepository
 from apps.llmanager.repositories.provider_config import ConfigRepository
 from apps.llmanager.serializers import AgentSerializer, ConversationSerializer
+from apps.llmanager.streaming import charge_usage, sse_stream
 
 logger = logging.getLogger("django")
 
+ORM_SECONDS = metrics.histogram("chatbot_orm_seconds", "Database queries of a chat stream request", ("query",))
+
+
+def busy_response(e: AdmissionRejected, response_class=JsonResponse):
+    """Fast 503 of a request that admission control shed, instead of a request timing out in the queue."""
+    response = response_class({"error": str(e)}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+    response["Retry-After"] = str(max(int(e.retry_after), 1))
+    return response
+
+
+class AdmittedStreamingHttpResponse(StreamingHttpResponse):
+    """Streaming response that keeps an admission ticket until Django closes it, also when the stream never started."""
+
+    def __init__(self, *args, ticket, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ticket = ticket
+
+    def close(self):
+        self.ticket.release()
+        super().close()
+
 
 class ChatbotPromptView(APIView):
     def post(self, request, conversation_id=None):
+        """
+        Deprecated: the raw answer text from the sync agent, streamed as plain text. Behind ASGI Django
+        buffers a sync iterator, so nothing arrives before the whole answer, and the generation goes on
+        after the client disconnects. Clients should move to `ChatbotStreamView`, named by the `Link` header.
+        """
         try:
             data = request.data
             prompt = data.get("prompt")
@@ -32,17 +71,33 @@ class ChatbotPromptView(APIView):
             model = ConfigRepository.get_model()
             provider = ConfigRepository.get_provider()
 
-            system_prompt = None
+            system_prompt = metadata = agent_model = None
             if agent_id:
-                system_prompt = AgentRepository.get_system_prompt_for_agent(agent_id)
-            agent = LLMAgentBuilder.build(agent_name=agent, provider=provider, model=model, system_prompt=system_prompt)
+                agent_model = AgentRepository.get(agent_id)
+                system_prompt, metadata = agent_model.instructions, agent_model.metadata
+            agent = agent_pool.get(
+                agent_name=agent, provider=provider, model=model, system_prompt=system_prompt, metadata=metadata
+            )
             conversation = ConversationRepository.get(conversation_id)
             if not conversation.title:
                 ConversationRepository.update_title(conversation_id, prompt[:20])
-            response_generator = agent.generate_response_stream(prompt, user_id, conversation_id)
-            response = StreamingHttpResponse(response_generator, content_type="text/event-stream; charset=utf-8")
+            ticket = admission.acquire(f"user:{user_id}")
+            response_generator = usage_store.track(
+                agent.generate_response_stream(prompt, user_id, conversation_id),
+                agent_id=agent_model and agent_model.id,
+                user_id=user_id,
+            )
+            response = AdmittedStreamingHttpResponse(
+                response_generator, content_type="text/plain; charset=utf-8", ticket=ticket
+            )
             response["Cache-Control"] = "no-cache"
+            response["Deprecation"] = "true"
+            if conversation_id is not None:
+                successor = reverse("stream-conversation", kwargs={"conversation_id": conversation_id})
+                response["Link"] = f'<{successor}>; rel="successor-version"'
             return response
+        except AdmissionRejected as e:
+            return busy_response(e, Response)
         except json.JSONDecodeError:
             return Response({"error": "Invalid JSON"}, status=status.HTTP_400_BAD_REQUEST)
         except Exception as e:
@@ -55,7 +110,7 @@ class ChatbotPromptView(APIView):
             agent = ConfigRepository.get_agent()
             model = ConfigRepository.get_model()
             provider = ConfigRepository.get_provider()
-            agent = LLMAgentBuilder.build(agent_name=agent, provider=provider, model=model)
+            agent = agent_pool.get(agent_name=agent, provider=provider, model=model)
             conversation = agent.get_conversation(user_id, conversation_id)
 
             return Response(conversation, status=status.HTTP_200_OK)
@@ -70,7 +125,7 @@ class ChatbotPromptView(APIView):
             agent = ConfigRepository.get_agent()
             model = ConfigRepository.get_model()
             provider = ConfigRepository.get_provider()
-            agent = LLMAgentBuilder.build(agent_name=agent, provider=provider, model=model)
+            agent = agent_pool.get(agent_name=agent, provider=provider, model=model)
             agent.clear_conversation(user_id, conversation_id)
             ConversationRepository.delete(conversation_id)
             return Response({"message": "Conversation cleared"}, status=status.HTTP_200_OK)
@@ -79,6 +134,82 @@ class ChatbotPromptView(APIView):
             return Response({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
 
 
+async def async_authenticate(request):
+    """Async `TokenAuthentication`: the user of the `Authorization: Token <key>` header or None."""
+    keyword, _, key = request.headers.get("Authorization", "").partition(" ")
+    if keyword != "Token" or not key.strip():
+        return None
+    try:
+        token = await Token.objects.select_related("user").aget(key=key.strip())
+    except Token.DoesNotExist:
+        return None
+    return token.user if token.user.is_active else None
+
+
+@method_decorator(csrf_exempt, name="dispatch")
+class ChatbotStreamView(View):
+    """
+    Streams the answer to a prompt from the async agent as server-sent events, see `sse_stream`.
+    The whole request runs on the event loop of the ASGI worker, a stream doesn't hold a thread.
+    """
+
+    async def post(self, request, conversation_id):
+        user = await async_authenticate(request)
+        if user is None:
+            return JsonResponse({"error": "Invalid token"}, status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            data = json.loads(request.body or b"{}")
+        except json.JSONDecodeError:
+            return JsonResponse({"error": "Invalid JSON"}, status=status.HTTP_400_BAD_REQUEST)
+        prompt = data.get("prompt")
+        if not prompt:
+            return JsonResponse({"error": "No prompt provided"}, status=status.HTTP_400_BAD_REQUEST)
+
+        try:
+            with ORM_SECONDS.labels("get_conversation").time():
+                conversation = await ConversationRepository.async_get(conversation_id)
+            if conversation.user_id != user.id:
+                return JsonResponse({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+            with ORM_SECONDS.labels("get_config").time():
+                config = await ConfigRepository.async_get_default()
+            system_prompt = metadata = agent_model = None
+            agent_id = data.get("agent_id")
+            if agent_id:
+                with ORM_SECONDS.labels("get_agent").time():
+                    agent_model = await AgentRepository.async_get(agent_id)
+                system_prompt, metadata = agent_model.instructions, agent_model.metadata
+            agent = async_agent_pool.get(
+                agent_name=config.agent,
+                provider=config.provider,
+                model=config.model,
+                system_prompt=system_prompt,
+                metadata=metadata,
+            )
+            if not conversation.title:
+                await ConversationRepository.async_update_title(conversation_id, prompt[:20])
+        except Conversation.DoesNotExist:
+            return JsonResponse({"error": "Conversation not found"}, status=status.HTTP_404_NOT_FOUND)
+        except Exception as e:
+            logger.error("error", exc_info=e)
+            return JsonResponse({"error": str(e)}, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+        try:
+            ticket = await admission.async_acquire(f"user:{user.id}")
+        except AdmissionRejected as e:
+            return busy_response(e)
+        events = usage_store.async_track(
+            agent.async_generate_events(prompt, user.id, conversation_id),
+            agent_id=agent_model and agent_model.id,
+            user_id=user.id,
+        )
+        events = sse_stream(charge_usage(events, ticket))
+        response = AdmittedStreamingHttpResponse(events, content_type="text/event-stream; charset=utf-8", ticket=ticket)
+        response["Cache-Control"] = "no-cache"
+        # nginx must pass the events through as they come
+        response["X-Accel-Buffering"] = "no"
+        return response
+
+
 class ConversationView(APIView):
     def post(self, request):
         try:
@@ -103,3 +234,21 @@ class AgentViewSet(viewsets.ReadOnlyModelViewSet):
     queryset = AgentRepository.get_active_agents()
     serializer_class = AgentSerializer
     permission_classes = [IsAuthenticated]
+
+
+class MetricsView(View):
+    """
+    Counters and histograms of all workers in the Prometheus text format, see `MetricsRegistry`.
+    When METRICS_TOKEN is set the scraper sends it as `Authorization: Bearer <token>`.
+    """
+
+    def get(self, request):
+        token = os.getenv("METRICS_TOKEN")
+        if token and not secrets.compare_digest(request.headers.get("Authorization", ""), f"Bearer {token}"):
+            return JsonResponse({"error": "Invalid token"}, status=status.HTTP_401_UNAUTHORIZED)
+        try:
+            body = metrics.render()
+        except redis.RedisError as e:
+            logger.error("Metrics are unavailable", exc_info=e)
+            return JsonResponse({"error": "Metrics are unavailable"}, status=status.HTTP_503_SERVICE_UNAVAILABLE)
+        return HttpResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -3,7 +3,7 @@ from django.contrib import admin, messages
 from django.db.models.signals import pre_delete
 from django.dispatch import receiver
 
-from aimanager.agent.builder import LLMAgentBuilder
+from aimanager.agent.builder import agent_pool
 from apps.llmanager.repositories.agent import AgentRepository
 from apps.telegrambot.models import Conversation, ConversationMessage, Lead, TelegramBot
 from apps.telegrambot.services import build_webhook_url, register_webhook, update_bot_properties
@@ -84,7 +84,7 @@ class MessageInline(admin.TabularInline):
 def clear_conversation_memory(sender, instance, **kwargs):
     try:
         model, provider, _ = AgentRepository.get_agent_params(instance.bot.agent_id)
-        agent = LLMAgentBuilder.build(agent_name="base", provider=provider, model=model)
+        agent = agent_pool.get(agent_name="base", provider=provider, model=model)
         agent.clear_conversation(instance.chat_id, instance.bot.id)
     except Exception as e:
         # Log the error but don't prevent deletion
@@ -7,13 +7,22 @@ from django.views.decorators.csrf import csrf_exempt
 from telegram import constants
 from telegram import error as tgerror
 
-from aimanager.agent.builder import AsyncLLMAgentBuilder
+from aimanager.agent.admission import AdmissionRejected, admission
+from aimanager.agent.builder import async_agent_pool
+from aimanager.completions.usage import track_usage
+from aimanager.metrics import metrics
+from aimanager.tracing import tracer
+from apps.llmanager.accounting import usage_store
 from apps.llmanager.repositories.agent import AgentRepository
 from apps.telegrambot.models import TelegramBot
 from apps.telegrambot.services import create_lead, log_conversation, notify_manager, parse_update
 
 logger = logging.getLogger("django")
 
+BUSY_REPLY = "Sorry, I'm handling too many messages right now. Please try again in a minute."
+
+ORM_SECONDS = metrics.histogram("telegram_orm_seconds", "Database queries of a Telegram update", ("query",))
+
 
 @method_decorator(csrf_exempt, name="dispatch")
 class WebhookView(View):
@@ -33,18 +42,52 @@ class WebhookView(View):
 
 
 async def handle_update(request: HttpRequest, bot_id: int, user_id: int) -> None:
-    bot_model = await TelegramBot.objects.aget(id=bot_id)
-    update = await parse_update(request.body, bot_model.token)
-    await log_conversation(bot_model, update.message.chat.id, update.message.chat.username, update.message.text)
-    model, provider, instructions = await AgentRepository.async_get_agent_params(bot_model.agent_id)
-    instructions += f"\n {bot_model.bot_specific_prompt}"
-    agent = AsyncLLMAgentBuilder.build(agent_name="base", provider=provider, model=model, system_prompt=instructions)
-    agent.register_tool(create_lead)
-    agent.register_tool(notify_manager)
-    response = await agent.async_generate_response(update.message.text, update.message.chat.id, bot_model.id)
-    await log_conversation(bot_model, update.message.chat.id, bot_model.name, response)
+    # a trace per update, sampled at its head unless the caller sent a sampled traceparent
+    with tracer.trace("telegram.handle_update", request.headers.get("traceparent"), bot_id=bot_id):
+        await _handle_update(request, bot_id)
+
+
+async def _handle_update(request: HttpRequest, bot_id: int) -> None:
+    with ORM_SECONDS.labels("get_bot").time(), tracer.span("orm.get_bot"):
+        bot_model = await TelegramBot.objects.aget(id=bot_id)
+    with tracer.span("telegram.parse_update"):
+        update = await parse_update(request.body, bot_model.token)
+    with ORM_SECONDS.labels("log_conversation").time(), tracer.span("telegram.log_conversation", author="user"):
+        await log_conversation(bot_model, update.message.chat.id, update.message.chat.username, update.message.text)
+    with ORM_SECONDS.labels("get_agent").time(), tracer.span("orm.get_agent"):
+        agent_model = await AgentRepository.async_get(bot_model.agent_id)
+    instructions = agent_model.instructions + f"\n {bot_model.bot_specific_prompt}"
+    agent = async_agent_pool.get(
+        agent_name="base",
+        provider=agent_model.provider,
+        model=agent_model.model,
+        system_prompt=instructions,
+        tools=[create_lead, notify_manager],
+        metadata=agent_model.metadata,
+    )
     try:
-        await update.message.reply_text(response, parse_mode=constants.ParseMode.HTML)
-    except tgerror.BadRequest:
-        logger.info("Cant parse as HTML, try simple response...")
-        await update.message.reply_text(response)
+        # one bot is one tenant, a busy bot can't take the whole worker
+        tenant = f"bot:{bot_model.id}"
+        async with admission.async_admit(tenant) as ticket:
+            with track_usage() as usage:
+                try:
+                    # the summary of the chat is admitted for the bot too
+                    response = await agent.async_generate_response(
+                        update.message.text, update.message.chat.id, bot_model.id, tenant=tenant
+                    )
+                finally:
+                    # the spend of the bot, also of a failed turn, is attributed to its owner
+                    usage_store.add(usage, agent_id=agent_model.id, bot_id=bot_model.id, user_id=bot_model.user_id)
+            ticket.charge(usage.total_tokens)
+    except AdmissionRejected as e:
+        logger.warning(f"Bot {bot_model.id} is busy: {e}")
+        await update.message.reply_text(BUSY_REPLY)
+        return
+    with ORM_SECONDS.labels("log_conversation").time(), tracer.span("telegram.log_conversation", author="bot"):
+        await log_conversation(bot_model, update.message.chat.id, bot_model.name, response)
+    with tracer.span("telegram.reply"):
+        try:
+            await update.message.reply_text(response, parse_mode=constants.ParseMode.HTML)
+        except tgerror.BadRequest:
+            logger.info("Cant parse as HTML, try simple response...")
+            await update.message.reply_text(response)
@@ -1,3 +1,4 @@
+import json
 import os
 import streamlit as st
 import requests
@@ -216,7 +217,7 @@ if st.session_state["authenticated"]:
                 request_data["agent_id"] = st.session_state["current_agent_id"]
 
             response = requests.post(
-                conv_url,
+                f"{conv_url}stream/",
                 json=request_data,
                 headers=headers,
                 stream=True,
@@ -226,15 +227,18 @@ if st.session_state["authenticated"]:
 
                 def iter_content():
                     chatbot_response = ""
-                    temp_response = b""
-                    for chunk in response.iter_content():
-                        try:
-                            temp_response += chunk
-                            yield temp_response.decode("utf-8")
-                            chatbot_response += temp_response.decode("utf-8")
-                            temp_response = b""
-                        except UnicodeDecodeError:
-                            pass
+                    event = None
+                    # server-sent events: "event:" and "data:" lines, comments start with ":"
+                    for line in response.iter_lines(decode_unicode=True):
+                        if line.startswith("event: "):
+                            event = line[len("event: ") :]
+                        elif line.startswith("data: "):
+                            data = json.loads(line[len("data: ") :])
+                            if event == "delta":
+                                chatbot_response += data["content"]
+                                yield data["content"]
+                            elif event == "error":
+                                st.error(f"Error: {data['message']}")
                     st.session_state["conversation"].append({"role": "chatbot", "content": chatbot_response})
 
                 with st.chat_message("assistant"):